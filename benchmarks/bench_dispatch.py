@@ -0,0 +1,67 @@
+"""Стоимость выбора обработчика события в зависимости от числа обработчиков
+
+python benchmarks/bench_dispatch.py
+
+Для capture_dict и Events.do регистрируется N обработчиков разных событий,
+затем измеряется время обработки одного сообщения. Обработчик пустой,
+поэтому время - это стоимость поиска обработчика.
+"""
+
+import asyncio
+import logging
+import time
+from types import FunctionType
+
+import micro.kafka_consumer as kafka_consumer
+from micro.events import Events
+
+logging.disable(logging.INFO)
+
+HANDLER_COUNTS = [10, 100, 300, 1000]
+ITERATIONS = 20000
+
+
+async def noop(*args):
+    pass
+
+
+def register_handlers(count: int) -> None:
+    """Зарегистрировать count обработчиков, искомое событие последнее"""
+    kafka_consumer.message_handlers.clear()
+    kafka_consumer.event_handlers.clear()
+    kafka_consumer.handlers_index.clear()
+    for n in range(count - 1):
+        kafka_consumer.message_handler(f"BenchEvent{n}")(noop)
+    kafka_consumer.message_handler("BenchTarget")(noop)
+
+
+def events_class(count: int) -> type:
+    """Класс legacy обработчиков Events с count функциями"""
+    functions = {
+        f"bench_event{n}": FunctionType(noop.__code__, globals())
+        for n in range(count - 1)
+    }
+    functions["bench_target"] = FunctionType(noop.__code__, globals())
+    return type("BenchEvents", (Events,), functions)
+
+
+async def measure(func, message) -> float:
+    """Среднее время одного вызова, мкс"""
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        await func(message)
+    return (time.perf_counter() - start) / ITERATIONS * 1e6
+
+
+async def main():
+    message = {"header": {"event": "BenchTarget"}, "event": "BenchTarget"}
+    print(f"{'handlers':>10} {'capture_dict, us':>18} {'Events.do, us':>16}")
+    for count in HANDLER_COUNTS:
+        register_handlers(count)
+        capture_us = await measure(kafka_consumer.capture_dict, message)
+        do_us = await measure(events_class(count).do, message)
+        print(f"{count:>10} {capture_us:>18.2f} {do_us:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,39 @@
+"""Те же бенчмарки через pytest-benchmark
+
+python -m pytest benchmarks/bench_pytest.py --benchmark-json=results.json
+"""
+
+import asyncio
+import itertools
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import micro.config as config  # noqa: E402
+from micro.kafka_producer import KafkaProducer  # noqa: E402
+from run import CASES, NullProducer  # noqa: E402
+
+
+@pytest.mark.parametrize("name", list(CASES))
+def test_benchmark(benchmark, monkeypatch, name):
+    monkeypatch.setattr(KafkaProducer(), "producer", NullProducer())
+    monkeypatch.setattr(config, "DLQ_WRITE_TOPIC", config.DLQ_WRITE_TOPIC)
+    func, args, *rest = CASES[name]()
+    # Сообщений за вызов, время сообщения - время вызова / per_call
+    per_call = rest[0] if rest else 1
+    benchmark.extra_info["per_call"] = per_call
+    loop = asyncio.new_event_loop()
+    cycle = itertools.cycle(args)
+    try:
+        if per_call > 1:
+            # Вызов уже содержит per_call сообщений, без лишних повторов
+            benchmark.pedantic(
+                lambda: loop.run_until_complete(func(next(cycle))),
+                rounds=max(1, 5000 // per_call),
+                warmup_rounds=1,
+            )
+        else:
+            benchmark(lambda: loop.run_until_complete(func(next(cycle))))
+    finally:
+        loop.close()
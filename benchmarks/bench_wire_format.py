@@ -0,0 +1,110 @@
+"""Размер и время кодирования событий в json и msgpack
+
+python benchmarks/bench_wire_format.py
+python benchmarks/bench_wire_format.py --output wire.json
+
+Для каждой модели micro.models создается событие со всеми полями
+(payloads.synthetic) и заголовком, как в HeaderEvent.send.
+Кодирование - HeaderEvent.encode() для json и msgpack топика,
+разбор - EventMessage.validate(), как в capture().
+Без пакета msgpack измеряется только json.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import micro.config as config  # noqa: E402
+from micro import codec  # noqa: E402
+from micro.kafka_consumer import EventMessage  # noqa: E402
+from micro.models.header_event import HeaderEvent  # noqa: E402
+from micro.schemes import Schema  # noqa: E402
+from payloads import synthetic  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+JSON_TOPIC = "bench-json"
+MSGPACK_TOPIC = "bench-msgpack"
+
+
+def timed(func, iterations: int) -> float:
+    """Среднее время вызова func, мкс"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def measure(obj: HeaderEvent, topic: str, iterations: int) -> dict:
+    model = obj.__class__
+    value, headers = obj.encode(topic)
+
+    def decode():
+        EventMessage(value, headers=headers).validate(model)
+
+    decode()
+    return {
+        "bytes": len(value),
+        "encode_us": round(timed(lambda: obj.encode(topic), iterations), 2),
+        "decode_us": round(timed(decode, iterations), 2),
+    }
+
+
+def events() -> list:
+    """События всех моделей со всеми полями"""
+    result = []
+    for name, model in sorted(Schema().get_models().items()):
+        if not issubclass(model, HeaderEvent) or model is HeaderEvent:
+            continue
+        try:
+            obj = model(**synthetic(model))
+        except Exception:
+            continue
+        obj.stamp(client_id="1")
+        result.append(obj)
+    return result
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="файл результатов json")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args(argv)
+    config.MSGPACK_TOPICS = [MSGPACK_TOPIC] if codec.msgpack else []
+    formats = {"json": JSON_TOPIC}
+    if codec.msgpack:
+        formats["msgpack"] = MSGPACK_TOPIC
+    else:
+        print("msgpack is not installed, json only\n")
+    results = {}
+    print(
+        f"{'event':<36} {'format':<8} {'bytes':>7} "
+        + f"{'encode us':>10} {'decode us':>10}"
+    )
+    for obj in events():
+        name = obj.__class__.__name__
+        results[name] = {
+            fmt: measure(obj, topic, args.iterations)
+            for fmt, topic in formats.items()
+        }
+        for fmt, result in results[name].items():
+            print(
+                f"{name:<36} {fmt:<8} {result['bytes']:>7} "
+                + f"{result['encode_us']:>10.2f} {result['decode_us']:>10.2f}"
+            )
+    print()
+    for fmt in formats:
+        total = sum(result[fmt]["bytes"] for result in results.values())
+        print(f"total {fmt}: {total} bytes in {len(results)} events")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Синтетические сообщения по моделям micro.models
+
+Для каждой модели заполняются все поля значениями по аннотации типа,
+так размер и состав сообщения близки к настоящим событиям.
+"""
+
+import datetime
+import enum
+import json
+import types
+import typing
+import uuid
+
+from pydantic import BaseModel
+
+from micro.models.header_event import HeaderEvent
+from micro.schemes import Schema
+
+
+def synthetic_value(annotation, depth: int = 0):
+    """Значение по аннотации типа поля"""
+    origin = typing.get_origin(annotation)
+    args = [
+        arg for arg in typing.get_args(annotation) if arg is not type(None)
+    ]
+    if origin in (typing.Union, types.UnionType):
+        return synthetic_value(args[0], depth)
+    if origin is typing.Literal:
+        return typing.get_args(annotation)[0]
+    if origin in (list, typing.List):
+        item = args[0] if args else str
+        return [synthetic_value(item, depth + 1) for _ in range(2)]
+    if origin in (dict, typing.Dict) or annotation is dict:
+        return {"key": "value", "count": 1}
+    if annotation is list:
+        return ["item", "item"]
+    if isinstance(annotation, type):
+        if issubclass(annotation, BaseModel):
+            return synthetic(annotation, depth + 1)
+        if issubclass(annotation, enum.Enum):
+            return next(iter(annotation)).value
+        if issubclass(annotation, bool):
+            return True
+        if issubclass(annotation, int):
+            return 12345
+        if issubclass(annotation, float):
+            return 123.45
+        if issubclass(annotation, datetime.datetime):
+            return datetime.datetime(2025, 1, 31, 12, 30).isoformat()
+        if issubclass(annotation, datetime.date):
+            return "2025-01-31"
+    return "Текст сообщения для проверки производительности"
+
+
+def synthetic(model: type, depth: int = 0) -> dict:
+    """Сообщение модели как dict, все поля заполнены"""
+    if depth > 3:
+        return {}
+    return {
+        name: synthetic_value(field.annotation, depth)
+        for name, field in model.model_fields.items()
+        if name not in ("header", "addresse")
+    }
+
+
+def event_payload(model: type) -> bytes:
+    """Сообщение kafka события модели, как его отправляет HeaderEvent"""
+    data = {
+        "header": {
+            "utc": "2025-01-31T09:30:00+00:00",
+            "datetime": "2025-01-31T12:30:00",
+            "event": model.__name__,
+            "uuid": str(uuid.uuid4()),
+            "source": "benchmark",
+            "trace_id": str(uuid.uuid4()),
+        },
+        "addresse": {"client_id": "1", "chat_id": None, "channel": None},
+        **synthetic(model),
+    }
+    return json.dumps(data, ensure_ascii=False).encode()
+
+
+def model_families() -> dict:
+    """Модели событий по модулям: имя модуля -> [модель]
+
+    Модели со своей deserialization() (обращаются к базе или api)
+    не включаются, бенчмарк измеряет только разбор сообщения.
+    """
+    families: dict = {}
+    for model in Schema().get_models().values():
+        if not issubclass(model, HeaderEvent) or model is HeaderEvent:
+            continue
+        if model.deserialization is not HeaderEvent.deserialization:
+            continue
+        family = model.__module__.rsplit(".", 1)[-1]
+        families.setdefault(family, []).append(model)
+    return families
@@ -0,0 +1,302 @@
+"""Бенчмарки конвейера обработки событий
+
+python benchmarks/run.py --output results.json
+python benchmarks/run.py --only validate --compare results.json
+
+Измеряется сообщений в секунду и задержка одного сообщения:
+    capture_dispatch - capture() с пустым legacy обработчиком
+    validate_<модуль> - capture() с типизированными обработчиками
+        моделей модуля micro.models, сообщения по моделям
+    header_event_send - HeaderEvent.send, сериализация и отправка
+        в пустой producer
+    report_mailing_10k - рассылка 10000 Report одним вызовом
+    report_send_many_10k - та же рассылка через HeaderEvent.send_many
+    dlq_error_path - capture() с ошибкой обработчика и отправкой в DLQ
+    codec_encode_<библиотека>, codec_decode_<библиотека> - json
+        сообщения Report через micro.codec и стандартный json,
+        encode с JSON_COMPACT
+Результат сохраняется в json для сравнения версий (--compare).
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import time
+from importlib.metadata import PackageNotFoundError, version
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import micro.config as config  # noqa: E402
+import micro.kafka_consumer as kafka_consumer  # noqa: E402
+from micro import codec  # noqa: E402
+from micro.kafka_producer import KafkaProducer  # noqa: E402
+from payloads import event_payload, model_families, synthetic  # noqa: E402
+
+logging.disable(logging.CRITICAL)
+
+CASES: dict = {}
+
+
+def case(name: str):
+    """Зарегистрировать бенчмарк, функция возвращает (корутина, аргументы)
+    или (корутина, аргументы, сообщений за вызов)"""
+
+    def decorator(func):
+        CASES[name] = func
+        return func
+
+    return decorator
+
+
+class NullProducer:
+    """Producer без kafka, учитывает только отправленные байты"""
+
+    def __init__(self):
+        self.sent = 0
+
+    async def send_and_wait(self, topic, value=None, key=None, **kwargs):
+        self.sent += len(value)
+
+    async def send(self, topic, value=None, key=None, **kwargs):
+        self.sent += len(value)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def stop(self):
+        pass
+
+
+def reset_handlers() -> None:
+    kafka_consumer.message_handlers.clear()
+    kafka_consumer.event_handlers.clear()
+    kafka_consumer.all_event_handlers.clear()
+    kafka_consumer.batch_event_handlers.clear()
+    kafka_consumer.handlers_index.clear()
+
+
+def kafka_message(value: bytes) -> SimpleNamespace:
+    return SimpleNamespace(
+        value=value, timestamp=int(time.time() * 1000), key=None
+    )
+
+
+async def noop(*args):
+    pass
+
+
+@case("capture_dispatch")
+def capture_dispatch():
+    reset_handlers()
+    kafka_consumer.message_handler("BenchEvent")(noop)
+    value = json.dumps(
+        {"header": {"event": "BenchEvent", "uuid": "1"}, "text": "x"}
+    ).encode()
+    return kafka_consumer.capture, [kafka_message(value)]
+
+
+def validate_family(models: list):
+    def setup():
+        reset_handlers()
+        for model in models:
+            kafka_consumer.event_handler(model.__name__)(noop)
+        return kafka_consumer.capture, [
+            kafka_message(event_payload(model)) for model in models
+        ]
+
+    return setup
+
+
+for family, models in sorted(model_families().items()):
+    case(f"validate_{family}")(validate_family(models))
+
+
+@case("header_event_send")
+def header_event_send():
+    from micro.models.common_events import Report
+
+    obj = Report(**synthetic(Report))
+    return (lambda obj: obj.send(client_id="1")), [obj]
+
+
+@case("report_mailing_10k")
+def report_mailing():
+    from micro.models.common_events import Report
+
+    data = synthetic(Report)
+    reports = [Report(**data) for _ in range(10000)]
+
+    async def mailing(reports):
+        for obj in reports:
+            await obj.send(client_id="1")
+
+    return mailing, [reports], len(reports)
+
+
+@case("report_send_many_10k")
+def report_send_many():
+    from micro.models.common_events import Report
+
+    data = synthetic(Report)
+    reports = [Report(**data) for _ in range(10000)]
+
+    async def mailing(reports):
+        await Report.send_many(reports, client_id="1")
+
+    return mailing, [reports], len(reports)
+
+
+@case("dlq_error_path")
+def dlq_error_path():
+    reset_handlers()
+    config.DLQ_WRITE_TOPIC = "bench-dlq"
+
+    async def failed(obj):
+        raise ValueError("benchmark error")
+
+    kafka_consumer.message_handler("BenchEvent")(failed)
+    value = json.dumps(
+        {"header": {"event": "BenchEvent", "uuid": "1"}, "text": "x"}
+    ).encode()
+    return kafka_consumer.capture, [kafka_message(value)]
+
+
+def report_data() -> dict:
+    from micro.models.common_events import Report
+
+    return Report(**synthetic(Report)).model_dump()
+
+
+def codec_cases(name: str):
+    @case(f"codec_encode_{name}")
+    def encode():
+        # Сериализация orjson только при JSON_COMPACT
+        codec.use(name, compact=True)
+        dumps = codec.dumps
+
+        async def func(data):
+            dumps(data)
+
+        return func, [report_data()]
+
+    @case(f"codec_decode_{name}")
+    def decode():
+        codec.use(name, compact=True)
+        loads = codec.loads
+
+        async def func(value):
+            loads(value)
+
+        return func, [codec.dumps(report_data())]
+
+
+for name in dict.fromkeys(["json", codec.select()]):
+    codec_cases(name)
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+async def measure(
+    iterations: int, func, args: list, per_call: int = 1
+) -> dict:
+    """Выполнить func по кругу с аргументами args
+
+    :param int per_call: сообщений за один вызов func,
+        вызовов iterations / per_call, но не меньше одного
+    """
+    # Прогрев
+    for arg in args:
+        await func(arg)
+    calls = max(1, iterations // per_call)
+    latencies = []
+    started = time.perf_counter()
+    for n in range(calls):
+        start = time.perf_counter_ns()
+        await func(args[n % len(args)])
+        latencies.append((time.perf_counter_ns() - start) / per_call)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    iterations = calls * per_call
+    return {
+        "iterations": iterations,
+        "msg_per_sec": round(iterations / elapsed, 1),
+        "mean_us": round(sum(latencies) / iterations / 1000, 2),
+        "p50_us": round(percentile(latencies, 0.50) / 1000, 2),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 2),
+    }
+
+
+async def run(names: list, iterations: int) -> dict:
+    KafkaProducer().producer = NullProducer()
+    results = {}
+    dlq_write_topic = config.DLQ_WRITE_TOPIC
+    for name in names:
+        config.DLQ_WRITE_TOPIC = dlq_write_topic
+        results[name] = await measure(iterations, *CASES[name]())
+        print(
+            f"{name:<32} {results[name]['msg_per_sec']:>12.1f} msg/s "
+            + f"{results[name]['p50_us']:>9.2f} p50 us "
+            + f"{results[name]['p99_us']:>9.2f} p99 us"
+        )
+    config.DLQ_WRITE_TOPIC = dlq_write_topic
+    codec.use(config.JSON_CODEC)
+    reset_handlers()
+    return results
+
+
+def compare(results: dict, path: str) -> None:
+    """Сравнить с результатами предыдущего запуска"""
+    with open(path) as f:
+        previous = json.load(f)["results"]
+    print(f"\ncompare with {path}")
+    for name, result in results.items():
+        if name in previous:
+            before = previous[name]["msg_per_sec"]
+            change = (result["msg_per_sec"] - before) / before * 100
+            print(f"{name:<32} {change:>+8.1f}% msg/s")
+
+
+def package_version() -> str:
+    try:
+        return version("micro")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="файл результатов json")
+    parser.add_argument("--compare", help="файл предыдущих результатов")
+    parser.add_argument(
+        "--only", help="только бенчмарки, имя которых содержит строку"
+    )
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args(argv)
+    names = [name for name in CASES if not args.only or args.only in name]
+    results = asyncio.run(run(names, args.iterations))
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "version": package_version(),
+                    "python": platform.python_version(),
+                    "created": datetime.datetime.now().isoformat(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""Кодирование сообщений kafka в json
+
+Используется самая быстрая доступная библиотека: orjson, затем msgspec,
+иначе стандартный json. JSON_CODEC=orjson|msgspec|json задает явно.
+Библиотеки устанавливаются дополнительно: micro[orjson], micro[msgspec],
+micro[msgpack].
+
+Результат dumps побайтно совпадает со стандартным
+json.dumps(data, ensure_ascii=False, default=serialize_datetime).encode():
+datetime, date, time и timedelta через serialize_datetime, не ASCII
+символы без экранирования, ключи dict не строки приводятся к строкам.
+loads по умолчанию тоже стандартный: orjson превращает int больше
+64 бит во float, а NaN и Infinity, которые пишет json.dumps,
+orjson и msgspec не разбирают.
+Поэтому по умолчанию работает стандартный json. JSON_COMPACT=true
+включает orjson (или msgspec): сериализация orjson - то же содержимое,
+но без пробелов между элементами (NaN и Infinity пишутся как null),
+разбор - orjson или msgspec, NaN и Infinity разбираются стандартным json,
+int больше 64 бит orjson разбирает во float.
+msgspec не сериализует, так как timedelta он кодирует иначе
+(ISO 8601 duration).
+
+Двоичный формат msgpack (пакет msgpack) включается для топиков
+MSGPACK_TOPICS: сообщение получает заголовок kafka
+content-type: application/msgpack, значения те же, что в json
+(datetime и прочие через serialize_datetime).
+Consumer определяет формат по заголовку, без заголовка - по первому
+байту (json событие начинается с "{", msgpack - с маркера map),
+так что топик можно переводить на msgpack постепенно.
+"""
+
+import json
+import logging
+from datetime import datetime, date, time, timedelta
+from typing import Any
+
+import micro.config as config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover
+    msgspec = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+CONTENT_TYPE = "content-type"
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+# Заголовки kafka сообщения msgpack
+MSGPACK_HEADERS = [(CONTENT_TYPE, MSGPACK.encode())]
+# Первый байт msgpack map: fixmap, map 16, map 32
+_MSGPACK_MAP = frozenset(range(0x80, 0x90)) | {0xDE, 0xDF}
+
+
+def serialize_datetime(obj: Any) -> str | float:
+    """
+    Сериализует объекты datetime, date, time, timedelta в строки или числа.
+
+    Поддерживаемые типы:
+        - datetime.datetime → ISO формат с временем: "2025-08-11T14:30:00"
+        - datetime.date      → ISO формат даты: "2025-08-11"
+        - datetime.time      → ISO формат времени: "14:30:00"
+        - datetime.timedelta → float (секунды) ИЛИ строка в формате
+          ISO 8601 (по желанию)
+
+    Для использования с json.dumps:
+        json.dumps(data, default=serialize_datetime)
+    и как default orjson.
+
+    :param obj: Любой объект для сериализации
+    :return: Сериализованное значение (str или float)
+    :raises TypeError: Если тип не поддерживается
+    """
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    elif isinstance(obj, date):
+        return obj.isoformat()
+    elif isinstance(obj, time):
+        return obj.isoformat()
+    elif isinstance(obj, timedelta):
+        # Вариант 1: возвращаем общее количество секунд (float)
+        return obj.total_seconds()
+
+        # Альтернатива: возвращать в формате ISO 8601 (например, "PT2H30M")
+        # from isodate import duration_isoformat  # требует pip install isodate
+        # return duration_isoformat(obj)
+        #
+        # Но без внешних зависимостей можно сделать вручную:
+        # days = obj.days
+        # seconds = obj.seconds
+        # hours, remainder = divmod(seconds, 3600)
+        # minutes, seconds = divmod(remainder, 60)
+        # parts = ["P"]
+        # if days: parts.append(f"{days}D")
+        # if hours or minutes or seconds:
+        #     parts.append("T")
+        #     if hours: parts.append(f"{hours}H")
+        #     if minutes: parts.append(f"{minutes}M")
+        #     if seconds: parts.append(f"{seconds}S")
+        # return "".join(parts) if len(parts) > 1 else "PT0S"
+
+    # Раскомментируйте, если нужно пропускать None
+    # elif obj is None:
+    #     return None
+
+    raise TypeError(
+        f"Объект типа {type(obj).__name__} не поддерживается для сериализации"
+    )
+
+
+def _json_dumps(data: Any) -> bytes:
+    return json.dumps(
+        data, ensure_ascii=False, default=serialize_datetime
+    ).encode()
+
+
+def _orjson_dumps(data: Any) -> bytes:
+    try:
+        return orjson.dumps(
+            data,
+            default=serialize_datetime,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
+    except TypeError:
+        # Например int больше 64 бит
+        return _json_dumps(data)
+
+
+def _orjson_loads(data: bytes | str) -> Any:
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # NaN, Infinity; ошибку невалидного json даст json.loads
+        return json.loads(data)
+
+
+def _msgspec_loads(data: bytes | str) -> Any:
+    try:
+        return msgspec.json.decode(data)
+    except msgspec.DecodeError:
+        # NaN, Infinity, int больше 64 бит
+        return json.loads(data)
+
+
+def select(name: str = None) -> str:
+    """Выбрать библиотеку json"""
+    name = name or "auto"
+    if name == "auto":
+        if orjson:
+            return "orjson"
+        if msgspec:
+            return "msgspec"
+        return "json"
+    if name == "orjson" and not orjson or name == "msgspec" and not msgspec:
+        logger.error(f"json codec {name} is not installed, use json")
+        return "json"
+    return name
+
+
+def use(name: str = None, compact: bool = None) -> None:
+    """Установить кодирование dumps/loads
+
+    :param bool compact: сериализовать orjson без пробелов и разбирать
+        выбранной библиотекой, по умолчанию JSON_COMPACT
+    """
+    global CODEC, dumps, loads
+    CODEC = select(name)
+    if compact is None:
+        compact = config.JSON_COMPACT
+    dumps, loads = _json_dumps, json.loads
+    if not compact:
+        return
+    if CODEC == "orjson":
+        dumps, loads = _orjson_dumps, _orjson_loads
+    elif CODEC == "msgspec":
+        loads = _msgspec_loads
+
+
+# Топики MSGPACK_TOPICS, записываемые в json без пакета msgpack
+_json_fallback: set = set()
+
+
+def msgpack_dumps(data: Any) -> bytes:
+    return msgpack.packb(data, default=serialize_datetime)
+
+
+def msgpack_loads(data: bytes) -> Any:
+    return msgpack.unpackb(data, strict_map_key=False)
+
+
+def is_msgpack_topic(topic: str) -> bool:
+    """Сообщения топика пишутся в msgpack"""
+    if topic not in config.MSGPACK_TOPICS:
+        return False
+    if msgpack is None:
+        if topic not in _json_fallback:
+            _json_fallback.add(topic)
+            logger.error(f"msgpack is not installed, topic {topic} uses json")
+        return False
+    return True
+
+
+def encode(data: Any, topic: str) -> tuple:
+    """Сообщение в формате топика
+
+    :return tuple: (bytes, заголовки kafka или None)
+    """
+    if is_msgpack_topic(topic):
+        return msgpack_dumps(data), MSGPACK_HEADERS
+    return dumps(data), None
+
+
+def content_type(value: bytes, headers=None) -> str:
+    """Формат сообщения по заголовку content-type или первому байту"""
+    for name, header in headers or ():
+        if name == CONTENT_TYPE:
+            return header.decode()
+    if value and value[0] in _MSGPACK_MAP:
+        return MSGPACK
+    return JSON
+
+
+def decode(value: bytes, headers=None) -> Any:
+    """Разобрать сообщение kafka в формате по content_type()"""
+    if content_type(value, headers) == MSGPACK:
+        return msgpack_loads(value)
+    return loads(value)
+
+
+# Имя используемой библиотеки
+CODEC: str = None
+# Сериализовать в bytes
+dumps = _json_dumps
+# Разобрать bytes или str
+loads = json.loads
+
+use(config.JSON_CODEC)
@@ -80,6 +80,79 @@ KAFKA_READ_TIMEOUT_SEC = config.int("KAFKA_READ_TIMEOUT_SEC") or 60
 BATCH_TIMEOUT_SEC = config.int("BATCH_TIMEOUT_SEC") or 5
 #  Максимальные размер блока чтения из KAFKA
 BATCH_MAX_RECORDS = config.int("BATCH_MAX_RECORDS") or 5
+# Адаптивный размер блока чтения из KAFKA:
+# блок растет, пока обработка укладывается в BATCH_TARGET_SEC,
+# и уменьшается, когда обработчики замедляются
+BATCH_ADAPTIVE = config.bool("BATCH_ADAPTIVE") or False
+# Границы адаптивного размера блока
+BATCH_MIN_RECORDS = config.int("BATCH_MIN_RECORDS") or 1
+BATCH_MAX_RECORDS_LIMIT = config.int("BATCH_MAX_RECORDS_LIMIT") or 500
+# Желаемое время обработки блока, не больше доли
+# BATCH_POLL_HEADROOM от max_poll_interval_ms
+BATCH_TARGET_SEC = config.int("BATCH_TARGET_SEC") or 5
+BATCH_POLL_HEADROOM = config.float("BATCH_POLL_HEADROOM") or 0.5
+# Фиксировать смещения в фоне: смещения партиций копятся
+# и отправляются одним commit, не блокируя обработку сообщений
+COMMIT_ASYNC = config.bool("COMMIT_ASYNC") or False
+# Минимальный интервал между фоновыми commit, 0 - сразу после пакета
+COMMIT_INTERVAL_MS = config.int("COMMIT_INTERVAL_MS") or 0
+# Сколько ждать завершения обработки отзываемых партиций
+# при перебалансировке, прежде чем отдать их другому consumer
+REBALANCE_DRAIN_TIMEOUT_SEC = config.int("REBALANCE_DRAIN_TIMEOUT_SEC") or 30
+# Backpressure: выборка партиции приостанавливается, когда сообщений
+# в обработке (или их байт) больше верхней границы, и возобновляется
+# ниже нижней границы
+BACKPRESSURE_HIGH_MESSAGES = config.int("BACKPRESSURE_HIGH_MESSAGES") or 1000
+BACKPRESSURE_LOW_MESSAGES = config.int("BACKPRESSURE_LOW_MESSAGES") or 500
+BACKPRESSURE_HIGH_BYTES = config.int("BACKPRESSURE_HIGH_BYTES") or 67108864
+BACKPRESSURE_LOW_BYTES = config.int("BACKPRESSURE_LOW_BYTES") or 33554432
+# Ожидание выборки, пока партиции приостановлены backpressure:
+# возобновленная партиция читается не позже чем через это время
+BACKPRESSURE_POLL_MS = config.int("BACKPRESSURE_POLL_MS") or 100
+# Сколько партиций одного пакета обрабатывать одновременно.
+# 1 - партиции обрабатываются последовательно, одна за другой
+PARTITION_CONCURRENCY = config.int("PARTITION_CONCURRENCY") or 1
+# Сколько ключей (route key) одной партиции обрабатывать одновременно.
+# Сообщения одного ключа всегда обрабатываются по порядку.
+# 1 - сообщения партиции обрабатываются последовательно
+KEY_CONCURRENCY = config.int("KEY_CONCURRENCY") or 1
+# Отдельный consumer (lane) для каждого класса топиков:
+# SRC_TOPIC (live), LOCAL_TOPIC (local), DLQ_READ_TOPIC (dlq).
+# Lane с меньшим весом не читает, пока у lane с большим весом
+# есть очередь, но не дольше LANE_MAX_WAIT_SEC
+CONSUMER_LANES = config.bool("CONSUMER_LANES") or False
+LANE_MAX_WAIT_SEC = config.int("LANE_MAX_WAIT_SEC") or 5
+LIVE_LANE_MAX_RECORDS = (
+    config.int("LIVE_LANE_MAX_RECORDS") or BATCH_MAX_RECORDS
+)
+LIVE_LANE_CONCURRENCY = (
+    config.int("LIVE_LANE_CONCURRENCY") or PARTITION_CONCURRENCY
+)
+LIVE_LANE_WEIGHT = config.int("LIVE_LANE_WEIGHT") or 100
+LOCAL_LANE_MAX_RECORDS = (
+    config.int("LOCAL_LANE_MAX_RECORDS") or BATCH_MAX_RECORDS
+)
+LOCAL_LANE_CONCURRENCY = (
+    config.int("LOCAL_LANE_CONCURRENCY") or PARTITION_CONCURRENCY
+)
+LOCAL_LANE_WEIGHT = config.int("LOCAL_LANE_WEIGHT") or 50
+DLQ_LANE_MAX_RECORDS = config.int("DLQ_LANE_MAX_RECORDS") or BATCH_MAX_RECORDS
+DLQ_LANE_CONCURRENCY = config.int("DLQ_LANE_CONCURRENCY") or 1
+DLQ_LANE_WEIGHT = config.int("DLQ_LANE_WEIGHT") or 10
+
+# Обработка событий в CONSUMER_WORKERS процессах, 0 - в процессе FastAPI.
+# Процесс без отчета WORKER_HEARTBEAT_SEC считается неисправным,
+# упавший процесс перезапускается через WORKER_RESTART_DELAY_SEC
+CONSUMER_WORKERS = config.int("CONSUMER_WORKERS") or 0
+WORKER_HEARTBEAT_SEC = config.int("WORKER_HEARTBEAT_SEC") or 30
+WORKER_RESTART_DELAY_SEC = config.int("WORKER_RESTART_DELAY_SEC") or 5
+# Пропуск повторно пришедших событий по header.uuid:
+# None - выключен, memory - в памяти процесса, postgres - в памяти
+# и в таблице DEDUP_TABLE
+DEDUP = config.get("DEDUP", None)
+DEDUP_CACHE_SIZE = config.int("DEDUP_CACHE_SIZE") or 100000
+DEDUP_TTL_SEC = config.int("DEDUP_TTL_SEC") or 86400
+DEDUP_TABLE = config.get("DEDUP_TABLE", None) or "micro_dedup"
 
 # *************************
 #     KAFKA PRODUCER
@@ -117,6 +190,43 @@ PRODUCER_KAFKA = {
     "connections_max_idle_ms": config.int("KAFKA_CONNECTIONS_MAX_IDLE_MS")
     or 540000,
 }
+# Не ждать подтверждения каждого отправленного события: события
+# копятся в producer и уходят пакетами (linger_ms), подтверждения
+# ожидаются KafkaProducer().flush() перед фиксацией смещений consumer
+PRODUCER_PIPELINE = config.bool("PRODUCER_PIPELINE") or False
+# Exactly-once: события обработчиков и смещения партиции фиксируются
+# одной транзакцией kafka, consumer читает read_committed
+# (micro.transactions)
+KAFKA_TRANSACTIONS = config.bool("KAFKA_TRANSACTIONS") or False
+# Отправка событий через таблицу OUTBOX_TABLE (micro.outbox):
+# HeaderEvent.send пишет событие в таблицу, фоновая задача
+# отправляет пакетами по OUTBOX_BATCH_SIZE, пустую таблицу
+# проверяет раз в OUTBOX_POLL_MS
+OUTBOX = config.bool("OUTBOX") or False
+OUTBOX_TABLE = config.get("OUTBOX_TABLE", None) or "micro_outbox"
+OUTBOX_BATCH_SIZE = config.int("OUTBOX_BATCH_SIZE") or 500
+OUTBOX_POLL_MS = config.int("OUTBOX_POLL_MS") or 1000
+# На сколько экземпляр сервиса забирает пакет событий outbox, сек,
+# больше KAFKA_DELIVERY_TIMEOUT_SEC: неотправленный пакет после
+# истечения заберет другой экземпляр
+OUTBOX_LEASE_SEC = config.int("OUTBOX_LEASE_SEC") or 120
+# Объединение событий классов с coalesce_window_ms: не отправленное
+# событие заменяется более поздним с тем же coalesce_key()
+PRODUCER_COALESCE = config.bool("PRODUCER_COALESCE") or False
+# Библиотека json сообщений kafka: auto, orjson, msgspec, json
+JSON_CODEC = config.get("JSON_CODEC", None) or "auto"
+# Сериализация orjson без пробелов между элементами и разбор
+# orjson/msgspec, иначе побайтно как json.dumps(ensure_ascii=False)
+# и разбор json.loads (int больше 64 бит, NaN)
+JSON_COMPACT = config.bool("JSON_COMPACT") or False
+# Топики, сообщения в которые пишутся в msgpack (через запятую)
+MSGPACK_TOPICS = [
+    topic
+    for topic in (config.get("MSGPACK_TOPICS", None) or "").split(",")
+    if topic
+]
+# Партиций в топике kafka в памяти (адрес kafka memory://)
+MEMORY_KAFKA_PARTITIONS = config.int("MEMORY_KAFKA_PARTITIONS") or 3
 # timeout отправки сообщений в kafka
 KAFKA_DELIVERY_TIMEOUT_SEC = config.int("KAFKA_DELIVERY_TIMEOUT_SEC") or 60
 
@@ -131,6 +241,13 @@ DST_TOPIC = config.get("TOPIC", None)
 # DLQ топики для сервиса
 DLQ_WRITE_TOPIC = config.get("DLQ_WRITE_TOPIC", None)
 DLQ_READ_TOPIC = config.get("DLQ_READ_TOPIC", None)
+# Повтор сообщений DLQ: задержка перед попыткой attempt
+# DLQ_BACKOFF_SEC * 2 ** (attempt - 1), но не больше DLQ_BACKOFF_MAX_SEC,
+# после DLQ_MAX_ATTEMPTS попыток сообщение уходит в DLQ_PARKING_TOPIC
+DLQ_BACKOFF_SEC = config.int("DLQ_BACKOFF_SEC") or 10
+DLQ_BACKOFF_MAX_SEC = config.int("DLQ_BACKOFF_MAX_SEC") or 3600
+DLQ_MAX_ATTEMPTS = config.int("DLQ_MAX_ATTEMPTS") or 5
+DLQ_PARKING_TOPIC = config.get("DLQ_PARKING_TOPIC", None)
 
 # Локальный топик для сервиса
 LOCAL_TOPIC = config.get("LOCAL_TOPIC", None)
@@ -0,0 +1,125 @@
+import collections
+import logging
+import time
+
+from micro.singleton import MetaSingleton
+from micro.pg import DB
+
+import micro.config as config
+
+logger = logging.getLogger(__name__)
+
+
+class Dedup(metaclass=MetaSingleton):
+    """Обработанные события по header.uuid
+
+    Повторно пришедшее событие (после перебалансировки или повтора DLQ)
+    не разбирается и не передается обработчикам.
+    DEDUP=memory - uuid хранятся в памяти процесса, не больше
+    DEDUP_CACHE_SIZE и не дольше DEDUP_TTL_SEC.
+    DEDUP=postgres - дополнительно в таблице DEDUP_TABLE: uuid
+    пакета kafka проверяются одним запросом prefetch(),
+    новые uuid записываются одним insert в flush().
+    """
+
+    def __init__(self):
+        self.enabled: bool = config.DEDUP in ("memory", "postgres")
+        self.postgres: bool = config.DEDUP == "postgres"
+        # uuid -> время истечения, по порядку добавления
+        self.cache: collections.OrderedDict = collections.OrderedDict()
+        # uuid для записи в postgres
+        self.pending: list = []
+        self.table_ready: bool = False
+        self.purged: float = time.monotonic()
+
+    def is_seen(self, uuid: str) -> bool:
+        """Событие уже обработано, только по памяти"""
+        if not self.enabled or not uuid:
+            return False
+        expires = self.cache.get(uuid)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del self.cache[uuid]
+            return False
+        return True
+
+    def remember(self, uuid: str) -> None:
+        """Запомнить uuid в памяти"""
+        self.cache[uuid] = time.monotonic() + config.DEDUP_TTL_SEC
+        self.cache.move_to_end(uuid)
+        while len(self.cache) > config.DEDUP_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def mark(self, uuid: str) -> None:
+        """Событие обработано"""
+        if not self.enabled or not uuid:
+            return
+        self.remember(uuid)
+        if self.postgres:
+            self.pending.append(uuid)
+
+    async def create_table(self) -> None:
+        if self.table_ready:
+            return
+        await DB().execute(
+            f"""
+            create table if not exists {config.DEDUP_TABLE} (
+                uuid text primary key,
+                seen_at timestamptz not null default now()
+            )"""
+        )
+        self.table_ready = True
+
+    async def prefetch(self, uuids: list) -> None:
+        """Загрузить из postgres обработанные uuid пакета"""
+        if not self.postgres:
+            return
+        uuids = [
+            uuid for uuid in set(uuids) if uuid and not self.is_seen(uuid)
+        ]
+        if not uuids:
+            return
+        await self.create_table()
+        for row in await DB().fetchall(
+            f"""
+            select uuid from {config.DEDUP_TABLE}
+            where uuid = any(%(uuids)s)
+              and seen_at > now() - make_interval(secs => %(ttl)s)""",
+            {"uuids": uuids, "ttl": config.DEDUP_TTL_SEC},
+        ):
+            self.remember(row["uuid"])
+
+    async def flush(self) -> None:
+        """Записать в postgres обработанные uuid"""
+        if not self.pending:
+            return
+        uuids, self.pending = self.pending, []
+        try:
+            await self.create_table()
+            await DB().execute(
+                f"""
+                insert into {config.DEDUP_TABLE} (uuid)
+                select unnest(%(uuids)s::text[])
+                on conflict (uuid) do nothing""",
+                {"uuids": uuids},
+            )
+            await self.purge()
+        except Exception:
+            # Записать со следующим пакетом
+            keep = config.DEDUP_CACHE_SIZE
+            self.pending = (uuids + self.pending)[-keep:]
+            raise
+
+    async def purge(self) -> None:
+        """Удалить устаревшие uuid, не чаще раза в TTL"""
+        now = time.monotonic()
+        if now - self.purged < config.DEDUP_TTL_SEC:
+            return
+        self.purged = now
+        await DB().execute(
+            f"""
+            delete from {config.DEDUP_TABLE}
+            where seen_at < now() - make_interval(secs => %(ttl)s)""",
+            {"ttl": config.DEDUP_TTL_SEC},
+        )
@@ -0,0 +1,854 @@
+import asyncio
+import contextlib
+import datetime
+import heapq
+import itertools
+import logging
+import time
+
+from aiokafka.structs import TopicPartition
+
+import micro.config as config
+import micro.kafka_consumer as kafka_consumer
+
+from micro import codec
+from micro.kafka_producer import KafkaProducer
+from micro.dedup import Dedup
+from micro.transactions import TransactionalProducers, current_transaction
+from micro.kafka_consumer import (
+    KafkaConsumerBase,
+    capture,
+    event_message_of,
+    event_priority,
+    call_batch_handler,
+    send_dlq,
+)
+from micro.metrics import (
+    CONSUMER_PAUSED_PARTITIONS,
+    CONSUMER_INFLIGHT_MESSAGES,
+    CONSUMER_INFLIGHT_BYTES,
+    EVENTS_PARKED_CNT,
+    DLQ_DELAYED_PARTITIONS,
+    KAFKA_TRANSACTION_SECONDS,
+    KAFKA_TRANSACTION_ABORT_CNT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class OffsetWatermark:
+    """Нижняя граница обработанных смещений партиции
+
+    Сообщения могут завершаться не по порядку смещений,
+    фиксировать можно только смещение первого необработанного сообщения.
+    """
+
+    def __init__(self):
+        # Смещения в обработке, куча + необработанные {offset: байт}
+        self.pending: list = []
+        self.unfinished: dict = {}
+        # Байт в необработанных сообщениях
+        self.bytes: int = 0
+        # Смещение, следующее за последним полученным
+        self.high: int = None
+        # Последнее зафиксированное смещение
+        self.committed: int = None
+
+    def track(self, offset: int, size: int = 0) -> None:
+        """Сообщение принято в обработку"""
+        heapq.heappush(self.pending, offset)
+        self.unfinished[offset] = size
+        self.bytes += size
+        if self.high is None or offset >= self.high:
+            self.high = offset + 1
+
+    def done(self, offset: int) -> None:
+        """Сообщение обработано, повторный вызов ничего не меняет"""
+        self.bytes -= self.unfinished.pop(offset, 0)
+        while self.pending and self.pending[0] not in self.unfinished:
+            heapq.heappop(self.pending)
+
+    def inflight(self) -> int:
+        """Количество необработанных сообщений"""
+        return len(self.unfinished)
+
+    def committable(self) -> int | None:
+        """Смещение, до которого все сообщения обработаны"""
+        return self.pending[0] if self.pending else self.high
+
+
+class BatchCollector:
+    """Накопление событий для batch обработчиков
+
+    События копятся по обработчикам между пакетами kafka,
+    пакет передается обработчику при достижении max_size
+    или по истечении max_wait_ms от первого события пакета.
+    Пока событие в пакете, его смещение остается необработанным.
+    """
+
+    def __init__(self, dispatcher: "Dispatcher"):
+        self.dispatcher = dispatcher
+        # BatchHandler -> [(obj, message, event_message)]
+        self.items: dict = {}
+        # BatchHandler -> время первого события пакета
+        self.started: dict = {}
+        # (tp, offset) -> число пакетов, ожидающих обработки сообщения
+        self.waiting: dict = {}
+
+    def holds(self, tp, offset: int) -> bool:
+        """Сообщение ожидает обработки в пакете"""
+        return (tp, offset) in self.waiting
+
+    async def add(self, batch_handler, obj, message, event_message) -> None:
+        """Добавить объект события в пакет обработчика"""
+        tp = TopicPartition(message.topic, message.partition)
+        key = (tp, message.offset)
+        event_message.batched = True
+        self.waiting[key] = self.waiting.get(key, 0) + 1
+        items = self.items.setdefault(batch_handler, [])
+        if not items:
+            self.started[batch_handler] = time.monotonic()
+        items.append((obj, message, event_message))
+
+    def wait_ms(self) -> int | None:
+        """Время до истечения ожидания ближайшего пакета"""
+        now = time.monotonic()
+        waits = [
+            max(0, int((started - now) * 1000) + batch_handler.max_wait_ms)
+            for batch_handler, started in self.started.items()
+        ]
+        return min(waits) if waits else None
+
+    async def flush(self, batch_handler) -> None:
+        """Передать обработчику накопленный пакет, не больше max_size
+        событий, остальные остаются следующему пакету"""
+        items = self.items.pop(batch_handler, [])
+        started = self.started.pop(batch_handler, None)
+        if not items:
+            return
+        if len(items) > batch_handler.max_size:
+            self.items[batch_handler] = items[batch_handler.max_size:]
+            self.started[batch_handler] = started
+            items = items[: batch_handler.max_size]
+        failures = await call_batch_handler(
+            batch_handler, [obj for obj, _, _ in items]
+        )
+        # Необработанные объекты отправить в DLQ
+        for index, error in failures.items():
+            if not config.DLQ_WRITE_TOPIC:
+                if isinstance(error, Exception):
+                    raise error
+                raise Exception(error)
+            _, _, event_message = items[index]
+            await send_dlq(event_message.as_dict(), error)
+        # Отметить сообщения обработанными
+        partitions = set()
+        for index, (_, message, event_message) in enumerate(items):
+            if index not in failures:
+                Dedup().mark(event_message.uuid())
+            tp = TopicPartition(message.topic, message.partition)
+            key = (tp, message.offset)
+            self.waiting[key] -= 1
+            if self.waiting[key] <= 0:
+                del self.waiting[key]
+                watermark = self.dispatcher.watermarks.get(tp)
+                if watermark:
+                    watermark.done(message.offset)
+                    partitions.add(tp)
+        for tp in partitions:
+            await self.dispatcher.commit(tp)
+        self.dispatcher.backpressure()
+
+    async def flush_partitions(self, partitions) -> None:
+        """Передать обработчикам пакеты с событиями партиций"""
+        partitions = set(partitions)
+        for batch_handler, items in list(self.items.items()):
+            if any(
+                TopicPartition(message.topic, message.partition) in partitions
+                for _, message, _ in items
+            ):
+                while batch_handler in self.items:
+                    await self.flush(batch_handler)
+
+    async def flush_full(self) -> None:
+        """Передать обработчикам заполненные пакеты"""
+        for batch_handler in list(self.items):
+            while (
+                len(self.items.get(batch_handler, ()))
+                >= batch_handler.max_size
+            ):
+                await self.flush(batch_handler)
+
+    async def flush_due(self, force: bool = False) -> None:
+        """Передать обработчикам пакеты с истекшим ожиданием
+
+        :param bool force: передать все пакеты
+        """
+        now = time.monotonic()
+        for batch_handler, started in list(self.started.items()):
+            if force or (now - started) * 1000 >= batch_handler.max_wait_ms:
+                while batch_handler in self.started:
+                    await self.flush(batch_handler)
+
+
+class DlqRedrive:
+    """Повтор сообщений DLQ с экспоненциальной задержкой
+
+    Сообщение DLQ обрабатывается не раньше error_at + backoff(attempt).
+    Если первое сообщение партиции DLQ еще рано обрабатывать,
+    партиция приостанавливается и перематывается на него,
+    и возобновляется по наступлении времени повтора.
+    Остальные партиции при этом читаются как обычно.
+    После DLQ_MAX_ATTEMPTS попыток сообщение отправляется
+    в DLQ_PARKING_TOPIC и больше не повторяется.
+    """
+
+    def __init__(self, dispatcher: "Dispatcher"):
+        self.dispatcher = dispatcher
+        # Куча (время повтора, tp) приостановленных партиций
+        self.delayed: list = []
+        # tp -> время повтора
+        self.waiting: dict = {}
+        # Разобранные admit() сообщения:
+        # (tp, offset) -> (попытка, время повтора)
+        self.states: dict = {}
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """Задержка перед повтором, сек"""
+        return min(
+            config.DLQ_BACKOFF_SEC * 2 ** max(attempt - 1, 0),
+            config.DLQ_BACKOFF_MAX_SEC,
+        )
+
+    @staticmethod
+    def is_dlq(message) -> bool:
+        return bool(config.DLQ_READ_TOPIC) and (
+            message.topic == config.DLQ_READ_TOPIC
+        )
+
+    def state(self, message) -> tuple:
+        """Номер попытки и время повтора сообщения DLQ, unix time
+
+        Результат admit() запоминается для exhausted() в run_lane,
+        сообщение разбирается один раз. Сообщение без разбираемых
+        attempt и error_at повторяется сразу.
+        """
+        tp = TopicPartition(message.topic, message.partition)
+        state = self.states.pop((tp, message.offset), None)
+        if state is not None:
+            return state
+        try:
+            value = codec.decode(message.value, message.headers)
+        except ValueError:
+            return 0, 0
+        if not isinstance(value, dict):
+            return 0, 0
+        attempt = value.get("attempt", 0)
+        if not isinstance(attempt, int):
+            attempt = 0
+        error_at = value.get("error_at", None)
+        if not error_at:
+            return attempt, 0
+        try:
+            due = datetime.datetime.fromisoformat(error_at).timestamp()
+        except (TypeError, ValueError, OverflowError):
+            logger.warning(
+                f"dlq message {message.topic}:{message.partition}:"
+                + f"{message.offset} has invalid error_at {error_at!r}"
+            )
+            return attempt, 0
+        return attempt, due + self.backoff(attempt)
+
+    def exhausted(self, message) -> bool:
+        """Попытки обработки сообщения DLQ исчерпаны"""
+        if not self.is_dlq(message):
+            return False
+        attempt, _ = self.state(message)
+        return attempt >= config.DLQ_MAX_ATTEMPTS
+
+    async def park(self, message) -> None:
+        """Отправить сообщение с исчерпанными попытками в DLQ_PARKING_TOPIC"""
+        EVENTS_PARKED_CNT.inc()
+        if config.DLQ_PARKING_TOPIC:
+            await KafkaProducer().send_kafka_topic(
+                topic=config.DLQ_PARKING_TOPIC,
+                key=None,
+                data=codec.decode(message.value, message.headers),
+            )
+            logger.info(
+                f"parked message {message.topic}:{message.partition}:"
+                + f"{message.offset} to {config.DLQ_PARKING_TOPIC}"
+            )
+        else:
+            logger.error(
+                f"dropped message {message.topic}:{message.partition}:"
+                + f"{message.offset}, attempts exhausted"
+            )
+
+    def admit(self, tp, messages: list) -> list:
+        """Сообщения партиции, которые пора обрабатывать
+
+        Сообщения с первого не готового к повтору отбрасываются,
+        партиция перематывается на него и приостанавливается.
+        """
+        if not messages or not self.is_dlq(messages[0]):
+            return messages
+        now = time.time()
+        for index, message in enumerate(messages):
+            attempt, due = self.state(message)
+            if attempt < config.DLQ_MAX_ATTEMPTS and due > now:
+                self.delay(tp, message.offset, due)
+                return messages[:index]
+            self.states[(tp, message.offset)] = (attempt, due)
+        return messages
+
+    def delay(self, tp, offset: int, due: float) -> None:
+        """Приостановить партицию до времени повтора"""
+        logger.info(
+            f"dlq partition {tp.topic}:{tp.partition} delayed "
+            + f"at offset {offset} for {due - time.time():.1f}s"
+        )
+        consumer = self.dispatcher.consumer
+        consumer.pause([tp])
+        consumer.seek(tp, offset)
+        self.dispatcher.rewind(tp)
+        self.waiting[tp] = due
+        heapq.heappush(self.delayed, (due, tp))
+        DLQ_DELAYED_PARTITIONS.set(len(self.waiting))
+
+    def resume_due(self) -> None:
+        """Возобновить партиции, время повтора которых наступило"""
+        now = time.time()
+        resume = []
+        while self.delayed and self.delayed[0][0] <= now:
+            due, tp = heapq.heappop(self.delayed)
+            if self.waiting.get(tp) == due:
+                del self.waiting[tp]
+                # Партицию мог приостановить и backpressure
+                if tp not in self.dispatcher.paused:
+                    resume.append(tp)
+        if resume:
+            self.dispatcher.consumer.resume(resume)
+        DLQ_DELAYED_PARTITIONS.set(len(self.waiting))
+
+    def wait_ms(self) -> int | None:
+        """Время до ближайшего повтора"""
+        while self.delayed and (
+            self.waiting.get(self.delayed[0][1]) != self.delayed[0][0]
+        ):
+            heapq.heappop(self.delayed)
+        if not self.delayed:
+            return None
+        return max(0, int((self.delayed[0][0] - time.time()) * 1000))
+
+    def release(self, revoked) -> None:
+        for tp in revoked:
+            self.waiting.pop(tp, None)
+            for key in [key for key in self.states if key[0] == tp]:
+                del self.states[key]
+        DLQ_DELAYED_PARTITIONS.set(len(self.waiting))
+
+
+class PartitionSlots:
+    """Места обработки партиций (PARTITION_CONCURRENCY)
+
+    Как asyncio.Semaphore, но освободившееся место получает ожидающий
+    с наибольшим приоритетом, при равном - ожидающий дольше.
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        # Куча ожидающих: (-приоритет, номер, asyncio.Future)
+        self.waiters: list = []
+        self.counter = itertools.count()
+
+    async def acquire(self, priority: int = 0) -> None:
+        if self.value > 0 and not self.waiters:
+            self.value -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (-priority, next(self.counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Место получено одновременно с отменой
+                self.release()
+            raise
+
+    def release(self) -> None:
+        while self.waiters:
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.value += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = 0):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class Dispatcher:
+    """Обработка пакета сообщений, полученного из kafka через getmany()
+
+    Каждая партиция пакета обрабатывается своей задачей,
+    одновременно не более concurrency (PARTITION_CONCURRENCY) партиций,
+    место первой получает партиция с событиями большего priority
+    (event_handler).
+    Внутри партиции сообщения раскладываются по очередям ключей,
+    очереди разных ключей обрабатываются параллельно
+    (не более KEY_CONCURRENCY), сообщения одного ключа - по порядку.
+    Смещение партиции фиксируется до первого необработанного сообщения.
+    События batch обработчиков копятся в BatchCollector.
+    Сообщения DLQ повторяются с задержкой через DlqRedrive.
+    Цикл сервиса обрабатывает пакеты задачами и продолжает выборку:
+    пакеты одной партиции ждут друг друга (enqueue), сообщения
+    в обработке и в очереди учитывает backpressure.
+    При KAFKA_TRANSACTIONS сообщения партиции пакета обрабатываются
+    в транзакции kafka (micro.transactions).
+    """
+
+    def __init__(
+        self,
+        consumer: KafkaConsumerBase,
+        events=None,
+        concurrency: int = None,
+    ):
+        self.consumer = consumer
+        self.events = events
+        # Сколько партиций обрабатывать одновременно
+        self.concurrency = concurrency or config.PARTITION_CONCURRENCY
+        self.partitions = PartitionSlots(self.concurrency)
+        self.watermarks: dict = {}
+        self.batches = BatchCollector(self)
+        self.redrive = DlqRedrive(self)
+        # Партиции без сообщений в обработке, tp -> asyncio.Event
+        self.idle: dict = {}
+        # Отозванные партиции, их сообщения больше не обрабатываются
+        self.revoked: set = set()
+        # Партиции с открытой транзакцией kafka, их смещения
+        # фиксируются только в транзакции
+        self.transactions: set = set()
+        # Разобранные prefetch сообщения пакета: (tp, offset) -> EventMessage
+        self.peeked: dict = {}
+        # Сообщения пакетов, ожидающие очереди партиции:
+        # tp -> [сообщений, байт]
+        self.queued: dict = {}
+        # Завершение последнего принятого пакета партиции,
+        # tp -> asyncio.Future: пакеты партиции обрабатываются по порядку
+        self.turns: dict = {}
+        # Номер позиции чтения партиции, меняется при seek
+        # и назначении: пакеты, прочитанные до этого, не обрабатываются
+        self.epochs: dict = {}
+        # Партиции, приостановленные backpressure
+        self.paused: set = set()
+
+    def backpressure(self) -> None:
+        """Приостановить выборку партиций с большим количеством
+        необработанных сообщений, возобновить разгруженные"""
+        inflight, inflight_bytes = 0, 0
+        pause, resume = [], []
+        for tp, watermark in self.watermarks.items():
+            # В обработке и в очереди партиции
+            queued_count, queued_size = self.queued.get(tp, (0, 0))
+            count = watermark.inflight() + queued_count
+            size = watermark.bytes + queued_size
+            inflight += count
+            inflight_bytes += size
+            if tp not in self.paused:
+                if (
+                    count > config.BACKPRESSURE_HIGH_MESSAGES
+                    or size > config.BACKPRESSURE_HIGH_BYTES
+                ):
+                    pause.append(tp)
+            elif tp not in self.redrive.waiting and (
+                count <= config.BACKPRESSURE_LOW_MESSAGES
+                and size <= config.BACKPRESSURE_LOW_BYTES
+            ):
+                resume.append(tp)
+        if pause:
+            logger.info(f"backpressure pause partitions: {sorted(pause)}")
+            self.consumer.pause(pause)
+            self.paused.update(pause)
+        if resume:
+            logger.info(f"backpressure resume partitions: {sorted(resume)}")
+            self.consumer.resume(resume)
+            self.paused.difference_update(resume)
+        CONSUMER_PAUSED_PARTITIONS.set(len(self.paused))
+        CONSUMER_INFLIGHT_MESSAGES.set(inflight)
+        CONSUMER_INFLIGHT_BYTES.set(inflight_bytes)
+
+    def assign(self, assigned) -> None:
+        """Подготовить состояние назначенных партиций"""
+        for tp in assigned:
+            self.revoked.discard(tp)
+            self.rewind(tp)
+            self.watermark(tp)
+            self.idle.setdefault(tp, asyncio.Event()).set()
+
+    async def revoke(self, revoked) -> None:
+        """Дождаться обработки сообщений отзываемых партиций,
+        не дольше REBALANCE_DRAIN_TIMEOUT_SEC,
+        и зафиксировать их смещения"""
+        revoked = set(revoked)
+        self.revoked |= revoked
+        busy = [
+            self.idle[tp].wait()
+            for tp in revoked
+            if tp in self.idle and not self.idle[tp].is_set()
+        ]
+        if busy:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*busy),
+                    timeout=config.REBALANCE_DRAIN_TIMEOUT_SEC,
+                )
+            except TimeoutError:
+                logger.error(
+                    f"partitions {sorted(revoked)} not drained "
+                    + f"in {config.REBALANCE_DRAIN_TIMEOUT_SEC}s"
+                )
+        # Накопленные события отзываемых партиций
+        await self.batches.flush_partitions(revoked)
+        for tp in revoked:
+            await self.commit(tp)
+        if config.KAFKA_TRANSACTIONS:
+            await TransactionalProducers().close(revoked)
+
+    def release(self, revoked) -> None:
+        """Освободить состояние отозванных партиций"""
+        for tp in revoked:
+            self.watermarks.pop(tp, None)
+            self.idle.pop(tp, None)
+            self.paused.discard(tp)
+            self.queued.pop(tp, None)
+            for key in [key for key in self.peeked if key[0] == tp]:
+                del self.peeked[key]
+        self.redrive.release(revoked)
+
+    def rewind(self, tp) -> None:
+        """Позиция чтения партиции изменена, принятые ранее пакеты
+        партиции не обрабатываются, их сообщения будут прочитаны снова"""
+        self.epochs[tp] = self.epochs.get(tp, 0) + 1
+
+    def enqueue(self, batches: dict) -> dict:
+        """Принять пакет в очереди партиций
+
+        Вызывается до первого await обработки пакета, поэтому
+        пакеты партиции обрабатываются в порядке получения.
+        :return dict: tp -> (завершение предыдущего пакета партиции,
+            завершение этого пакета, позиция чтения)
+        """
+        loop = asyncio.get_running_loop()
+        turns = {}
+        for tp, messages in batches.items():
+            queued = self.queued.setdefault(tp, [0, 0])
+            queued[0] += len(messages)
+            queued[1] += sum(len(message.value or b"") for message in messages)
+            self.watermark(tp)
+            turn = loop.create_future()
+            turns[tp] = (self.turns.get(tp), turn, self.epochs.get(tp, 0))
+            self.turns[tp] = turn
+        return turns
+
+    def dequeue(self, tp, messages: list) -> None:
+        """Пакет партиции вышел из очереди"""
+        queued = self.queued.get(tp)
+        if queued:
+            queued[0] -= len(messages)
+            queued[1] -= sum(len(message.value or b"") for message in messages)
+            if queued[0] <= 0:
+                del self.queued[tp]
+
+    def priority(self, tp, messages: list) -> int:
+        """Приоритет сообщений партиции: наибольший priority их событий
+
+        Разобранные сообщения запоминаются в peeked для capture().
+        """
+        if not kafka_consumer.prioritized_events:
+            return 0
+        priority = 0
+        for message in messages:
+            key = (tp, message.offset)
+            event_message = self.peeked.get(key)
+            if event_message is None:
+                event_message = self.peeked[key] = event_message_of(message)
+            try:
+                event_name = event_message.event_name()
+            except ValueError:
+                # Ошибку разбора обработает capture()
+                continue
+            priority = max(priority, event_priority(event_name))
+        return priority
+
+    def poll_timeout_ms(self) -> int | None:
+        """Время ожидания следующего пакета kafka,
+        не дольше ожидания накопленных пакетов событий,
+        повторов DLQ и возобновления партиций backpressure"""
+        waits = [
+            wait
+            for wait in (self.batches.wait_ms(), self.redrive.wait_ms())
+            if wait is not None
+        ]
+        if self.paused:
+            waits.append(config.BACKPRESSURE_POLL_MS)
+        return min(waits) if waits else None
+
+    def watermark(self, tp) -> OffsetWatermark:
+        """Получить нижнюю границу смещений партиции, если нет то создать"""
+        if tp not in self.watermarks:
+            self.watermarks[tp] = OffsetWatermark()
+        return self.watermarks[tp]
+
+    async def commit(self, tp) -> None:
+        """Зафиксировать смещение партиции по нижней границе"""
+        if tp in self.transactions:
+            # Смещение отправит транзакция партиции
+            return
+        watermark = self.watermarks.get(tp)
+        if watermark:
+            offset = watermark.committable()
+            if offset is not None and (
+                watermark.committed is None or offset > watermark.committed
+            ):
+                watermark.committed = offset
+                try:
+                    # uuid обработанных событий раньше смещений
+                    await Dedup().flush()
+                except Exception as e:
+                    logger.error(f"dedup flush failed {e}")
+                await self.consumer.partition_commit(tp, offset)
+
+    async def run_transaction(
+        self, tp, watermark: OffsetWatermark, messages: list
+    ) -> None:
+        """Обработать сообщения партиции в транзакции kafka:
+        отправленные события и смещение фиксируются вместе"""
+        started = time.monotonic()
+        producer = await TransactionalProducers().producer(tp)
+        await producer.begin_transaction()
+        token = current_transaction.set(producer)
+        self.transactions.add(tp)
+        try:
+            if config.KEY_CONCURRENCY > 1:
+                await self.run_lanes(watermark, messages)
+            else:
+                await self.run_lane(watermark, messages)
+            offset = watermark.committable()
+            if offset is not None and (
+                watermark.committed is None or offset > watermark.committed
+            ):
+                try:
+                    await Dedup().flush()
+                except Exception as e:
+                    logger.error(f"dedup flush failed {e}")
+                await producer.send_offsets_to_transaction(
+                    {tp: offset}, TransactionalProducers.group_id()
+                )
+            else:
+                offset = None
+            await producer.commit_transaction()
+        except BaseException:
+            # Сообщения партиции будут прочитаны повторно
+            KAFKA_TRANSACTION_ABORT_CNT.inc()
+            try:
+                await producer.abort_transaction()
+            except Exception as e:
+                logger.error(f"abort transaction {tp} failed {e}")
+                await TransactionalProducers().close([tp])
+            raise
+        finally:
+            current_transaction.reset(token)
+            self.transactions.discard(tp)
+        if offset is not None:
+            watermark.committed = offset
+        KAFKA_TRANSACTION_SECONDS.observe(time.monotonic() - started)
+        # Пакетные обработчики вызываются вне транзакции,
+        # их смещения фиксирует consumer после обработки
+        await self.batches.flush_full()
+
+    async def run_lane(self, watermark: OffsetWatermark, messages: list):
+        """Обработать сообщения по порядку"""
+        for message in messages:
+            tp = TopicPartition(message.topic, message.partition)
+            if tp in self.revoked:
+                # Партиция передана другому consumer
+                return
+            if self.redrive.exhausted(message):
+                await self.redrive.park(message)
+                watermark.done(message.offset)
+                continue
+            await capture(
+                message=message,
+                events=self.events,
+                batch=self.batches.add,
+                event_message=self.peeked.pop(
+                    (tp, message.offset), None
+                ),
+            )
+            if self.batches.holds(tp, message.offset):
+                # В транзакции пакеты передаются после ее фиксации
+                if current_transaction.get() is None:
+                    await self.batches.flush_full()
+            else:
+                watermark.done(message.offset)
+
+    async def run_lanes(self, watermark: OffsetWatermark, messages: list):
+        """Обработать очереди ключей партиции пулом обработчиков"""
+        lanes: dict = {}
+        for message in messages:
+            lanes.setdefault(message.key, []).append(message)
+        if len(lanes) == 1:
+            await self.run_lane(watermark, messages)
+            return
+        workers = asyncio.Semaphore(config.KEY_CONCURRENCY)
+
+        async def worker(lane: list):
+            async with workers:
+                await self.run_lane(watermark, lane)
+
+        async with asyncio.TaskGroup() as tg:
+            for lane in lanes.values():
+                tg.create_task(worker(lane))
+
+    async def run_partition(self, tp, messages: list, turn=None) -> None:
+        """Обработать сообщения одной партиции и зафиксировать смещение
+
+        :param tuple turn: очередь партиции из enqueue()
+        """
+        if turn is None:
+            await self.process_partition(tp, messages)
+            return
+        previous, done, epoch = turn
+        queued = True
+        try:
+            if previous is not None:
+                # Дождаться предыдущего пакета партиции, не отменяя его
+                await asyncio.wait([previous])
+            self.dequeue(tp, messages)
+            queued = False
+            if epoch != self.epochs.get(tp, 0):
+                # Прочитано до seek или до повторного назначения
+                return
+            await self.process_partition(tp, messages)
+        finally:
+            if queued:
+                self.dequeue(tp, messages)
+            self.finish_turn(tp, done)
+
+    def finish_turn(self, tp, done: asyncio.Future) -> None:
+        """Следующий пакет партиции может обрабатываться"""
+        if not done.done():
+            done.set_result(None)
+        if self.turns.get(tp) is done:
+            del self.turns[tp]
+
+    async def process_partition(self, tp, messages: list) -> None:
+        """Обработать сообщения партиции после предыдущих пакетов"""
+        if tp in self.revoked:
+            return
+        # Сообщения DLQ, время повтора которых наступило
+        messages = self.redrive.admit(tp, messages)
+        if not messages:
+            return
+        watermark = self.watermark(tp)
+        for message in messages:
+            watermark.track(message.offset, len(message.value or b""))
+        idle = self.idle.setdefault(tp, asyncio.Event())
+        idle.clear()
+        try:
+            async with self.partitions.slot(self.priority(tp, messages)):
+                if config.KAFKA_TRANSACTIONS:
+                    await self.run_transaction(tp, watermark, messages)
+                    return
+                try:
+                    if config.KEY_CONCURRENCY > 1:
+                        await self.run_lanes(watermark, messages)
+                    else:
+                        await self.run_lane(watermark, messages)
+                except Exception:
+                    # Зафиксировать обработанное начало партиции,
+                    # остальное будет прочитано повторно
+                    await self.commit(tp)
+                    raise
+                await self.commit(tp)
+        finally:
+            idle.set()
+
+    async def prefetch(self, batches: dict) -> None:
+        """Проверить uuid событий пакета одним запросом
+
+        Разобранные сообщения запоминаются в peeked и передаются
+        в capture(), заголовок не разбирается повторно.
+        """
+        dedup = Dedup()
+        if not dedup.postgres or not batches:
+            return
+        uuids = []
+        for tp, messages in batches.items():
+            for message in messages:
+                event_message = event_message_of(message)
+                self.peeked[(tp, message.offset)] = event_message
+                try:
+                    uuids.append(event_message.uuid())
+                except ValueError:
+                    pass
+        try:
+            await dedup.prefetch(uuids)
+        except Exception as e:
+            logger.error(f"dedup prefetch failed {e}")
+
+    async def run_partitions(self, batches: dict, turns: dict) -> None:
+        """Обработать сообщения партиций пакета"""
+        if self.concurrency > 1 and len(batches) > 1:
+            # Партиции параллельно, выход из группы после обработки всех,
+            # ошибка в любой партиции отменяет остальные
+            async with asyncio.TaskGroup() as tg:
+                for tp, messages in batches.items():
+                    tg.create_task(
+                        self.run_partition(tp, messages, turns[tp]),
+                        name=f"partition {tp.topic}:{tp.partition}",
+                    )
+        else:
+            # Партиции с большим приоритетом первыми
+            order = sorted(
+                batches, key=lambda tp: -self.priority(tp, batches[tp])
+            )
+            for tp in order:
+                await self.run_partition(tp, batches[tp], turns[tp])
+
+    async def run_batch(self, result: dict) -> None:
+        """Обработать пакет сообщений {TopicPartition: [messages]}
+
+        Пакеты можно обрабатывать одновременно (задачами, пока
+        выбираются следующие): пакеты одной партиции обрабатываются
+        по порядку получения, сообщения в очереди учитываются
+        backpressure.
+        """
+        batches = {tp: messages for tp, messages in result.items() if messages}
+        turns = self.enqueue(batches)
+        self.backpressure()
+        try:
+            await self.prefetch(batches)
+            await self.run_partitions(batches, turns)
+        finally:
+            for tp, messages in batches.items():
+                # Партиции, до которых не дошла обработка после ошибки
+                _, done, _ = turns[tp]
+                if not done.done():
+                    self.dequeue(tp, messages)
+                    self.finish_turn(tp, done)
+                # Не обработанные сообщения будут прочитаны заново
+                for message in messages:
+                    self.peeked.pop((tp, message.offset), None)
+                    self.redrive.states.pop((tp, message.offset), None)
+        # Пакеты событий с истекшим ожиданием
+        await self.batches.flush_due()
+        self.backpressure()
+        self.redrive.resume_due()
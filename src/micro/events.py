@@ -1,5 +1,6 @@
 import logging
 import re
+import functools
 
 from types import FunctionType
 from micro.logging_trace import TRACE
@@ -7,6 +8,7 @@ from micro.logging_trace import TRACE
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=1024)
 def get_event_name(name: str) -> str:
     """Преобразовать имя события типа
     CamelCaseName в camel_case_name
@@ -21,36 +23,58 @@ def get_event_name(name: str) -> str:
 
 class Events:
 
+    # Функции-обработчики класса
+    _functions: tuple = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._functions = tuple(
+            (name, func)
+            for name, func in cls.__dict__.items()
+            if type(func) is FunctionType
+        )
+
+    @classmethod
+    @functools.lru_cache(maxsize=1024)
+    def routes(cls, event_name: str) -> tuple:
+        """Функции-обработчики события (name, func), с кэшированием
+
+        Имена событий приходят извне, кэш ограничен, как у get_event_name.
+        """
+        prefix = get_event_name(event_name) + "_"
+        return tuple(
+            (name, func)
+            for name, func in cls._functions
+            if prefix.startswith(f"{name}_")
+        )
+
     @classmethod
     async def do(cls, js):
         event_name = js.get("event", None)
         if event_name:
-            for name, func in cls.__dict__.items():
-                if type(func) is FunctionType and (
-                    get_event_name(event_name) + "_"
-                ).startswith(f"{name}_"):
-                    # Пришло новое сообщение
-                    trace_id = js.get("trace_id")
-                    if trace_id:
-                        TRACE().set(trace_id)
-                    else:
-                        TRACE().new()
-                    event_split = event_name.split(".")
-                    # Кратко распечатать 200 символов json
-                    js_example = {
-                        key: value
-                        for key, value in js.items()
-                        if key != "event"
-                    }
-                    sjs = f"{js_example}"[0:200]
-                    logger.info(
-                        f'arrived message "{event_name}/{trace_id}" '
-                        + f'to func: "{name}" : "{sjs}"'
-                    )
-                    await func(
-                        [
-                            event_split[i] if i < len(event_split) else ""
-                            for i in range(0, 10)
-                        ],
-                        js,
-                    )
+            for name, func in cls.routes(event_name):
+                # Пришло новое сообщение
+                trace_id = js.get("trace_id")
+                if trace_id:
+                    TRACE().set(trace_id)
+                else:
+                    TRACE().new()
+                event_split = event_name.split(".")
+                # Кратко распечатать 200 символов json
+                js_example = {
+                    key: value
+                    for key, value in js.items()
+                    if key != "event"
+                }
+                sjs = f"{js_example}"[0:200]
+                logger.info(
+                    f'arrived message "{event_name}/{trace_id}" '
+                    + f'to func: "{name}" : "{sjs}"'
+                )
+                await func(
+                    [
+                        event_split[i] if i < len(event_split) else ""
+                        for i in range(0, 10)
+                    ],
+                    js,
+                )
@@ -1,10 +1,16 @@
 import logging
-import json
+import re
+import functools
+import time
 import datetime
 import traceback
 import asyncio
+import contextlib
+from typing import Callable, NamedTuple
+from typing_extensions import TypedDict
 
-from aiokafka import AIOKafkaConsumer
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from pydantic import TypeAdapter, ValidationError
 
 from micro.singleton import MetaSingleton
 
@@ -13,20 +19,238 @@ import micro.config as config
 from micro.schemes import Schema
 from micro.logging_trace import TRACE
 
-from micro.kafka_producer import KafkaProducer
+from micro.kafka_producer import KafkaProducer, KafkaDeliveryError
+from micro.dedup import Dedup
+from micro import codec
+from micro.memory_kafka import MemoryConsumer, is_memory
 
-from .metrics import DO_EVENTS_CNT, WORKED_EVENTS_CNT, EVENTS_SENT_DLQ_CNT
+from .metrics import (
+    DO_EVENTS_CNT,
+    WORKED_EVENTS_CNT,
+    EVENTS_SENT_DLQ_CNT,
+    EVENTS_DUPLICATE_CNT,
+    CONSUMER_BATCH_MAX_RECORDS,
+    CONSUMER_BATCH_HANDLER_SECONDS,
+    CONSUMER_COMMIT_SECONDS,
+    CONSUMER_COMMIT_ERROR_CNT,
+    CONSUMER_LANE_LAG,
+    CONSUMER_LANE_MESSAGES_CNT,
+    EVENT_HANDLER_INFLIGHT,
+    EVENT_HANDLER_TIMEOUT_CNT,
+    EVENT_HANDLER_SECONDS,
+)
 
 logger = logging.getLogger(__name__)
 
 
-class KafkaConsumer(metaclass=MetaSingleton):
+class AdaptiveBatch:
+    """Адаптивный размер блока чтения из kafka
+
+    Размер блока удваивается, пока блок приходит полным
+    и обработка укладывается в желаемое время, и уменьшается,
+    когда обработка блока выходит за желаемое время.
+    Желаемое время - BATCH_TARGET_SEC, но не больше доли
+    BATCH_POLL_HEADROOM от max_poll_interval_ms, чтобы consumer
+    не был исключен из группы.
+    """
+
+    def __init__(self, max_records: int = None):
+        self.max_records: int = max_records or config.BATCH_MAX_RECORDS
+        # Сглаженное время обработки одного сообщения, сек
+        self.latency: float = None
+        CONSUMER_BATCH_MAX_RECORDS.set(self.max_records)
+
+    def target_sec(self) -> float:
+        """Желаемое время обработки блока"""
+        poll_interval_sec = (
+            config.CONSUMER_KAFKA["max_poll_interval_ms"] / 1000
+        ) * config.BATCH_POLL_HEADROOM
+        return min(config.BATCH_TARGET_SEC, poll_interval_sec)
+
+    def observe(self, count: int, elapsed: float) -> None:
+        """Учесть время обработки блока
+
+        :param int count: количество сообщений в блоке
+        :param float elapsed: время обработки блока, сек
+        """
+        CONSUMER_BATCH_HANDLER_SECONDS.set(elapsed)
+        if not config.BATCH_ADAPTIVE or not count:
+            return
+        latency = elapsed / count
+        self.latency = (
+            latency
+            if self.latency is None
+            else 0.3 * latency + 0.7 * self.latency
+        )
+        target = self.target_sec()
+        # Сколько сообщений укладывается в желаемое время
+        fits = int(target / self.latency) if self.latency else None
+        if elapsed > target:
+            # Обработчики замедлились, уменьшить блок
+            size = self.max_records // 2
+            if fits is not None:
+                size = min(size, fits)
+        elif count >= self.max_records:
+            # Блок полный и есть запас по времени, увеличить блок
+            size = self.max_records * 2
+            if fits is not None:
+                size = min(size, max(fits, self.max_records))
+        else:
+            size = self.max_records
+        self.max_records = max(
+            config.BATCH_MIN_RECORDS,
+            min(config.BATCH_MAX_RECORDS_LIMIT, size),
+        )
+        CONSUMER_BATCH_MAX_RECORDS.set(self.max_records)
+
+
+class OffsetCommitter:
+    """Фоновая фиксация смещений
+
+    Смещения партиций копятся в одну карту {tp: offset}
+    и фиксируются одним commit фоновой задачей run().
+    flush() - принудительная фиксация, при отзыве партиций
+    и остановке сервиса.
+    """
+
+    def __init__(self, kafka_consumer: "KafkaConsumerBase"):
+        self.kafka_consumer = kafka_consumer
+        self.offsets: dict = {}
+        self.staged = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    def stage(self, tp, offset: int) -> None:
+        """Добавить смещение партиции к следующему commit"""
+        if offset > self.offsets.get(tp, -1):
+            self.offsets[tp] = offset
+        self.staged.set()
+
+    def restage(self, offsets: dict) -> None:
+        """Вернуть не зафиксированные смещения назначенных партиций"""
+        assigned = self.kafka_consumer.assignment()
+        for tp, offset in offsets.items():
+            if tp in assigned and offset > self.offsets.get(tp, -1):
+                self.offsets[tp] = offset
+
+    async def flush(self, partitions=None) -> None:
+        """Зафиксировать накопленные смещения
+
+        :param partitions: только эти партиции, по умолчанию все
+        """
+        async with self.lock:
+            if partitions is None:
+                offsets, self.offsets = self.offsets, {}
+            else:
+                offsets = {
+                    tp: self.offsets.pop(tp)
+                    for tp in partitions
+                    if tp in self.offsets
+                }
+            if not offsets or not self.kafka_consumer.consumer:
+                return
+            try:
+                await self.kafka_consumer.commit_offsets(offsets)
+            except Exception:
+                self.restage(offsets)
+                raise
+
+    async def run(self) -> None:
+        """Фоновая задача фиксации смещений"""
+        while True:
+            await self.staged.wait()
+            self.staged.clear()
+            try:
+                await self.flush()
+            except KafkaDeliveryError:
+                # Перезапуск consumer с последних зафиксированных смещений
+                raise
+            except Exception as e:
+                logger.error(f"Kafka commit failed {e}")
+                # Повторить после паузы
+                await asyncio.sleep(
+                    config.CONSUMER_KAFKA["retry_backoff_ms"] / 1000
+                )
+                self.staged.set()
+            if config.COMMIT_INTERVAL_MS:
+                await asyncio.sleep(config.COMMIT_INTERVAL_MS / 1000)
+
+
+class RebalanceListener(ConsumerRebalanceListener):
+    """Обработка перебалансировки партиций consumer
+
+    При отзыве партиций: остановить выборку по ним, дождаться
+    обработки уже полученных сообщений, зафиксировать смещения
+    и освободить состояние партиций. Так сообщения не обрабатываются
+    повторно новым владельцем партиции.
+    """
+
+    def __init__(self, kafka_consumer: "KafkaConsumerBase"):
+        self.kafka_consumer = kafka_consumer
+
+    async def on_partitions_revoked(self, revoked) -> None:
+        if not revoked:
+            return
+        logger.info(f"partitions revoked: {sorted(revoked)}")
+        dispatcher = self.kafka_consumer.dispatcher
+        # Не выбирать новые сообщения отзываемых партиций
+        self.kafka_consumer.pause(revoked)
+        try:
+            if dispatcher:
+                # Дождаться обработки и зафиксировать нижние границы
+                await dispatcher.revoke(revoked)
+            # Зафиксировать накопленные смещения до передачи партиций
+            await self.kafka_consumer.committer.flush(revoked)
+        except Exception as e:
+            logger.error(f"Kafka commit on revoke failed {e}")
+        finally:
+            if dispatcher:
+                dispatcher.release(revoked)
+
+    async def on_partitions_assigned(self, assigned) -> None:
+        logger.info(f"partitions assigned: {sorted(assigned)}")
+        dispatcher = self.kafka_consumer.dispatcher
+        if dispatcher:
+            dispatcher.assign(assigned)
+
+
+class KafkaConsumerBase:
+    """Consumer kafka: чтение, фиксация смещений, перебалансировка"""
 
     consumer: AIOKafkaConsumer = None
+    # Имя lane для метрик
+    name: str = "main"
+
+    def __init__(self, max_records: int = None):
+        self.batch = AdaptiveBatch(max_records)
+        self.committer = OffsetCommitter(self)
+        # Обработчик пакетов сообщений, состояние партиций
+        self.dispatcher = None
+        # Отставание партиций от high watermark, tp -> сообщений
+        self.lags: dict = {}
+
+    def topics(self) -> list:
+        """Топики подписки consumer"""
+        topics = []
+        if config.SRC_TOPIC:
+            topics.append(config.SRC_TOPIC)
+        if config.LOCAL_TOPIC:
+            topics.append(config.LOCAL_TOPIC)
+        if config.DLQ_READ_TOPIC:
+            topics.append(config.DLQ_READ_TOPIC)
+        return topics
+
+    def pattern(self) -> str | None:
+        """Шаблон топиков подписки, если нет топиков"""
+        return config.SRC_PATTERN_TOPIC
 
     async def start(self):
         logger.info(f"connect consumer kafka: {config.CONSUMER_KAFKA}")
-        self.consumer = AIOKafkaConsumer(
+        consumer_class = (
+            MemoryConsumer
+            if is_memory(config.CONSUMER_KAFKA["bootstrap_servers"])
+            else AIOKafkaConsumer
+        )
+        self.consumer = consumer_class(
             **config.CONSUMER_KAFKA,
             # Отключает автоматическую отправку подтверждений (commit)
             # о прочитанных смещениях (offset).
@@ -39,41 +263,48 @@ class KafkaConsumer(metaclass=MetaSingleton):
             # "latest" – читать только новые сообщения,
             # которые будут приходить после запуска.
             auto_offset_reset="latest",
+            # Транзакции kafka: только зафиксированные сообщения
+            isolation_level=(
+                "read_committed"
+                if config.KAFKA_TRANSACTIONS
+                else "read_uncommitted"
+            ),
         )
-        topics = []
-        if config.SRC_TOPIC:
-            topics.append(config.SRC_TOPIC)
-        if config.LOCAL_TOPIC:
-            topics.append(config.LOCAL_TOPIC)
-        if config.DLQ_READ_TOPIC:
-            topics.append(config.DLQ_READ_TOPIC)
+        topics = self.topics()
+        pattern = self.pattern()
+        listener = RebalanceListener(self)
         if topics:
-            self.consumer.subscribe(topics=topics)
+            self.consumer.subscribe(topics=topics, listener=listener)
             logger.info(f"subscribe topics: {topics}")
         else:
-            if config.SRC_PATTERN_TOPIC:
-                self.consumer.subscribe(pattern=config.SRC_PATTERN_TOPIC)
-                logger.info(
-                    f"subscribe topic pattern: {config.SRC_PATTERN_TOPIC}"
-                )
+            if pattern:
+                self.consumer.subscribe(pattern=pattern, listener=listener)
+                logger.info(f"subscribe topic pattern: {pattern}")
             else:
                 raise Exception("Service not source topics")
         await self.consumer.start()
 
-    async def get_messages(self):
+    async def get_messages(self, timeout_ms: int = None):
         """Получить сообщения из kafka
         если соединения не установлено,
-        то установить соединение и запустить kafka"""
+        то установить соединение и запустить kafka
+
+        :param int timeout_ms: время ожидания пакета,
+            по умолчанию BATCH_TIMEOUT_SEC
+        """
         if not self.consumer:
             await self.start()
+        if timeout_ms is None:
+            timeout_ms = config.BATCH_TIMEOUT_SEC * 1000
         try:
             data = await asyncio.wait_for(
                 self.consumer.getmany(
-                    timeout_ms=config.BATCH_TIMEOUT_SEC * 1000,
-                    max_records=config.BATCH_MAX_RECORDS,
+                    timeout_ms=timeout_ms,
+                    max_records=self.batch.max_records,
                 ),
                 timeout=config.KAFKA_READ_TIMEOUT_SEC,
             )
+            self.observe_lag(data)
             return data
         except asyncio.TimeoutError:
             logger.error("Kafka poll timeout")
@@ -82,9 +313,74 @@ class KafkaConsumer(metaclass=MetaSingleton):
             logger.error(f"Kafka poll failed {e}")
             return {}
 
+    def observe_lag(self, data: dict) -> None:
+        """Учесть прочитанные сообщения и отставание партиций"""
+        for tp, messages in data.items():
+            highwater = self.consumer.highwater(tp)
+            if messages and highwater is not None:
+                self.lags[tp] = highwater - messages[-1].offset - 1
+        assigned = self.assignment()
+        self.lags = {
+            tp: lag for tp, lag in self.lags.items() if tp in assigned
+        }
+        CONSUMER_LANE_LAG.labels(self.name).set(sum(self.lags.values()))
+        CONSUMER_LANE_MESSAGES_CNT.labels(self.name).inc(
+            sum(len(messages) for messages in data.values())
+        )
+
+    def batch_done(self, count: int, elapsed: float) -> None:
+        """Учесть время обработки блока для адаптивного размера блока"""
+        self.batch.observe(count, elapsed)
+
+    def assignment(self) -> set:
+        """Назначенные consumer партиции"""
+        return self.consumer.assignment() if self.consumer else set()
+
+    def pause(self, partitions) -> None:
+        """Приостановить выборку сообщений партиций"""
+        assigned = self.assignment()
+        partitions = [tp for tp in partitions if tp in assigned]
+        if partitions:
+            self.consumer.pause(*partitions)
+
+    def resume(self, partitions) -> None:
+        """Возобновить выборку сообщений партиций"""
+        assigned = self.assignment()
+        partitions = [tp for tp in partitions if tp in assigned]
+        if partitions:
+            self.consumer.resume(*partitions)
+
+    def seek(self, tp, offset: int) -> None:
+        """Читать партицию со смещения offset"""
+        if tp in self.assignment():
+            self.consumer.seek(tp, offset)
+
+    async def commit_offsets(self, offsets: dict) -> None:
+        """Зафиксировать смещения {tp: offset}
+
+        Сначала дождаться подтверждения отправленных событий
+        """
+        started = time.monotonic()
+        try:
+            await KafkaProducer().flush()
+            await self.consumer.commit(offsets)
+        except Exception:
+            CONSUMER_COMMIT_ERROR_CNT.inc()
+            raise
+        finally:
+            CONSUMER_COMMIT_SECONDS.observe(time.monotonic() - started)
+
     async def partition_commit(self, tp, offset):
         """Пометить прочитанные записи обработанными"""
-        await self.consumer.commit({tp: offset})
+        if config.COMMIT_ASYNC:
+            # Зафиксирует фоновая задача
+            self.committer.stage(tp, offset)
+        else:
+            await self.commit_offsets({tp: offset})
+
+    async def flush_commits(self) -> None:
+        """Принудительно зафиксировать накопленные смещения"""
+        await self.committer.flush()
 
     async def stop(self):
         """Остановить kafka соединение и отпустить объект"""
@@ -94,24 +390,345 @@ class KafkaConsumer(metaclass=MetaSingleton):
             self.consumer = None
 
 
+class KafkaConsumer(KafkaConsumerBase, metaclass=MetaSingleton):
+    """Consumer сервиса, все топики сервиса одним consumer"""
+
+
+class ConsumerLane(KafkaConsumerBase):
+    """Consumer одного класса топиков сервиса
+
+    Consumer lane входят в группу сервиса, каждый со своей подпиской,
+    своим размером блока, числом параллельных партиций и весом.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        topics: list,
+        max_records: int,
+        concurrency: int,
+        weight: int,
+        pattern: str = None,
+    ):
+        super().__init__(max_records)
+        self.name = name
+        self._topics = topics
+        self._pattern = pattern
+        self.concurrency = concurrency
+        self.weight = weight
+
+    def topics(self) -> list:
+        return self._topics
+
+    def pattern(self) -> str | None:
+        return self._pattern
+
+
+def consumer_lanes() -> list:
+    """Consumer lane для топиков сервиса, по убыванию веса"""
+    lanes = []
+    if config.SRC_TOPIC or config.SRC_PATTERN_TOPIC:
+        lanes.append(
+            ConsumerLane(
+                name="live",
+                topics=[config.SRC_TOPIC] if config.SRC_TOPIC else [],
+                pattern=config.SRC_PATTERN_TOPIC,
+                max_records=config.LIVE_LANE_MAX_RECORDS,
+                concurrency=config.LIVE_LANE_CONCURRENCY,
+                weight=config.LIVE_LANE_WEIGHT,
+            )
+        )
+    if config.LOCAL_TOPIC:
+        lanes.append(
+            ConsumerLane(
+                name="local",
+                topics=[config.LOCAL_TOPIC],
+                max_records=config.LOCAL_LANE_MAX_RECORDS,
+                concurrency=config.LOCAL_LANE_CONCURRENCY,
+                weight=config.LOCAL_LANE_WEIGHT,
+            )
+        )
+    if config.DLQ_READ_TOPIC:
+        lanes.append(
+            ConsumerLane(
+                name="dlq",
+                topics=[config.DLQ_READ_TOPIC],
+                max_records=config.DLQ_LANE_MAX_RECORDS,
+                concurrency=config.DLQ_LANE_CONCURRENCY,
+                weight=config.DLQ_LANE_WEIGHT,
+            )
+        )
+    return sorted(lanes, key=lambda lane: -lane.weight)
+
+
+class LanePriority:
+    """Приоритет чтения consumer lane
+
+    Lane ждет перед чтением блока, пока у lane с большим весом
+    есть очередь (последний блок был полным), но не дольше
+    LANE_MAX_WAIT_SEC, чтобы не выпасть из группы.
+    """
+
+    def __init__(self, lanes: list):
+        self.weights = {lane.name: lane.weight for lane in lanes}
+        # Lane с очередью сообщений
+        self.backlog: set = set()
+        self.condition = asyncio.Condition()
+
+    def ahead(self, lane: ConsumerLane) -> bool:
+        """Есть lane с большим весом и очередью"""
+        return any(self.weights[name] > lane.weight for name in self.backlog)
+
+    async def report(self, lane: ConsumerLane, count: int) -> None:
+        """Учесть размер прочитанного lane блока"""
+        async with self.condition:
+            if count >= lane.batch.max_records:
+                self.backlog.add(lane.name)
+            else:
+                self.backlog.discard(lane.name)
+            self.condition.notify_all()
+
+    async def wait_turn(self, lane: ConsumerLane) -> None:
+        """Дождаться очереди чтения lane"""
+        async with self.condition:
+            try:
+                await asyncio.wait_for(
+                    self.condition.wait_for(lambda: not self.ahead(lane)),
+                    timeout=config.LANE_MAX_WAIT_SEC,
+                )
+            except TimeoutError:
+                pass
+
+
 message_handlers: list = []
 event_handlers: list = []
 all_event_handlers: list = []
+batch_event_handlers: list = []
+
+
+class BatchHandler(NamedTuple):
+    """Обработчик пакета событий и параметры накопления пакета"""
+
+    handler: Callable
+    max_size: int
+    max_wait_ms: int
+
+
+class EventHandler(NamedTuple):
+    """Обработчик типизированного события и его ограничения"""
+
+    name: str
+    handler: Callable
+    semaphore: asyncio.Semaphore | None
+    timeout: float | None
+    priority: int
+
+
+class HandlerTimeoutError(Exception):
+    """Обработчик события не уложился в timeout"""
+
+    def __init__(self, event_name: str, timeout: float):
+        super().__init__(
+            f'handler of "{event_name}" timed out after {timeout} sec'
+        )
+        self.event_name = event_name
+        self.timeout = timeout
+
+
+class HandlerRoute(NamedTuple):
+    """Обработчики одного события и модель события"""
+
+    message_handlers: tuple
+    event_handlers: tuple
+    model: type | None
+    batch_handlers: tuple = ()
+    # Наибольший priority обработчиков события
+    priority: int = 0
+
+
+# Индекс обработчиков: имя события в нижнем регистре -> HandlerRoute,
+# строится при регистрации обработчиков
+handlers_index: dict = {}
+
+# События, модель которых не найдена и после повторного сбора моделей:
+# модели собираются заново не больше одного раза на имя события
+missing_models: set = set()
+
+# События с обработчиками priority != 0, только для них диспетчер
+# определяет приоритет сообщений
+prioritized_events: set = set()
+
+# Ограничение одновременной обработки события: имя события в нижнем
+# регистре -> asyncio.Semaphore, общий для всех обработчиков события
+event_semaphores: dict = {}
+
+
+def find_model(event_name: str, refresh: bool = False) -> type | None:
+    """Найти модель события по имени, без учета регистра
+
+    :param bool refresh: собрать модели заново, модуль модели мог быть
+        импортирован после первого обращения к Schema
+    """
+    if refresh:
+        Schema().refresh()
+    models = Schema().get_models()
+    model = models.get(event_name, None)
+    if model is None:
+        for name, obj in models.items():
+            if name.lower() == event_name.lower():
+                return obj
+    return model
+
+
+def index_handlers(event_name: str) -> None:
+    """Перестроить запись индекса обработчиков события"""
+    key = event_name.lower()
+    # Новый обработчик: модель ищется заново
+    missing_models.discard(key)
+    route = HandlerRoute(
+        message_handlers=tuple(
+            handler["handler"]
+            for handler in message_handlers
+            if handler["name"].lower() == key
+        ),
+        # Обработчики с большим priority вызываются первыми
+        event_handlers=tuple(
+            sorted(
+                (
+                    handler["handler"]._replace(
+                        semaphore=event_semaphores.get(key)
+                    )
+                    for handler in event_handlers
+                    if handler["name"].lower() == key
+                ),
+                key=lambda handler: -handler.priority,
+            )
+        ),
+        model=find_model(event_name),
+        batch_handlers=tuple(
+            handler["handler"]
+            for handler in batch_event_handlers
+            if handler["name"].lower() == key
+        ),
+    )
+    if route.event_handlers:
+        route = route._replace(priority=route.event_handlers[0].priority)
+    if route.priority:
+        prioritized_events.add(key)
+    else:
+        prioritized_events.discard(key)
+    handlers_index[key] = route
+
+
+def event_priority(event_name: str | None) -> int:
+    """Приоритет события: наибольший priority его обработчиков"""
+    route = handlers_index.get(event_name.lower()) if event_name else None
+    return route.priority if route else 0
+
+
+def route_model(event_name: str, route: HandlerRoute) -> HandlerRoute:
+    """Найти модель события, не найденную при регистрации обработчика"""
+    if route.model is None and (route.event_handlers or route.batch_handlers):
+        key = event_name.lower()
+        if key in missing_models:
+            return route
+        model = find_model(event_name, refresh=True)
+        if model is None:
+            missing_models.add(key)
+        else:
+            route = route._replace(model=model)
+            handlers_index[key] = route
+    return route
 
 
 def message_handler(event_name):
 
     def decorator(handler):
         message_handlers.append({"name": event_name, "handler": handler})
+        index_handlers(event_name)
         return handler
 
     return decorator
 
 
-def event_handler(event_name):
+def event_handler(
+    event_name,
+    max_concurrency: int = None,
+    timeout: float = None,
+    priority: int = 0,
+):
+    """Обработчик типизированного события
+
+    :param int max_concurrency: сколько событий этого типа могут
+        обрабатываться одновременно, ограничение общее для всех
+        обработчиков события, по умолчанию без ограничения
+    :param float timeout: время обработки одного события, сек,
+        при превышении событие отправляется в DLQ с ошибкой
+        HandlerTimeoutError
+    :param int priority: приоритет события: партиции с такими событиями
+        получают место из PARTITION_CONCURRENCY раньше ожидающих партиций
+        с меньшим приоритетом, обработчики одного события вызываются
+        по убыванию priority
+
+    @event_handler("CronTriggeredEvent", max_concurrency=1, timeout=60)
+    async def cron(obj: CronTriggeredEvent):
+        ...
+    """
 
     def decorator(handler):
-        event_handlers.append({"name": event_name, "handler": handler})
+        key = event_name.lower()
+        if max_concurrency:
+            if key in event_semaphores:
+                # Ограничение события задается один раз
+                logger.warning(
+                    f'max_concurrency of "{event_name}" is already set, '
+                    + "the first limit is shared by all handlers"
+                )
+            else:
+                event_semaphores[key] = asyncio.Semaphore(max_concurrency)
+        event_handlers.append(
+            {
+                "name": event_name,
+                "handler": EventHandler(
+                    name=event_name,
+                    handler=handler,
+                    # Общий семафор события подставляет index_handlers
+                    semaphore=None,
+                    timeout=timeout,
+                    priority=priority,
+                ),
+            }
+        )
+        index_handlers(event_name)
+        return handler
+
+    return decorator
+
+
+def batch_event_handler(
+    event_name, max_size: int = 100, max_wait_ms: int = 1000
+):
+    """Обработчик пакета событий
+
+    Обработчик получает список объектов события, накопленных из пакетов
+    kafka, но не более max_size объектов и не дольше max_wait_ms.
+    Смещения сообщений фиксируются после возврата из обработчика.
+    Обработчик может вернуть dict {индекс в списке: ошибка}
+    с необработанными объектами, они будут отправлены в DLQ.
+
+    @batch_event_handler("UpdatedClient", max_size=500, max_wait_ms=200)
+    async def updated_clients(objs: list[UpdatedClient]) -> dict | None:
+        ...
+    """
+
+    def decorator(handler):
+        batch_event_handlers.append(
+            {
+                "name": event_name,
+                "handler": BatchHandler(handler, max_size, max_wait_ms),
+            }
+        )
+        index_handlers(event_name)
         return handler
 
     return decorator
@@ -126,56 +743,313 @@ def all_event_handler():
     return decorator
 
 
-async def capture_dict(message: dict) -> None:
-    # Получить имя события
-    header: dict = message.get("header", {})
-    event_name = header.get("event", None) or message.get("event", None)
+class _HeaderPeek(TypedDict, total=False):
+    event: str | None
+    uuid: str | None
+    source: str | None
+    trace_id: str | None
+
+
+class _EventPeek(TypedDict, total=False):
+    header: _HeaderPeek | None
+    event: str | None
+
+
+# Разбор из json только имени события и полей заголовка для логирования
+_event_peek = TypeAdapter(_EventPeek)
+
+# Имя события из заголовка, если заголовок первое поле сообщения,
+# как его формирует HeaderEvent.send
+_header_event_name = re.compile(
+    rb'\A\s*\{\s*"header"\s*:\s*\{[^{}]*?"event"\s*:\s*"([^"\\]+)"'
+)
+
+
+class EventMessage:
+    """Входящее сообщение kafka
+
+    Тело сообщения разбирается по мере необходимости: для типизированных
+    обработчиков модель валидируется прямо из байтов сообщения,
+    dict создается только для legacy обработчиков и DLQ.
+    Сообщение msgpack (codec.content_type) разбирается в dict сразу.
+    """
+
+    def __init__(
+        self,
+        value: bytes,
+        create_event_timestamp: str = None,
+        headers=None,
+    ):
+        self.value = value
+        self.create_event_timestamp = create_event_timestamp
+        # Формат сообщения по заголовку content-type
+        self.msgpack: bool = (
+            codec.content_type(value, headers) == codec.MSGPACK
+        )
+        self._peek: dict = None
+        self._dict: dict = None
+        # Событие накоплено для batch обработчика
+        self.batched: bool = False
+
+    def peek(self) -> dict:
+        """Имя события и заголовок, без разбора остального сообщения"""
+        if self._peek is None:
+            if self._dict is not None or self.msgpack:
+                self._peek = self.as_dict()
+            else:
+                try:
+                    self._peek = _event_peek.validate_json(self.value)
+                except ValidationError:
+                    # Нестандартный заголовок, разобрать полностью
+                    self._peek = self.as_dict()
+        return self._peek
+
+    def header(self) -> dict:
+        return self.peek().get("header") or {}
+
+    def uuid(self) -> str | None:
+        return self.header().get("uuid", None)
+
+    def event_name(self) -> str | None:
+        match = not self.msgpack and _header_event_name.match(self.value)
+        if match:
+            return match.group(1).decode()
+        return self.header().get("event", None) or self.peek().get(
+            "event", None
+        )
+
+    def as_dict(self) -> dict:
+        """Сообщение как dict, с временем создания события"""
+        if self._dict is None:
+            self._dict = (
+                codec.msgpack_loads(self.value)
+                if self.msgpack
+                else codec.loads(self.value)
+            )
+            self._dict["create_event_timestamp"] = self.create_event_timestamp
+        return self._dict
+
+    def validate(self, model: type) -> object:
+        """Получить объект модели прямо из json"""
+        context = {"create_event_timestamp": self.create_event_timestamp}
+        if self.msgpack:
+            return model.model_validate(
+                codec.msgpack_loads(self.value), context=context
+            )
+        return model.model_validate_json(self.value, context=context)
+
+
+def logger_capture_event(event_name: str, header) -> None:
+    """Установить trace_id пришедшего события и вывести в лог
 
-    def logger_capture_event():
-        if header:
+    :param str event_name: имя события
+    :param header: заголовок события, dict или Header
+    """
+    if header:
+        if isinstance(header, dict):
             source = header.get("source")
             uuid = header.get("uuid")
             trace_id = header.get("trace_id")
-            if trace_id:
-                TRACE().set(trace_id)
-            else:
-                TRACE().new()
-            logger.info(
-                f'get event from "{source}" '
-                + f'-> "{event_name}" with uuid={uuid}'
+        else:
+            source = header.source
+            uuid = header.uuid
+            trace_id = header.trace_id
+        if trace_id:
+            TRACE().set(trace_id)
+        else:
+            TRACE().new()
+        logger.info(
+            f'get event from "{source}" '
+            + f'-> "{event_name}" with uuid={uuid}'
+        )
+
+
+async def call_event_handler(event_handler: EventHandler, obj) -> None:
+    """Вызвать обработчик события с его ограничениями"""
+    name = event_handler.name
+    async with event_handler.semaphore or contextlib.nullcontext():
+        EVENT_HANDLER_INFLIGHT.labels(name).inc()
+        start = time.monotonic()
+        try:
+            async with asyncio.timeout(event_handler.timeout) as timeout:
+                await event_handler.handler(obj)
+        except TimeoutError as e:
+            if not timeout.expired():
+                raise
+            EVENT_HANDLER_TIMEOUT_CNT.labels(name).inc()
+            raise HandlerTimeoutError(name, event_handler.timeout) from e
+        finally:
+            EVENT_HANDLER_INFLIGHT.labels(name).dec()
+            EVENT_HANDLER_SECONDS.labels(name).observe(
+                time.monotonic() - start
             )
 
+
+async def call_batch_handler(batch_handler: BatchHandler, objs: list) -> dict:
+    """Вызвать обработчик пакета событий
+
+    :return dict: необработанные объекты {индекс в списке: ошибка}
+    """
+    try:
+        failures = await batch_handler.handler(objs)
+    except Exception as e:
+        # Ошибка всего пакета
+        failures = {index: e for index in range(len(objs))}
+    WORKED_EVENTS_CNT.inc(len(objs) - len(failures or {}))
+    return failures or {}
+
+
+async def dispatch_event(
+    event_name: str, as_header, as_dict, as_model, batch=None
+):
+    """Вызвать обработчики события
+
+    :param str event_name: имя события
+    :param as_header: функция получения заголовка события как dict
+    :param as_dict: функция получения сообщения как dict
+    :param as_model: функция получения объекта модели события
+    :param batch: функция накопления объекта для batch обработчика,
+        если не задана, то batch обработчик вызывается сразу
+    """
+    # Найти обработчики события
+    route = handlers_index.get(event_name.lower()) if event_name else None
+    if route is None:
+        return
+    route = route_model(event_name, route)
     # ++ legasy
-    for handler in message_handlers:
-        if handler["name"].lower() == event_name.lower():
-            logger_capture_event()
-            await handler["handler"](message)
+    for handler in route.message_handlers:
+        logger_capture_event(event_name, as_header())
+        await handler(as_dict())
+        # Обработано входящее событие
+        WORKED_EVENTS_CNT.inc()
+    # -- legasy
+    # Перебрать обработчики события
+    for handler in route.event_handlers:
+        # logger.info(f"capture event: {message=}")
+        # Найти свою модель
+        obj = route.model
+        if obj:
+            # Получить объект из json
+            data_obj = as_model(obj)
+            # Вызвать метод дополнителной сереализации
+            await data_obj.deserialization()
+            # Вывести пришло событие
+            logger_capture_event(event_name, data_obj.header)
+            # Вызвать функцию обработчик события, передать на вход объект
+            await call_event_handler(handler, data_obj)
             # Обработано входящее событие
             WORKED_EVENTS_CNT.inc()
-    # -- legasy
-    # Перебрать все обработчики событий
-    for handler in event_handlers:
-        # Найти свой обработчик
-        if handler["name"].lower() == event_name.lower():
-            # logger.info(f"capture event: {message=}")
-            # Найти свою модель
-            obj = Schema().get_models().get(event_name, None)
-            if obj:
-                # Получить объект из json
-                data_obj = obj(**message)
-                # Вызвать метод дополнителной сереализации
-                await data_obj.deserialization()
-                # Вывести пришло событие
-                logger_capture_event()
-                # Вызвать функцию обработчик события, передать на вход объект
-                await handler["handler"](data_obj)
-                # Обработано входящее событие
-                WORKED_EVENTS_CNT.inc()
-            else:
-                raise Exception(f"Не найдена model {event_name}")
+        else:
+            raise Exception(f"Не найдена model {event_name}")
+    # Перебрать обработчики пакетов события
+    for batch_handler in route.batch_handlers:
+        if not route.model:
+            raise Exception(f"Не найдена model {event_name}")
+        data_obj = as_model(route.model)
+        await data_obj.deserialization()
+        logger_capture_event(event_name, data_obj.header)
+        if batch:
+            # Накопить в пакет
+            await batch(batch_handler, data_obj)
+        else:
+            # Пакет из одного события
+            failures = await call_batch_handler(batch_handler, [data_obj])
+            for error in failures.values():
+                if isinstance(error, Exception):
+                    raise error
+                raise Exception(error)
+
+
+async def capture_dict(message: dict) -> None:
+    # Получить имя события
+    header: dict = message.get("header") or {}
+    event_name = header.get("event", None) or message.get("event", None)
+    uuid = header.get("uuid", None)
+    dedup = Dedup()
+    # Только по памяти: uuid из postgres загружает пакетом
+    # Dispatcher.prefetch, без запроса на каждое событие
+    if skip_duplicate(uuid):
+        return
+    await dispatch_event(
+        event_name=event_name,
+        as_header=lambda: header,
+        as_dict=lambda: message,
+        as_model=lambda obj: obj(**message),
+    )
+    dedup.mark(uuid)
+
 
+def skip_duplicate(uuid: str) -> bool:
+    """Событие с этим uuid уже обработано"""
+    if Dedup().is_seen(uuid):
+        EVENTS_DUPLICATE_CNT.inc()
+        logger.info(f"skip duplicate event with uuid={uuid}")
+        return True
+    return False
 
-async def capture(message: object, events=None) -> None:
+
+async def capture_message(message: EventMessage, batch=None) -> None:
+    await dispatch_event(
+        event_name=message.event_name(),
+        as_header=message.header,
+        as_dict=message.as_dict,
+        as_model=message.validate,
+        batch=batch,
+    )
+
+
+async def send_dlq(message_dict: dict, error: Exception | str) -> None:
+    """Отправить сообщение с ошибкой обработки в топик ошибок сервиса"""
+    if isinstance(error, Exception):
+        err = "".join(traceback.format_exception(error))
+    else:
+        err = str(error)
+    # Добавить в текущее сообщение данные об ошибке
+    message_dict["attempt"] = message_dict.get("attempt", 0) + 1
+    message_dict["error_message"] = str(error)
+    message_dict["error_type"] = (
+        type(error).__name__ if isinstance(error, Exception) else "error"
+    )
+    message_dict["traceback"] = err.split("\n")
+    now_isoformat = datetime.datetime.now().isoformat()
+    message_dict["error_at"] = now_isoformat
+    message_dict["first_error_at"] = message_dict.get(
+        "first_error_at", now_isoformat
+    )
+    # Отправить сообщение в топик ошибок сервиса
+    await KafkaProducer().send_kafka_topic(
+        topic=config.DLQ_WRITE_TOPIC, key=None, data=message_dict
+    )
+    # Метрика !!!
+    EVENTS_SENT_DLQ_CNT.inc()
+    logger.error(err)
+    logger.info(f"sended error message to topic {config.DLQ_WRITE_TOPIC}")
+
+
+def event_message_of(message: object) -> EventMessage:
+    """Входящее сообщение kafka как EventMessage"""
+    return EventMessage(
+        value=message.value,
+        # Время создания сообщения
+        create_event_timestamp=datetime.datetime.fromtimestamp(
+            message.timestamp / 1000
+        ).strftime("%d.%m.%Y %H:%M:%S"),
+        headers=getattr(message, "headers", None),
+    )
+
+
+async def capture(
+    message: object, events=None, batch=None, event_message=None
+) -> None:
+    """Обработать сообщение kafka
+
+    :param object message: сообщение kafka
+    :param events: legacy обработчики Events
+    :param batch: функция накопления событий для batch обработчиков
+        batch(batch_handler, obj, message=..., event_message=...)
+    :param EventMessage event_message: сообщение, уже разобранное
+        вызывающим (event_message_of), чтобы не разбирать повторно
+    """
     # Входящее событие в сервис
     DO_EVENTS_CNT.inc()
     # Перехватить все входящие сообщения
@@ -183,46 +1057,35 @@ async def capture(message: object, events=None) -> None:
         # Вызвать функцию обработчик события, передать на вход объект
         await handler["handler"](message)
         WORKED_EVENTS_CNT.inc()
-    if message_handlers or event_handlers:
-        # Добавить в сообщение время создания
-        message_dict = json.loads(message.value)
-        message_dict["create_event_timestamp"] = (
-            datetime.datetime.fromtimestamp(message.timestamp / 1000).strftime(
-                "%d.%m.%Y %H:%M:%S"
+    if message_handlers or event_handlers or batch_event_handlers:
+        if event_message is None:
+            event_message = event_message_of(message)
+        # Повторно пришедшее событие
+        dedup = Dedup()
+        uuid = event_message.uuid() if dedup.enabled else None
+        if skip_duplicate(uuid):
+            return
+        if batch:
+            batch = functools.partial(
+                batch, message=message, event_message=event_message
             )
-        )
         # Обработать сообщение
         if config.DLQ_WRITE_TOPIC:
             try:
                 # legasy
                 if events:
-                    await events.do(message_dict)
+                    await events.do(event_message.as_dict())
                 # new
-                await capture_dict(message_dict)
+                await capture_message(event_message, batch=batch)
             except Exception as e:
-                err = traceback.format_exc()
-                # Добавить в текущее сообщение данные об ошибке
-                message_dict["attempt"] = message_dict.get("attempt", 0) + 1
-                message_dict["error_message"] = str(e)
-                message_dict["traceback"] = err.split("\n")
-                now_isoformat = datetime.datetime.now().isoformat()
-                message_dict["error_at"] = now_isoformat
-                message_dict["first_error_at"] = message_dict.get(
-                    "first_error_at", now_isoformat
-                )
-                # Отправить сообщение в топик ошибок сервиса
-                await KafkaProducer().send_kafka_topic(
-                    topic=config.DLQ_WRITE_TOPIC, key=None, data=message_dict
-                )
-                # Метрика !!!
-                EVENTS_SENT_DLQ_CNT.inc()
-                logger.error(err)
-                logger.info(
-                    f"sended error message to topic {config.DLQ_WRITE_TOPIC}"
-                )
+                await send_dlq(event_message.as_dict(), e)
+                return
         else:
             # legasy
             if events:
-                await events.do(message_dict)
+                await events.do(event_message.as_dict())
             # new
-            await capture_dict(message_dict)
+            await capture_message(event_message, batch=batch)
+        # Событие обработано, накопленные отметит BatchCollector
+        if not event_message.batched:
+            dedup.mark(uuid)
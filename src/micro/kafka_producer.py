@@ -1,12 +1,15 @@
 import logging
-import json
 import asyncio
-from datetime import datetime, date, time, timedelta
-from typing import Any
+import time
+from datetime import datetime
 
 from aiokafka import AIOKafkaProducer
 
 from micro.singleton import MetaSingleton
+from micro import codec
+from micro.codec import serialize_datetime  # noqa
+from micro.memory_kafka import MemoryProducer, is_memory
+from micro.transactions import current_transaction
 
 # from micro.models.header_event import HeaderEvent, Header
 
@@ -14,97 +17,89 @@ from micro.logging_trace import TRACE
 
 import micro.config as config
 
-from .metrics import EVENTS_SENT_CNT
+from .metrics import (
+    EVENTS_SENT_CNT,
+    PRODUCER_DELIVERY_SECONDS,
+    PRODUCER_INFLIGHT_DELIVERIES,
+    PRODUCER_DELIVERY_ERROR_CNT,
+    EVENTS_COALESCED_CNT,
+)
 
 logger = logging.getLogger(__name__)
 
 
-def serialize_datetime(obj: Any) -> str | float:
-    """
-    Сериализует объекты datetime, date, time, timedelta в строки или числа.
-
-    Поддерживаемые типы:
-        - datetime.datetime → ISO формат с временем: "2025-08-11T14:30:00"
-        - datetime.date      → ISO формат даты: "2025-08-11"
-        - datetime.time      → ISO формат времени: "14:30:00"
-        - datetime.timedelta → float (секунды) ИЛИ строка в формате
-          ISO 8601 (по желанию)
-
-    Для использования с json.dumps:
-        json.dumps(data, default=serialize_datetime)
-
-    :param obj: Любой объект для сериализации
-    :return: Сериализованное значение (str или float)
-    :raises TypeError: Если тип не поддерживается
-    """
-    if isinstance(obj, datetime):
-        return obj.isoformat()
-    elif isinstance(obj, date):
-        return obj.isoformat()
-    elif isinstance(obj, time):
-        return obj.isoformat()
-    elif isinstance(obj, timedelta):
-        # Вариант 1: возвращаем общее количество секунд (float)
-        return obj.total_seconds()
-
-        # Альтернатива: возвращать в формате ISO 8601 (например, "PT2H30M")
-        # from isodate import duration_isoformat  # требует pip install isodate
-        # return duration_isoformat(obj)
-        #
-        # Но без внешних зависимостей можно сделать вручную:
-        # days = obj.days
-        # seconds = obj.seconds
-        # hours, remainder = divmod(seconds, 3600)
-        # minutes, seconds = divmod(remainder, 60)
-        # parts = ["P"]
-        # if days: parts.append(f"{days}D")
-        # if hours or minutes or seconds:
-        #     parts.append("T")
-        #     if hours: parts.append(f"{hours}H")
-        #     if minutes: parts.append(f"{minutes}M")
-        #     if seconds: parts.append(f"{seconds}S")
-        # return "".join(parts) if len(parts) > 1 else "PT0S"
-
-    # Раскомментируйте, если нужно пропускать None
-    # elif obj is None:
-    #     return None
-
-    raise TypeError(
-        f"Объект типа {type(obj).__name__} не поддерживается для сериализации"
-    )
+class KafkaDeliveryError(Exception):
+    """Отправленное событие не подтверждено kafka"""
 
 
 class KafkaProducer(metaclass=MetaSingleton):
 
     producer: AIOKafkaProducer = None
 
+    def __init__(self):
+        # Ожидающие подтверждения отправки, PRODUCER_PIPELINE
+        self.deliveries: set = set()
+        # Первая ошибка отправки после clear_failed()
+        self.failed: BaseException = None
+        # Ожидающие отправки сообщения, PRODUCER_COALESCE:
+        # (topic, событие, ключ) -> [key, value, headers, задача отправки]
+        self.coalesced: dict = {}
+        # Задачи, отправляющие сообщение из coalesced
+        self.coalesce_sending: set = set()
+
     async def start(self, topic: str):
         if topic:
-            self.producer = AIOKafkaProducer(
+            producer_class = (
+                MemoryProducer
+                if is_memory(config.PRODUCER_KAFKA["bootstrap_servers"])
+                else AIOKafkaProducer
+            )
+            self.producer = producer_class(
                 **config.PRODUCER_KAFKA,
             )
             logger.info(f"connect producer kafka: {config.PRODUCER_KAFKA}")
             await self.producer.start()
 
     async def send_kafka_topic_value(
-        self, topic: str, key: any, value
-    ) -> None:
+        self, topic: str, key: any, value, headers: list = None
+    ) -> asyncio.Future | None:
         """Отправить сообщение в заданный topic
 
+        При PRODUCER_PIPELINE сообщение только ставится в очередь
+        producer, подтверждение ожидает flush().
+        В транзакции партиции (KAFKA_TRANSACTIONS) сообщение
+        отправляется producer транзакции и фиксируется
+        вместе со смещением партиции.
+
         :param any key: route key
         :param dict data: сообщение
+        :param list headers: заголовки kafka [(имя, bytes)]
+        :return: future подтверждения при PRODUCER_PIPELINE
+            и в транзакции
         """
-        if not self.producer:
+        transaction = current_transaction.get()
+        if transaction is None and not self.producer:
             await self.start(topic)
         try:
-            await asyncio.wait_for(
-                self.producer.send_and_wait(
+            # asyncio.timeout не создает задачу на каждую отправку
+            async with asyncio.timeout(config.KAFKA_DELIVERY_TIMEOUT_SEC):
+                if transaction is not None:
+                    delivery = await transaction.send(
+                        topic=topic,
+                        key=str(key).encode() if key else None,
+                        value=value,
+                        headers=headers,
+                    )
+                    EVENTS_SENT_CNT.inc()
+                    return delivery
+                if config.PRODUCER_PIPELINE:
+                    return await self.enqueue(topic, key, value, headers)
+                await self.producer.send_and_wait(
                     topic=topic,
                     key=str(key).encode() if key else None,
                     value=value,
-                ),
-                timeout=config.KAFKA_DELIVERY_TIMEOUT_SEC,
-            )
+                    headers=headers,
+                )
             # Отправлено событие в kafka
             EVENTS_SENT_CNT.inc()
         except asyncio.TimeoutError:
@@ -113,37 +108,233 @@ class KafkaProducer(metaclass=MetaSingleton):
             )
             raise
 
-    async def send_kafka_topic(self, topic: str, key: any, data: dict) -> None:
+    async def send_batch(self, topic: str, records: list) -> list:
+        """Отправить сообщения одним пакетом
+
+        Все сообщения ставятся в очередь producer,
+        подтверждения ожидаются один раз, не дольше
+        KAFKA_DELIVERY_TIMEOUT_SEC.
+        В транзакции партиции сообщения отправляет producer
+        транзакции, подтверждение - фиксация транзакции.
+
+        :param list records: [(key, value bytes)]
+            или [(key, value bytes, заголовки kafka)]
+        :return list: ошибка каждого сообщения или None
+        """
+        transaction = current_transaction.get()
+        if transaction is None and not self.producer:
+            await self.start(topic)
+        deliveries, errors = [], [None] * len(records)
+        for n, (key, value, *headers) in enumerate(records):
+            headers = headers[0] if headers else None
+            try:
+                if transaction is not None:
+                    delivery = await transaction.send(
+                        topic=topic,
+                        key=str(key).encode() if key else None,
+                        value=value,
+                        headers=headers,
+                    )
+                elif config.PRODUCER_PIPELINE:
+                    delivery = await self.enqueue(topic, key, value, headers)
+                else:
+                    delivery = await self.producer.send(
+                        topic=topic,
+                        key=str(key).encode() if key else None,
+                        value=value,
+                        headers=headers,
+                    )
+            except Exception as e:
+                errors[n] = e
+                continue
+            deliveries.append((n, delivery))
+        if transaction is not None:
+            EVENTS_SENT_CNT.inc(len(deliveries))
+            return errors
+        if deliveries:
+            await asyncio.wait(
+                [delivery for _, delivery in deliveries],
+                timeout=config.KAFKA_DELIVERY_TIMEOUT_SEC,
+            )
+        for n, delivery in deliveries:
+            if not delivery.done():
+                errors[n] = asyncio.TimeoutError(
+                    "Kafka send timeout after "
+                    + f"{config.KAFKA_DELIVERY_TIMEOUT_SEC}s"
+                )
+            elif delivery.cancelled():
+                errors[n] = asyncio.CancelledError()
+            else:
+                errors[n] = delivery.exception()
+                if errors[n] is None and not config.PRODUCER_PIPELINE:
+                    # Подтверждения pipeline учитывает enqueue
+                    EVENTS_SENT_CNT.inc()
+        return errors
+
+    async def enqueue(
+        self, topic: str, key: any, value, headers: list = None
+    ) -> asyncio.Future:
+        """Поставить сообщение в очередь producer"""
+        delivery = await self.producer.send(
+            topic=topic,
+            key=str(key).encode() if key else None,
+            value=value,
+            headers=headers,
+        )
+        started = time.monotonic()
+        self.deliveries.add(delivery)
+        PRODUCER_INFLIGHT_DELIVERIES.set(len(self.deliveries))
+
+        def delivered(future: asyncio.Future) -> None:
+            self.deliveries.discard(future)
+            PRODUCER_INFLIGHT_DELIVERIES.set(len(self.deliveries))
+            PRODUCER_DELIVERY_SECONDS.observe(time.monotonic() - started)
+            error = (
+                future.exception()
+                if not future.cancelled()
+                else asyncio.CancelledError()
+            )
+            if error is None:
+                EVENTS_SENT_CNT.inc()
+                return
+            PRODUCER_DELIVERY_ERROR_CNT.inc()
+            logger.error(f"Kafka delivery to {topic} failed {error!r}")
+            if self.failed is None:
+                self.failed = error
+
+        delivery.add_done_callback(delivered)
+        return delivery
+
+    async def coalesce(
+        self,
+        topic: str,
+        key: any,
+        value: bytes,
+        event: str,
+        coalesce_key: any,
+        window_ms: int,
+        headers: list = None,
+    ) -> None:
+        """Отправить сообщение через window_ms, если до отправки
+        придет событие event с тем же coalesce_key, то отправить
+        только последнее"""
+        buffer_key = (topic, event, coalesce_key)
+        entry = self.coalesced.get(buffer_key)
+        if entry is not None:
+            # Заменить не отправленное сообщение, время отправки прежнее
+            entry[:3] = key, value, headers
+            EVENTS_COALESCED_CNT.labels(event).inc()
+            return
+        self.coalesced[buffer_key] = [
+            key,
+            value,
+            headers,
+            asyncio.create_task(self.coalesce_send(buffer_key, window_ms)),
+        ]
+
+    async def coalesce_send(self, buffer_key: tuple, window_ms: int) -> None:
+        """Отправить сообщение из coalesced по истечении окна"""
+        await asyncio.sleep(window_ms / 1000)
+        key, value, headers, task = self.coalesced.pop(buffer_key)
+        self.coalesce_sending.add(task)
+        try:
+            await self.send_coalesced(buffer_key[0], key, value, headers)
+        finally:
+            self.coalesce_sending.discard(task)
+
+    async def send_coalesced(
+        self, topic: str, key: any, value, headers: list = None
+    ) -> None:
+        try:
+            await self.send_kafka_topic_value(topic, key, value, headers)
+        except Exception as e:
+            # Смещения не фиксируются до перезапуска consumer
+            logger.error(f"Kafka send coalesced event failed {e!r}")
+            if self.failed is None:
+                self.failed = e
+
+    async def flush_coalesced(self) -> None:
+        """Сразу отправить ожидающие сообщения coalesced"""
+        while self.coalesced:
+            buffer_key = next(iter(self.coalesced))
+            key, value, headers, task = self.coalesced.pop(buffer_key)
+            # Задача еще ждет окончания окна
+            task.cancel()
+            await self.send_coalesced(buffer_key[0], key, value, headers)
+        if self.coalesce_sending:
+            await asyncio.wait(list(self.coalesce_sending))
+
+    async def flush(self) -> None:
+        """Дождаться подтверждения всех отправленных событий
+
+        Вызывается перед фиксацией смещений consumer: смещение
+        фиксируется, только когда события, отправленные при обработке,
+        записаны в kafka.
+        Ошибка отправки повторяется каждым flush() до clear_failed(),
+        так что смещения не фиксируются до перезапуска consumer.
+
+        :raises KafkaDeliveryError: событие не подтверждено
+        """
+        await self.flush_coalesced()
+        if self.deliveries:
+            pending = list(self.deliveries)
+            done, not_done = await asyncio.wait(
+                pending, timeout=config.KAFKA_DELIVERY_TIMEOUT_SEC
+            )
+            if not_done and self.failed is None:
+                self.failed = asyncio.TimeoutError(
+                    f"{len(not_done)} events are not acknowledged after "
+                    + f"{config.KAFKA_DELIVERY_TIMEOUT_SEC}s"
+                )
+        if self.failed is not None:
+            raise KafkaDeliveryError(str(self.failed)) from self.failed
+
+    def clear_failed(self) -> None:
+        """Забыть ошибки отправки после перезапуска consumer"""
+        self.failed = None
+
+    async def send_kafka_topic(
+        self, topic: str, key: any, data: dict
+    ) -> asyncio.Future | None:
         """Отправить сообщение в заданный topic
 
         :param any key: route key
-        :param dict data: сообщение
+        :param dict data: сообщение, json или msgpack (MSGPACK_TOPICS)
+        :return: future подтверждения при PRODUCER_PIPELINE
         """
-        await self.send_kafka_topic_value(
+        value, headers = codec.encode(data, topic)
+        return await self.send_kafka_topic_value(
             topic=topic,
             key=key,
-            value=json.dumps(
-                data, ensure_ascii=False, default=serialize_datetime
-            ).encode(),
+            value=value,
+            headers=headers,
         )
 
     async def send_kafka(
         self, key: any, data: dict, topic: str = None
-    ) -> None:
+    ) -> asyncio.Future | None:
         """Отправить сообщение в topic
         по умолчанию
 
         :param any key: route key
         :param dict data: сообщение
+        :return: future подтверждения при PRODUCER_PIPELINE
         """
-        await self.send_kafka_topic(
+        return await self.send_kafka_topic(
             topic=topic if topic else config.DST_TOPIC, key=key, data=data
         )
 
     async def stop(self):
-        """Остановить kafka соединение и отпустить объект"""
+        """Остановить kafka соединение и отпустить объект
+
+        Очередь producer отправляется до остановки, ошибки отправки
+        сохраняются для flush()
+        """
+        await self.flush_coalesced()
         if self.producer:
             await self.producer.stop()
+            if self.deliveries:
+                await asyncio.wait(list(self.deliveries))
             del self.producer
             self.producer = None
 
@@ -1,23 +1,33 @@
 # Подключить логирование главного модуля
 import logging
 import uuid
+import contextvars
 
 from micro.singleton import MetaSingleton
 
 logger = logging.getLogger(__name__)
 
+# trace_id хранится в контексте задачи asyncio,
+# параллельно обрабатываемые сообщения не перетирают trace_id друг друга
+_trace_id: contextvars.ContextVar = contextvars.ContextVar(
+    "trace_id", default=None
+)
 
-class TRACE(metaclass=MetaSingleton):
 
-    trace_id: str
+class TRACE(metaclass=MetaSingleton):
 
     def __init__(self):
         # self.trace_id: str = "start"
-        self.new()
+        # trace_id по умолчанию, для потоков без своего контекста
+        self.default_trace_id = self.new()
+
+    @property
+    def trace_id(self) -> str:
+        return _trace_id.get() or self.default_trace_id
 
     def set(self, trace_id: str):
-        self.trace_id = trace_id
-        return self.trace_id
+        _trace_id.set(trace_id)
+        return trace_id
 
     def new(self):
         new_uuid = uuid.uuid4().hex[:12]
@@ -0,0 +1,366 @@
+"""Kafka в памяти процесса для тестов и бенчмарков
+
+Включается адресом kafka memory://, например
+SRC_BOOTSTRAP_SERVERS=memory:// и DST_BOOTSTRAP_SERVERS=memory://.
+Тогда KafkaConsumer и KafkaProducer вместо aiokafka используют
+MemoryConsumer и MemoryProducer, и весь конвейер BackgroundRunner
+работает в одном процессе без брокера.
+
+Поддерживается то, что использует micro: топики с партициями
+(MEMORY_KAFKA_PARTITIONS, создаются при первом обращении),
+смещения, группы consumer с распределением партиций
+и вызовом ConsumerRebalanceListener, фиксация смещений,
+getmany, pause/resume/seek, highwater, транзакции producer.
+Брокер один на процесс, процессы CONSUMER_WORKERS его не разделяют.
+"""
+
+import asyncio
+import logging
+import re
+import time
+import zlib
+
+from aiokafka.structs import (
+    ConsumerRecord,
+    OffsetAndMetadata,
+    RecordMetadata,
+    TopicPartition,
+)
+
+from micro.singleton import MetaSingleton
+
+import micro.config as config
+
+logger = logging.getLogger(__name__)
+
+MEMORY_URL = "memory://"
+
+
+def is_memory(bootstrap_servers) -> bool:
+    """Адрес kafka указывает на брокер в памяти"""
+    return isinstance(bootstrap_servers, str) and bootstrap_servers.startswith(
+        MEMORY_URL
+    )
+
+
+class MemoryBroker(metaclass=MetaSingleton):
+    """Брокер в памяти: топики, группы consumer, смещения групп"""
+
+    def __init__(self):
+        # topic -> [[ConsumerRecord], ...] по партициям
+        self.topics: dict = {}
+        # group_id -> {tp: offset}
+        self.committed: dict = {}
+        # group_id -> [MemoryConsumer]
+        self.groups: dict = {}
+        # Ожидающие новых сообщений getmany
+        self.waiters: set = set()
+
+    def partitions(self, topic: str) -> list:
+        """Партиции топика, если нет то создать"""
+        if topic not in self.topics:
+            self.topics[topic] = [
+                [] for _ in range(config.MEMORY_KAFKA_PARTITIONS)
+            ]
+            logger.info(f"memory kafka: created topic {topic}")
+            # Топик мог подойти под шаблон подписки
+            for group_id in self.groups:
+                self.rebalance(group_id)
+        return self.topics[topic]
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return len(self.partitions(tp.topic)[tp.partition])
+
+    async def append(
+        self,
+        topic: str,
+        key: bytes,
+        value: bytes,
+        partition: int = None,
+        headers=None,
+    ) -> RecordMetadata:
+        """Записать сообщение в топик"""
+        log = self.partitions(topic)
+        if partition is None:
+            if key is None:
+                # Без ключа - в самую короткую партицию
+                partition = min(range(len(log)), key=lambda n: len(log[n]))
+            else:
+                partition = zlib.crc32(key) % len(log)
+        records = log[partition]
+        timestamp = int(time.time() * 1000)
+        records.append(
+            ConsumerRecord(
+                topic=topic,
+                partition=partition,
+                offset=len(records),
+                timestamp=timestamp,
+                timestamp_type=0,
+                key=key,
+                value=value,
+                checksum=None,
+                serialized_key_size=len(key) if key is not None else -1,
+                serialized_value_size=(
+                    len(value) if value is not None else -1
+                ),
+                headers=tuple(headers or ()),
+            )
+        )
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        return RecordMetadata(
+            topic=topic,
+            partition=partition,
+            topic_partition=TopicPartition(topic, partition),
+            offset=len(records) - 1,
+            timestamp=timestamp,
+            timestamp_type=0,
+            log_start_offset=0,
+        )
+
+    def join(self, consumer: "MemoryConsumer") -> None:
+        self.groups.setdefault(consumer.group_id, []).append(consumer)
+        self.rebalance(consumer.group_id)
+
+    def leave(self, consumer: "MemoryConsumer") -> None:
+        members = self.groups.get(consumer.group_id, [])
+        if consumer in members:
+            members.remove(consumer)
+            self.rebalance(consumer.group_id)
+
+    def rebalance(self, group_id: str) -> None:
+        """Распределить партиции между участниками группы по кругу
+
+        Участник применяет новое распределение в следующем getmany.
+        """
+        members = self.groups.get(group_id, [])
+        plan = {member: set() for member in members}
+        tps = sorted(
+            {
+                TopicPartition(topic, partition)
+                for member in members
+                for topic in self.topics
+                if member.subscribed(topic)
+                for partition in range(len(self.topics[topic]))
+            }
+        )
+        for tp in tps:
+            candidates = [
+                member for member in members if member.subscribed(tp.topic)
+            ]
+            if candidates:
+                plan[candidates[tp.partition % len(candidates)]].add(tp)
+        for member, assignment in plan.items():
+            member.pending = assignment
+
+    def position(self, group_id: str, tp: TopicPartition, reset: str) -> int:
+        """Смещение чтения новой партиции участника группы"""
+        committed = self.committed.get(group_id, {}).get(tp)
+        if committed is not None:
+            return committed
+        return 0 if reset == "earliest" else self.highwater(tp)
+
+    def commit(self, group_id: str, offsets: dict) -> None:
+        group = self.committed.setdefault(group_id, {})
+        for tp, offset in offsets.items():
+            if isinstance(offset, OffsetAndMetadata):
+                offset = offset.offset
+            group[tp] = offset
+
+
+class MemoryConsumer:
+    """Замена AIOKafkaConsumer для брокера в памяти"""
+
+    def __init__(
+        self,
+        *topics,
+        group_id: str = None,
+        auto_offset_reset: str = "latest",
+        **kwargs,
+    ):
+        self.broker = MemoryBroker()
+        self.group_id = group_id or "memory"
+        self.auto_offset_reset = auto_offset_reset
+        self.topics: set = set(topics)
+        self.pattern = None
+        self.listener = None
+        # tp -> смещение чтения
+        self.positions: dict = {}
+        # Распределение партиций от брокера, применяется в getmany
+        self.pending: set = None
+        self.paused: set = set()
+        self.started = False
+
+    def subscribe(self, topics=(), pattern: str = None, listener=None):
+        self.topics = set(topics)
+        self.pattern = re.compile(pattern) if pattern else None
+        self.listener = listener
+        for topic in self.topics:
+            self.broker.partitions(topic)
+        if self.started:
+            self.broker.rebalance(self.group_id)
+
+    def subscribed(self, topic: str) -> bool:
+        if topic in self.topics:
+            return True
+        return bool(self.pattern and self.pattern.fullmatch(topic))
+
+    async def start(self) -> None:
+        self.started = True
+        self.broker.join(self)
+        await self.apply_assignment()
+
+    async def stop(self) -> None:
+        if self.started:
+            self.started = False
+            if self.listener and self.positions:
+                await self.listener.on_partitions_revoked(
+                    set(self.positions)
+                )
+            self.broker.leave(self)
+            self.positions = {}
+
+    async def apply_assignment(self) -> None:
+        """Применить новое распределение партиций группы"""
+        if self.pending is None:
+            return
+        assignment, self.pending = self.pending, None
+        revoked = set(self.positions) - assignment
+        assigned = assignment - set(self.positions)
+        if self.listener and revoked:
+            await self.listener.on_partitions_revoked(revoked)
+        for tp in revoked:
+            self.positions.pop(tp, None)
+            self.paused.discard(tp)
+        for tp in assigned:
+            self.positions[tp] = self.broker.position(
+                self.group_id, tp, self.auto_offset_reset
+            )
+        if self.listener and assigned:
+            await self.listener.on_partitions_assigned(assigned)
+
+    def assignment(self) -> set:
+        return set(self.positions)
+
+    def pause(self, *partitions) -> None:
+        self.paused.update(partitions)
+
+    def resume(self, *partitions) -> None:
+        self.paused.difference_update(partitions)
+
+    def seek(self, tp: TopicPartition, offset: int) -> None:
+        self.positions[tp] = offset
+
+    def highwater(self, tp: TopicPartition) -> int:
+        return self.broker.highwater(tp)
+
+    async def commit(self, offsets: dict = None) -> None:
+        if offsets is None:
+            offsets = dict(self.positions)
+        self.broker.commit(self.group_id, offsets)
+
+    async def committed(self, tp: TopicPartition) -> int | None:
+        return self.broker.committed.get(self.group_id, {}).get(tp)
+
+    def fetch(self, max_records: int = None) -> dict:
+        """Прочитать доступные сообщения не приостановленных партиций"""
+        result = {}
+        left = max_records or float("inf")
+        for tp in sorted(self.positions):
+            if tp in self.paused or left <= 0:
+                continue
+            records = self.broker.partitions(tp.topic)[tp.partition]
+            position = self.positions[tp]
+            end = int(min(len(records), position + left))
+            if end > position:
+                result[tp] = records[position:end]
+                self.positions[tp] = end
+                left -= end - position
+        return result
+
+    async def getmany(self, timeout_ms: int = 0, max_records: int = None):
+        await self.apply_assignment()
+        result = self.fetch(max_records)
+        if result or not timeout_ms:
+            return result
+        deadline = time.monotonic() + timeout_ms / 1000
+        while not result:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            waiter = asyncio.get_running_loop().create_future()
+            self.broker.waiters.add(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            except TimeoutError:
+                pass
+            finally:
+                self.broker.waiters.discard(waiter)
+            await self.apply_assignment()
+            result = self.fetch(max_records)
+        return result
+
+
+class MemoryProducer:
+    """Замена AIOKafkaProducer для брокера в памяти
+
+    С transactional_id сообщения транзакции записываются в топики
+    и смещения группы фиксируются только в commit_transaction.
+    """
+
+    def __init__(self, transactional_id: str = None, **kwargs):
+        self.broker = MemoryBroker()
+        self.transactional_id = transactional_id
+        # Сообщения и смещения открытой транзакции
+        self.transaction: list = None
+        self.offsets: dict = {}
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        if self.transaction is not None:
+            await self.abort_transaction()
+
+    async def flush(self) -> None:
+        pass
+
+    async def begin_transaction(self) -> None:
+        if self.transaction is not None:
+            raise RuntimeError("transaction is already in progress")
+        self.transaction, self.offsets = [], {}
+
+    async def send_offsets_to_transaction(self, offsets, group_id) -> None:
+        self.offsets.setdefault(group_id, {}).update(offsets)
+
+    async def commit_transaction(self) -> None:
+        messages, self.transaction = self.transaction, None
+        for future, args, kwargs in messages:
+            future.set_result(await self.broker.append(*args, **kwargs))
+        for group_id, offsets in self.offsets.items():
+            self.broker.commit(group_id, offsets)
+        self.offsets = {}
+
+    async def abort_transaction(self) -> None:
+        messages, self.transaction = self.transaction or [], None
+        for future, args, kwargs in messages:
+            future.cancel()
+        self.offsets = {}
+
+    async def send(
+        self, topic, value=None, key=None, partition=None, headers=None, **kw
+    ) -> asyncio.Future:
+        """Записать сообщение, вернуть future с RecordMetadata"""
+        future = asyncio.get_running_loop().create_future()
+        args = (topic, key, value)
+        kwargs = {"partition": partition, "headers": headers}
+        if self.transaction is not None:
+            # Запишется при фиксации транзакции
+            self.transaction.append((future, args, kwargs))
+        else:
+            future.set_result(await self.broker.append(*args, **kwargs))
+        return future
+
+    async def send_and_wait(self, topic, value=None, key=None, **kwargs):
+        return await (await self.send(topic, value=value, key=key, **kwargs))
@@ -1,4 +1,4 @@
-from prometheus_client import Counter
+from prometheus_client import Counter, Gauge, Histogram
 
 API_YCLIENTS_POST_REQUEST_CNT: Counter = Counter(
     "api_yclients_post_request_cnt", "Count send post request to api yclients"
@@ -44,3 +44,144 @@ PG_UPDATES: Counter = Counter(
     "Count update/insert/delete records postgres local base",
     ["method"],
 )
+
+CONSUMER_BATCH_MAX_RECORDS: Gauge = Gauge(
+    "consumer_batch_max_records",
+    "Current max_records of the consumer poll",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_BATCH_HANDLER_SECONDS: Gauge = Gauge(
+    "consumer_batch_handler_seconds",
+    "Handler time of the last consumed batch",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_COMMIT_SECONDS: Histogram = Histogram(
+    "consumer_commit_seconds",
+    "Latency of consumer offset commits",
+)
+
+CONSUMER_COMMIT_ERROR_CNT: Counter = Counter(
+    "consumer_commit_error_cnt",
+    "Count of failed consumer offset commits",
+)
+
+CONSUMER_PAUSED_PARTITIONS: Gauge = Gauge(
+    "consumer_paused_partitions",
+    "Count of partitions paused by consumer backpressure",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_INFLIGHT_MESSAGES: Gauge = Gauge(
+    "consumer_inflight_messages",
+    "Count of consumed messages not yet processed",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_INFLIGHT_BYTES: Gauge = Gauge(
+    "consumer_inflight_bytes",
+    "Size of consumed messages not yet processed",
+    multiprocess_mode="liveall",
+)
+
+EVENT_HANDLER_INFLIGHT: Gauge = Gauge(
+    "event_handler_inflight",
+    "Count of events being processed by the event handler",
+    ["event"],
+    multiprocess_mode="liveall",
+)
+
+EVENT_HANDLER_TIMEOUT_CNT: Counter = Counter(
+    "event_handler_timeout_cnt",
+    "Count of events the event handler timed out on",
+    ["event"],
+)
+
+EVENT_HANDLER_SECONDS: Histogram = Histogram(
+    "event_handler_seconds",
+    "Time of processing one event by the event handler",
+    ["event"],
+)
+
+EVENTS_PARKED_CNT: Counter = Counter(
+    "events_parked_cnt",
+    "Count of dlq events that ran out of attempts",
+)
+
+DLQ_DELAYED_PARTITIONS: Gauge = Gauge(
+    "dlq_delayed_partitions",
+    "Count of dlq partitions waiting for the retry time",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_LANE_LAG: Gauge = Gauge(
+    "consumer_lane_lag",
+    "Count of messages behind the high watermark for the consumer lane",
+    ["lane"],
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_LANE_MESSAGES_CNT: Counter = Counter(
+    "consumer_lane_messages_cnt",
+    "Count of messages consumed by the consumer lane",
+    ["lane"],
+)
+
+EVENTS_DUPLICATE_CNT: Counter = Counter(
+    "events_duplicate_cnt",
+    "Count of already processed incoming events skipped by uuid",
+)
+
+CONSUMER_WORKERS_ALIVE: Gauge = Gauge(
+    "consumer_workers_alive",
+    "Count of alive consumer worker processes",
+    multiprocess_mode="liveall",
+)
+
+CONSUMER_WORKER_RESTART_CNT: Counter = Counter(
+    "consumer_worker_restart_cnt",
+    "Count of consumer worker process restarts by the supervisor",
+)
+
+PRODUCER_DELIVERY_SECONDS: Histogram = Histogram(
+    "producer_delivery_seconds",
+    "Time from queueing an event to the producer until broker ack",
+)
+
+PRODUCER_INFLIGHT_DELIVERIES: Gauge = Gauge(
+    "producer_inflight_deliveries",
+    "Count of events queued to the producer and not yet acknowledged",
+    multiprocess_mode="liveall",
+)
+
+PRODUCER_DELIVERY_ERROR_CNT: Counter = Counter(
+    "producer_delivery_error_cnt",
+    "Count of events the broker failed to acknowledge",
+)
+
+KAFKA_TRANSACTION_SECONDS: Histogram = Histogram(
+    "kafka_transaction_seconds",
+    "Time of processing a partition batch in a kafka transaction",
+)
+
+KAFKA_TRANSACTION_ABORT_CNT: Counter = Counter(
+    "kafka_transaction_abort_cnt",
+    "Count of aborted kafka transactions",
+)
+
+OUTBOX_RELAYED_CNT: Counter = Counter(
+    "outbox_relayed_cnt",
+    "Count of events sent from the outbox table into kafka",
+)
+
+OUTBOX_RELAY_ERROR_CNT: Counter = Counter(
+    "outbox_relay_error_cnt",
+    "Count of failed outbox relay batches",
+)
+
+EVENTS_COALESCED_CNT: Counter = Counter(
+    "events_coalesced_cnt",
+    "Count of unsent events replaced by a later event with the same key",
+    ["event"],
+)
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import logging
-from typing import List
+from typing import ClassVar, List
 
 from pydantic import Field, BaseModel
 
@@ -343,12 +343,17 @@ class BotBaseTopic(HeaderEvent):
 class BotUpdateTopic(BotBaseTopic):
     """Создать новый топик, если нету или обновить текущий"""
 
+    coalesce_window_ms: ClassVar[int] = 200
+
     # fmt: off
     dialogues_id: int = Field(..., description="Идентификатор диалога")  # noqa
     caption: str = Field(..., description="Наименование топика")  # noqa
     emoji: str | None = Field(None, description="Emoji")  # noqa
     # fmt: on
 
+    def coalesce_key(self):
+        return (self.chat_id, self.dialogues_id)
+
 
 class BotSendTextTopic(BotSendBase):
     """Послать сообщение в topic"""
@@ -1,4 +1,5 @@
 from __future__ import annotations
+from typing import ClassVar
 from pydantic import Field
 from datetime import datetime
 from micro.models.header_event import HeaderEvent
@@ -6,6 +7,8 @@ from micro.models.header_event import HeaderEvent
 
 class UpdatedClient(HeaderEvent):
 
+    coalesce_window_ms: ClassVar[int] = 200
+
     # fmt: off
     client_id: int = Field(..., description="Идентификатор клиента",)  # noqa
     # fmt: on
@@ -26,6 +29,8 @@ class UpdatedLead(HeaderEvent):
 
 class ClientStatusChanged(HeaderEvent):
 
+    coalesce_window_ms: ClassVar[int] = 200
+
     # fmt: off
     client_id: int = Field(..., description="Идентификатор клиента",)  # noqa
     from_state: str | None = Field(None, description="Переход из статуса клиента",)  # noqa
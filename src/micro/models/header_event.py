@@ -4,11 +4,23 @@ import logging
 
 import datetime
 from datetime import UTC
+import time
+import types
+import typing
 import uuid
 
-from pydantic import Field, BaseModel
+from pydantic import (
+    Field,
+    BaseModel,
+    PrivateAttr,
+    ValidationInfo,
+    model_validator,
+)
 
 from micro.kafka_producer import KafkaProducer
+from micro.outbox import Outbox
+from micro.transactions import current_transaction
+from micro import codec
 from micro.logging_trace import TRACE
 
 import micro.config as config
@@ -64,6 +76,91 @@ class Addresse(BaseModel):
     # fmt: on
 
 
+# Типы, которые model_dump_json пишет так же, как json.dumps.
+# float нет: NaN и Infinity pydantic пишет как null, а 1e+20 как 1e20
+_JSON_NATIVE = (str, int, bool, type(None))
+
+# Сериализаторы событий в bytes по (класс, JSON_COMPACT)
+_serializers: dict = {}
+
+
+def _json_native(annotation, seen: set) -> bool:
+    """Значения типа сериализуются pydantic в json без отличий
+    от json.dumps(model_dump(), default=serialize_datetime)"""
+    if annotation in _JSON_NATIVE:
+        return True
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return _model_json_native(annotation, seen)
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+    if origin is typing.Annotated:
+        return _json_native(args[0], seen)
+    if origin is typing.Literal:
+        return all(isinstance(arg, _JSON_NATIVE) for arg in args)
+    if origin in (typing.Union, types.UnionType, list, tuple):
+        return all(
+            arg is Ellipsis or _json_native(arg, seen) for arg in args
+        )
+    if origin is dict:
+        return args[0] is str and _json_native(args[1], seen)
+    # datetime, timedelta, Enum, Any и прочие - через model_dump
+    return False
+
+
+def _model_json_native(cls: type, seen: set) -> bool:
+    if cls in seen:
+        return True
+    seen.add(cls)
+    decorators = cls.__pydantic_decorators__
+    if (
+        decorators.field_serializers
+        or decorators.model_serializers
+        or cls.model_config.get("extra") == "allow"
+    ):
+        return False
+    return all(
+        _json_native(field.annotation, seen)
+        for field in cls.model_fields.values()
+    ) and all(
+        _json_native(field.return_type, seen)
+        for field in cls.model_computed_fields.values()
+    )
+
+
+def _struct(cls: type, **values) -> BaseModel:
+    """Объект модели без валидации и значений по умолчанию,
+    values - все поля модели"""
+    obj = cls.__new__(cls)
+    object.__setattr__(obj, "__dict__", values)
+    object.__setattr__(obj, "__pydantic_fields_set__", set(values))
+    object.__setattr__(obj, "__pydantic_extra__", None)
+    object.__setattr__(obj, "__pydantic_private__", None)
+    return obj
+
+
+def serializer(cls: type) -> typing.Callable[[BaseModel], bytes]:
+    """Сериализатор события класса cls в bytes для kafka
+
+    По умолчанию через model_dump() и micro.codec, побайтно
+    как json.dumps. При JSON_COMPACT, если все поля - типы json
+    (str, int, bool, None и модели из них), событие пишется в bytes
+    сериализатором pydantic без промежуточного dict и без пробелов
+    между элементами, иначе (float, datetime, Enum...) через model_dump().
+    """
+    key = (cls, config.JSON_COMPACT)
+    func = _serializers.get(key)
+    if func is None:
+        if config.JSON_COMPACT and _model_json_native(cls, set()):
+            func = cls.__pydantic_serializer__.to_json
+        else:
+
+            def func(obj: BaseModel) -> bytes:
+                return codec.dumps(obj.model_dump())
+
+        _serializers[key] = func
+    return func
+
+
 class HeaderEvent(BaseModel):
     """
     Базовый класс события с заголовком и адресатом.
@@ -81,6 +178,27 @@ class HeaderEvent(BaseModel):
     addresse: Addresse | None = Field(None, description="Получатель сообщения") # noqa
     # fmt: on
 
+    # Время создания события в kafka, передается в контексте валидации
+    _create_event_timestamp: str | None = PrivateAttr(None)
+
+    # Окно объединения событий, мс (PRODUCER_COALESCE): из событий
+    # класса с одним coalesce_key() за окно отправляется последнее
+    coalesce_window_ms: typing.ClassVar[int | None] = None
+
+    @model_validator(mode="after")
+    def _set_context(self, info: ValidationInfo):
+        """Взять из контекста валидации время создания события"""
+        if info.context:
+            self._create_event_timestamp = info.context.get(
+                "create_event_timestamp"
+            )
+        return self
+
+    @property
+    def create_event_timestamp(self) -> str | None:
+        """Время создания события в kafka "%d.%m.%Y %H:%M:%S" """
+        return self._create_event_timestamp
+
     def route_key(self):
         """
         Формирует ключ маршрутизации для Kafka topic partition.
@@ -99,10 +217,85 @@ class HeaderEvent(BaseModel):
             or "na"
         )
 
+    def encode(self, topic: str) -> tuple:
+        """Событие в формате топика: (bytes, заголовки kafka или None)"""
+        if codec.is_msgpack_topic(topic):
+            return (
+                codec.msgpack_dumps(self.model_dump()),
+                codec.MSGPACK_HEADERS,
+            )
+        return serializer(self.__class__)(self), None
+
+    def coalesce_key(self):
+        """Ключ объединения событий, по умолчанию route_key()"""
+        return self.route_key()
+
     async def deserialization(self):
         """Абстрактный метод десереализации"""
         pass
 
+    def stamp(
+        self,
+        desc: str = None,
+        version: str = None,
+        client_id: str = None,
+        addresse: Addresse = None,
+        chat_id: str = None,
+        channel: str = None,
+        contact_id: str = None,
+        parent: object = None,
+        now: float = None,
+    ) -> None:
+        """Сформировать заголовок и получателя события перед отправкой
+
+        Параметры как у send(), now - время события time.time()
+        """
+        # Дата сообщения, один отсчет часов для utc и локального времени
+        if now is None:
+            now = time.time()
+        # идентификатор текущего события
+        event_uuid = str(uuid.uuid4())
+        # Заголовок сообщения, поля не требуют валидации
+        self.header = _struct(
+            Header,
+            # Время события в utc
+            utc=datetime.datetime.fromtimestamp(now, UTC).isoformat(),
+            # Локальное время события
+            datetime=datetime.datetime.fromtimestamp(now).isoformat(),
+            # Тип события, как название класса
+            event=self.__class__.__name__,
+            uuid=event_uuid,
+            # Взять родителя сообщения, если первое сообщение в цепочке,
+            # то родителя не ставим
+            parent=(
+                parent.header.uuid
+                if parent and hasattr(parent.header, "uuid")
+                else None
+            ),
+            # Строим цепочку сообщений (distributed tracing)
+            # Если задан родитель в отправке, то из него взять значение
+            root=(
+                parent.header.root
+                if parent and hasattr(parent.header, "root")
+                else event_uuid
+            ),
+            # Описание события
+            desc=desc,
+            # Версия события
+            version=version,
+            # источник сообщения
+            source=config.PRODUCER_ID,
+            # Идентификатор trace_id
+            trace_id=TRACE().trace_id,
+        )
+        # Получатель сообщения, значения вызывающего - с валидацией
+        self.addresse = addresse or Addresse(
+            client_id=client_id,
+            chat_id=chat_id,
+            channel=channel,
+            contact_id=contact_id,
+        )
+
     async def send(
         self,
         key: any = None,
@@ -115,12 +308,14 @@ class HeaderEvent(BaseModel):
         contact_id: str = None,
         parent: object = None,
         topic: str = None,
+        outbox=None,
     ) -> None:
         """
         Отправляет событие в Kafka с авто-генерацией заголовка.
 
         Формирует Header (uuid, timestamps, trace-chain) и Recipient,
-        затем сериализует объект и отправляет через KafkaProducer.
+        затем сериализует объект в bytes сериализатором класса
+        (serializer) и отправляет через KafkaProducer.
 
         Args:
             key: Ключ маршрутизации (переопределяет route_key()).
@@ -132,6 +327,10 @@ class HeaderEvent(BaseModel):
             chat_id: ID Telegram-чата (если не задан addresse).
             channel: ID Telegram-канала (если не задан addresse).
             parent: Родительское событие для построения цепочки (parent/root).
+            outbox: Транзакция вызывающего: список запросов, в который
+              добавляется запись события в таблицу outbox (выполнить
+              через DB().execute(outbox)), или курсор
+              DB().transaction(), которым событие записывается сразу.
 
         Returns:
             None
@@ -141,59 +340,109 @@ class HeaderEvent(BaseModel):
             - Логгирует факт отправки.
             - Модифицирует self.header и self.addresse.
         """
-        # Дата сообщения
-        now_utc = datetime.datetime.now(UTC)
-        now_local = datetime.datetime.now()
-        # Заголовок сообщения
-        self.header = Header(
-            # Время события в utc
-            utc=now_utc.isoformat(),
-            # Локальное время события
-            datetime=now_local.isoformat(),
-            # Тип события, как название класса
-            event=self.__class__.__name__,
-            # идентификатор текущего события
-            uuid=str(uuid.uuid4()),
-            # Описание события
+        self.stamp(
             desc=desc,
-            # Версия события
             version=version,
-            # источник сообщения
-            source=config.PRODUCER_ID,
-            # Идентификатор trace_id
-            trace_id=TRACE().trace_id,
-        )
-        # Получатель сообщения
-        self.addresse = addresse or Addresse(
             client_id=client_id,
+            addresse=addresse,
             chat_id=chat_id,
             channel=channel,
             contact_id=contact_id,
+            parent=parent,
         )
-        # Строим цепочку сообщений (distributed tracing)
-        # Сформировать атрибут для цепочки сообщений
-        # Если задан родитель в отправке, то из него взять значение
-        self.header.root = (
-            parent.header.root
-            if parent and hasattr(parent.header, "root")
-            else self.header.uuid
-        )
-        # Взять родителя сообщения, если первое сообщение в цепочке,
-        # то родителя не ставим
-        self.header.parent = (
-            parent.header.uuid
-            if parent and hasattr(parent.header, "uuid")
-            else None
-        )
-        # Отправить сообщение, если не задан ключ,
-        # то взять от даты псевдослучайное число
-        await KafkaProducer().send_kafka(
-            key=key or self.route_key(), data=self.dict(), topic=topic
-        )
+        topic = topic if topic else config.DST_TOPIC
+        value, headers = self.encode(topic)
+        if outbox is not None or config.OUTBOX:
+            # Событие отправит фоновая задача outbox
+            await Outbox().put(
+                topic=topic,
+                key=key or self.route_key(),
+                value=value,
+                queries=outbox,
+                headers=headers,
+            )
+        elif (
+            config.PRODUCER_COALESCE
+            and self.coalesce_window_ms
+            and current_transaction.get() is None
+        ):
+            # Отправится по окончании окна, если не заменят
+            await KafkaProducer().coalesce(
+                topic=topic,
+                key=key or self.route_key(),
+                value=value,
+                event=self.__class__.__name__,
+                coalesce_key=self.coalesce_key(),
+                window_ms=self.coalesce_window_ms,
+                headers=headers,
+            )
+        else:
+            # Отправить сообщение, если не задан ключ,
+            # то взять от даты псевдослучайное число
+            await KafkaProducer().send_kafka_topic_value(
+                topic=topic,
+                key=key or self.route_key(),
+                value=value,
+                headers=headers,
+            )
         logger.info(
             f'send event "{self.header.event}" with uuid={self.header.uuid}'
         )
 
+    @staticmethod
+    async def send_many(
+        events: list,
+        parent: object = None,
+        topic: str = None,
+        outbox=None,
+        **kwargs,
+    ) -> list:
+        """
+        Отправляет список событий в Kafka одним пакетом.
+
+        Заголовки формируются как в send() (uuid, время, parent/root
+        от parent), события сериализуются и ставятся в очередь
+        producer все сразу, подтверждение ожидается один раз в конце.
+
+        Args:
+            events: События или пары (событие, dict параметров send()
+              для этого события, например {"chat_id": ...}).
+            parent: Родительское событие для всех событий списка.
+            topic: Топик, по умолчанию DST_TOPIC.
+            outbox: Транзакция вызывающего, см. send().
+            **kwargs: Параметры send() для всех событий
+              (desc, version, client_id, addresse, chat_id...).
+
+        Returns:
+            list: Ошибка отправки каждого события или None.
+        """
+        topic = topic if topic else config.DST_TOPIC
+        now = time.time()
+        records = []
+        for item in events:
+            event, params = item if isinstance(item, tuple) else (item, {})
+            params = {**kwargs, **params}
+            key = params.pop("key", None)
+            event.stamp(parent=parent, now=now, **params)
+            records.append((key or event.route_key(), *event.encode(topic)))
+        if outbox is not None or config.OUTBOX:
+            for key, value, headers in records:
+                await Outbox().put(
+                    topic=topic,
+                    key=key,
+                    value=value,
+                    queries=outbox,
+                    headers=headers,
+                )
+            errors = [None] * len(records)
+        else:
+            errors = await KafkaProducer().send_batch(
+                topic=topic, records=records
+            )
+        failed = len(records) - errors.count(None)
+        logger.info(f"send {len(records)} events, failed {failed}")
+        return errors
+
 
 class PrintBaseEvent(HeaderEvent):
     """Базовое событие для генерации отчетов (сотрудник/админ).
@@ -0,0 +1,209 @@
+import asyncio
+import base64
+import logging
+
+from micro.singleton import MetaSingleton
+from micro.pg import DB
+from micro.kafka_producer import KafkaProducer
+from micro import codec
+
+import micro.config as config
+
+from micro.metrics import (
+    EVENTS_SENT_CNT,
+    OUTBOX_RELAYED_CNT,
+    OUTBOX_RELAY_ERROR_CNT,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox(metaclass=MetaSingleton):
+    """Отправка событий через таблицу OUTBOX_TABLE
+
+    HeaderEvent.send(outbox=queries) добавляет в список запросов
+    insert события, вызывающий выполняет его вместе со своими
+    изменениями одной транзакцией: DB().execute(queries).
+    HeaderEvent.send(outbox=acur) выполняет insert курсором
+    транзакции вызывающего: async with DB().transaction() as acur.
+    При OUTBOX=true send() без outbox пишет событие в таблицу
+    отдельным insert вне транзакции вызывающего, не атомарно
+    с его изменениями, об этом предупреждает лог.
+    relay() - фоновая задача: забирает события пакетами
+    по OUTBOX_BATCH_SIZE коротким update locked_until (for update
+    skip locked, несколько экземпляров сервиса не мешают друг другу),
+    отправляет их в kafka без ожидания каждого и без открытой
+    транзакции, дожидается подтверждения всех и удаляет пакет одним
+    delete. Пакет, не удаленный за OUTBOX_LEASE_SEC, забирается снова.
+    Гарантия at-least-once: при ошибке отправки пакет отправится
+    повторно целиком.
+    """
+
+    def __init__(self):
+        self.table_ready: bool = False
+        # Предупреждение о записи вне транзакции вызывающего выведено
+        self.warned: bool = False
+
+    async def create_table(self) -> None:
+        if self.table_ready:
+            return
+        await DB().execute(
+            f"""
+            create table if not exists {config.OUTBOX_TABLE} (
+                id bigserial primary key,
+                topic text not null,
+                key text,
+                value bytea not null,
+                headers jsonb,
+                created_at timestamptz not null default now(),
+                locked_until timestamptz
+            )"""
+        )
+        # Таблица прежней версии
+        await DB().execute(
+            f"""
+            alter table {config.OUTBOX_TABLE}
+            add column if not exists headers jsonb,
+            add column if not exists locked_until timestamptz"""
+        )
+        self.table_ready = True
+
+    @staticmethod
+    def query(topic: str, key: any, value: bytes, headers=None) -> dict:
+        """Запрос записи события в формате списка DB().execute
+
+        :param headers: заголовки kafka [(имя, bytes)], хранятся в json
+            как [имя, base64]
+        """
+        return {
+            "sql": f"""
+            insert into {config.OUTBOX_TABLE} (topic, key, value, headers)
+            values (%(topic)s, %(key)s, %(value)s, %(headers)s::jsonb)""",
+            "params": {
+                "topic": topic,
+                "key": str(key) if key else None,
+                "value": value,
+                "headers": (
+                    codec.dumps(
+                        [
+                            [name, base64.b64encode(data).decode()]
+                            for name, data in headers
+                        ]
+                    ).decode()
+                    if headers
+                    else None
+                ),
+            },
+        }
+
+    async def put(
+        self,
+        topic: str,
+        key: any,
+        value: bytes,
+        queries=None,
+        headers=None,
+    ) -> None:
+        """Записать событие в таблицу
+
+        :param queries: транзакция вызывающего: список запросов
+            DB().execute, в который добавить запрос, или курсор
+            DB().transaction(), которым выполнить запрос.
+            Без транзакции запрос выполняется сразу отдельно
+        :param headers: заголовки kafka [(имя, bytes)]
+        """
+        await self.create_table()
+        query = self.query(topic or config.DST_TOPIC, key, value, headers)
+        if isinstance(queries, list):
+            queries.append(query)
+        elif queries is not None:
+            await queries.execute(query["sql"], query["params"])
+        else:
+            if not self.warned:
+                self.warned = True
+                logger.warning(
+                    "outbox event is written outside of caller transaction,"
+                    + " pass outbox= to send() to write it atomically"
+                )
+            await DB().execute(query["sql"], query["params"])
+
+    async def relay_batch(self) -> int:
+        """Отправить в kafka один пакет событий таблицы
+
+        :return int: отправлено событий
+        """
+        await self.create_table()
+        producer = KafkaProducer()
+        # Забрать пакет, транзакция только на время update
+        async with DB().transaction() as acur:
+            await acur.execute(
+                f"""
+                update {config.OUTBOX_TABLE}
+                set locked_until = now() + make_interval(secs => %(lease)s)
+                where id in (
+                    select id from {config.OUTBOX_TABLE}
+                    where locked_until is null or locked_until < now()
+                    order by id
+                    limit %(limit)s
+                    for update skip locked
+                )
+                returning id, topic, key, value, headers""",
+                {
+                    "lease": config.OUTBOX_LEASE_SEC,
+                    "limit": config.OUTBOX_BATCH_SIZE,
+                },
+            )
+            rows = sorted(await acur.fetchall(), key=lambda row: row["id"])
+        if not rows:
+            return 0
+        ids = [row["id"] for row in rows]
+        try:
+            if not producer.producer:
+                await producer.start(rows[0]["topic"])
+            deliveries = [
+                await producer.producer.send(
+                    topic=row["topic"],
+                    key=row["key"].encode() if row["key"] else None,
+                    value=bytes(row["value"]),
+                    headers=[
+                        (name, base64.b64decode(data))
+                        for name, data in row["headers"] or ()
+                    ]
+                    or None,
+                )
+                for row in rows
+            ]
+            await asyncio.wait_for(
+                asyncio.gather(*deliveries),
+                timeout=config.KAFKA_DELIVERY_TIMEOUT_SEC,
+            )
+        except Exception:
+            # Вернуть пакет, не дожидаясь окончания OUTBOX_LEASE_SEC
+            await DB().execute(
+                f"""
+                update {config.OUTBOX_TABLE} set locked_until = null
+                where id = any(%(ids)s)""",
+                {"ids": ids},
+            )
+            raise
+        await DB().execute(
+            f"delete from {config.OUTBOX_TABLE} where id = any(%(ids)s)",
+            {"ids": ids},
+        )
+        EVENTS_SENT_CNT.inc(len(rows))
+        OUTBOX_RELAYED_CNT.inc(len(rows))
+        return len(rows)
+
+    async def relay(self) -> None:
+        """Фоновая задача отправки событий таблицы"""
+        logger.info(f"start outbox relay {config.OUTBOX_TABLE}")
+        while True:
+            try:
+                count = await self.relay_batch()
+            except Exception as e:
+                OUTBOX_RELAY_ERROR_CNT.inc()
+                logger.error(f"outbox relay failed {e}")
+                count = 0
+            # Полный пакет - сразу следующий
+            if count < config.OUTBOX_BATCH_SIZE:
+                await asyncio.sleep(config.OUTBOX_POLL_MS / 1000)
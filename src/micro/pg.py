@@ -1,3 +1,4 @@
+import contextlib
 import logging
 import psycopg_pool
 from psycopg.rows import dict_row
@@ -65,6 +66,15 @@ class DB(metaclass=MetaSingleton):
                     await acur.execute(query, params)
                     return acur.rowcount
 
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """Курсор в транзакции, commit при выходе без ошибки"""
+        await self.open_pool()
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                async with conn.cursor() as acur:
+                    yield acur
+
     async def returning(self, query, params=None):
         await self.open_pool()
         async with self.pool.connection() as conn:
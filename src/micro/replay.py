@@ -0,0 +1,369 @@
+"""Прогон записанных сообщений kafka через capture()
+
+Записать сообщения топика в файл json lines:
+
+    python -m micro.replay dump --topic events --start 1000 --end 2000 \
+        events.jsonl
+
+Прогнать файл через обработчики сервиса (модуль main регистрирует
+обработчики), в 10 раз быстрее записи, 4 сообщения одновременно:
+
+    python -m micro.replay events.jsonl --module main --speed 10 \
+        --concurrency 4
+
+--speed 0 - без пауз между сообщениями. Отправляемые обработчиками
+события не уходят в kafka, а пишутся в kafka в памяти
+(micro.memory_kafka), --output сохраняет их в файл.
+На время прогона выключаются OUTBOX, KAFKA_TRANSACTIONS и DEDUP:
+события не попадают в таблицу outbox и транзакции рабочей kafka,
+записанные сообщения не пропускаются как уже обработанные.
+В конце выводится число сообщений, пропускная способность
+и задержки p50/p95/p99 по типам событий.
+"""
+
+import argparse
+import asyncio
+import base64
+import importlib
+import logging
+import math
+import sys
+import time
+
+from aiokafka import AIOKafkaConsumer
+from aiokafka.structs import ConsumerRecord, TopicPartition
+
+import micro.config as config
+
+from micro import codec
+from micro.dedup import Dedup
+from micro.kafka_consumer import EventMessage, capture
+from micro.kafka_producer import KafkaProducer
+from micro.memory_kafka import MemoryBroker, MemoryProducer
+
+logger = logging.getLogger(__name__)
+
+
+def record_to_line(record) -> dict:
+    """Сообщение kafka как строка файла"""
+    line = {
+        "topic": record.topic,
+        "partition": record.partition,
+        "offset": record.offset,
+        "timestamp": record.timestamp,
+        "key": record.key.decode() if record.key is not None else None,
+    }
+    try:
+        line["value"] = record.value.decode()
+    except UnicodeDecodeError:
+        line["value_b64"] = base64.b64encode(record.value).decode()
+    if record.headers:
+        line["headers"] = [
+            [name, base64.b64encode(value).decode()]
+            for name, value in record.headers
+        ]
+    return line
+
+
+def line_to_record(line: dict) -> ConsumerRecord:
+    """Строка файла как сообщение kafka"""
+    if "value_b64" in line:
+        value = base64.b64decode(line["value_b64"])
+    else:
+        value = line["value"].encode()
+    key = line["key"].encode() if line.get("key") is not None else None
+    return ConsumerRecord(
+        topic=line.get("topic", "replay"),
+        partition=line.get("partition", 0),
+        offset=line.get("offset", 0),
+        timestamp=line.get("timestamp") or int(time.time() * 1000),
+        timestamp_type=0,
+        key=key,
+        value=value,
+        checksum=None,
+        serialized_key_size=len(key) if key is not None else -1,
+        serialized_value_size=len(value),
+        headers=tuple(
+            (name, base64.b64decode(data))
+            for name, data in line.get("headers", ())
+        ),
+    )
+
+
+def read_records(path: str):
+    with open(path) as f:
+        for text in f:
+            if text.strip():
+                yield line_to_record(codec.loads(text))
+
+
+def percentile(values: list, p: float) -> float:
+    """Процентиль p (0..1) отсортированного списка"""
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p * len(values)) - 1)]
+
+
+def report(latencies: dict, elapsed: float) -> list:
+    """Статистика по типам событий: число, сообщений/сек, задержки, мс"""
+    rows = []
+    for event_name, values in sorted(latencies.items()):
+        values = sorted(values)
+        rows.append(
+            {
+                "event": event_name,
+                "count": len(values),
+                "per_sec": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": percentile(values, 0.50) * 1000,
+                "p95_ms": percentile(values, 0.95) * 1000,
+                "p99_ms": percentile(values, 0.99) * 1000,
+            }
+        )
+    return rows
+
+
+async def replay(
+    path: str,
+    speed: float = 0,
+    concurrency: int = 1,
+    events=None,
+) -> dict:
+    """Прогнать сообщения файла через capture()
+
+    :param str path: файл json lines
+    :param float speed: ускорение относительно записи, 0 - без пауз
+    :param int concurrency: сколько сообщений обрабатывать одновременно
+    :param events: legacy обработчики Events
+    :return dict: {"elapsed", "events": report(), "errors", "produced"}
+    """
+    # Отправляемые события - в kafka в памяти
+    producer = KafkaProducer()
+    producer.producer = MemoryProducer()
+    broker = MemoryBroker()
+    # Без рабочих outbox, транзакций и dedup
+    dedup = Dedup()
+    saved = (
+        config.OUTBOX,
+        config.KAFKA_TRANSACTIONS,
+        dedup.enabled,
+        dedup.postgres,
+    )
+    config.OUTBOX = config.KAFKA_TRANSACTIONS = False
+    dedup.enabled = dedup.postgres = False
+    try:
+        return await run_replay(path, speed, concurrency, events, broker)
+    finally:
+        (
+            config.OUTBOX,
+            config.KAFKA_TRANSACTIONS,
+            dedup.enabled,
+            dedup.postgres,
+        ) = saved
+
+
+async def run_replay(
+    path: str, speed: float, concurrency: int, events, broker
+) -> dict:
+    """Прогон файла, параметры и результат как у replay()"""
+    latencies: dict = {}
+    errors = 0
+    workers = asyncio.Semaphore(concurrency)
+
+    async def handle(record):
+        nonlocal errors
+        try:
+            event_name = EventMessage(
+                record.value, headers=record.headers
+            ).event_name()
+        except ValueError:
+            event_name = None
+        started = time.perf_counter()
+        try:
+            await capture(record, events=events)
+        except Exception as e:
+            errors += 1
+            logger.error(f"replay {record.offset} failed: {e}")
+        finally:
+            latencies.setdefault(event_name or "unknown", []).append(
+                time.perf_counter() - started
+            )
+            workers.release()
+
+    started = time.perf_counter()
+    first_timestamp = None
+    async with asyncio.TaskGroup() as tg:
+        for record in read_records(path):
+            if speed:
+                if first_timestamp is None:
+                    first_timestamp = record.timestamp
+                # Время сообщения относительно начала прогона
+                due = (record.timestamp - first_timestamp) / 1000 / speed
+                delay = due - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await workers.acquire()
+            tg.create_task(handle(record))
+    # События, ожидающие PRODUCER_COALESCE и PRODUCER_PIPELINE
+    await KafkaProducer().flush()
+    elapsed = time.perf_counter() - started
+    return {
+        "elapsed": elapsed,
+        "events": report(latencies, elapsed),
+        "errors": errors,
+        "produced": {
+            topic: sum(len(records) for records in partitions)
+            for topic, partitions in broker.topics.items()
+        },
+    }
+
+
+def write_produced(path: str) -> None:
+    """Сохранить отправленные при прогоне события"""
+    with open(path, "wb") as f:
+        for partitions in MemoryBroker().topics.values():
+            for records in partitions:
+                for record in records:
+                    f.write(codec.dumps(record_to_line(record)) + b"\n")
+
+
+async def dump(
+    path: str,
+    topic: str,
+    partitions: list = None,
+    start: int = None,
+    end: int = None,
+    limit: int = None,
+) -> int:
+    """Записать сообщения топика в файл json lines
+
+    :param list partitions: номера партиций, по умолчанию все
+    :param int start: начальное смещение, по умолчанию с начала
+    :param int end: конечное смещение (не включая), по умолчанию
+        до конца на момент запуска
+    :param int limit: не больше limit сообщений на партицию
+    :return int: записано сообщений
+    """
+    kafka = dict(config.CONSUMER_KAFKA, group_id=None)
+    consumer = AIOKafkaConsumer(**kafka, enable_auto_commit=False)
+    await consumer.start()
+    written = 0
+    try:
+        if partitions is None:
+            partitions = sorted(consumer.partitions_for_topic(topic) or [])
+        tps = [TopicPartition(topic, partition) for partition in partitions]
+        consumer.assign(tps)
+        highwater = await consumer.end_offsets(tps)
+        lowwater = await consumer.beginning_offsets(tps)
+        stop = {}
+        for tp in tps:
+            first = max(start or 0, lowwater[tp])
+            last = highwater[tp]
+            if end is not None:
+                last = min(last, end)
+            if limit:
+                last = min(last, first + limit)
+            if first < last:
+                consumer.seek(tp, first)
+                stop[tp] = last
+            else:
+                consumer.pause(tp)
+        with open(path, "wb") as f:
+            while stop:
+                result = await consumer.getmany(timeout_ms=1000)
+                for tp, records in result.items():
+                    for record in records:
+                        if tp in stop and record.offset < stop[tp]:
+                            f.write(
+                                codec.dumps(record_to_line(record)) + b"\n"
+                            )
+                            written += 1
+                    if tp in stop and records[-1].offset + 1 >= stop[tp]:
+                        consumer.pause(tp)
+                        del stop[tp]
+    finally:
+        await consumer.stop()
+    logger.info(f"dumped {written} messages of {topic} to {path}")
+    return written
+
+
+def print_report(result: dict) -> None:
+    print(
+        f"{'event':<40} {'count':>8} {'msg/s':>10} "
+        + f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    )
+    for row in result["events"]:
+        print(
+            f"{row['event']:<40} {row['count']:>8} {row['per_sec']:>10.1f} "
+            + f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f} "
+            + f"{row['p99_ms']:>9.2f}"
+        )
+    print(f"elapsed {result['elapsed']:.2f}s, errors {result['errors']}")
+    for topic, count in result["produced"].items():
+        print(f"produced to {topic}: {count}")
+
+
+def main(argv: list = None) -> None:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    # Команда по умолчанию - replay
+    if not argv or argv[0] not in ("replay", "dump", "-h", "--help"):
+        argv.insert(0, "replay")
+    parser = argparse.ArgumentParser(prog="python -m micro.replay")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser(
+        "replay", help="прогнать файл через capture()"
+    )
+    replay_parser.add_argument("path")
+    replay_parser.add_argument(
+        "--module",
+        action="append",
+        default=[],
+        help="модуль сервиса, регистрирующий обработчики",
+    )
+    replay_parser.add_argument("--speed", type=float, default=0)
+    replay_parser.add_argument("--concurrency", type=int, default=1)
+    replay_parser.add_argument(
+        "--output", help="файл для отправленных событий"
+    )
+
+    dump_parser = commands.add_parser("dump", help="записать топик в файл")
+    dump_parser.add_argument("path")
+    dump_parser.add_argument("--topic", required=True)
+    dump_parser.add_argument("--partition", type=int, action="append")
+    dump_parser.add_argument("--start", type=int)
+    dump_parser.add_argument("--end", type=int)
+    dump_parser.add_argument("--limit", type=int)
+
+    args = parser.parse_args(argv)
+    if args.command == "dump":
+        asyncio.run(
+            dump(
+                args.path,
+                topic=args.topic,
+                partitions=args.partition,
+                start=args.start,
+                end=args.end,
+                limit=args.limit,
+            )
+        )
+        return
+    events = None
+    for name in args.module:
+        module = importlib.import_module(name)
+        app = getattr(module, "app", None)
+        events = getattr(app, "events", None) or events
+    result = asyncio.run(
+        replay(
+            args.path,
+            speed=args.speed,
+            concurrency=args.concurrency,
+            events=events,
+        )
+    )
+    print_report(result)
+    if args.output:
+        write_produced(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -45,3 +45,7 @@ class Schema(metaclass=MetaSingleton):
                         result[name] = obj
             self._models = result
         return self._models
+
+    def refresh(self):
+        """Сбросить кэш, модели будут собраны заново из sys.modules"""
+        self._models = None
@@ -22,8 +22,16 @@ import micro.logging_trace  as logging_trace# noqa
 
 from micro.utils import hide_passwords
 import micro.config as config
-from micro.kafka_consumer import KafkaConsumer, capture
+from micro.kafka_consumer import (
+    KafkaConsumer,
+    LanePriority,
+    consumer_lanes,
+)
+from micro.dispatcher import Dispatcher
+from micro.supervisor import Supervisor
 from micro.kafka_producer import KafkaProducer
+from micro.transactions import TransactionalProducers
+from micro.outbox import Outbox
 from micro.status import Status
 from micro.schemes import Schema  # noqa
 from micro.models.common_events import InfoEvent, Live
@@ -47,33 +55,64 @@ app = None
 
 class BackgroundRunner:
 
-    async def run_main(self, app):
+    # Остановить обработку, не перезапускать после ошибки
+    stopped: bool = False
+
+    async def run_main(self, app, primary: bool = True):
+        """Обработка событий сервиса
+
+        :param bool primary: запускать app.runner и сообщать о старте,
+            в режиме CONSUMER_WORKERS только в процессе 0
+        """
+
+        async def cycle(consumer, priority: LanePriority = None):
+            dispatcher = Dispatcher(
+                consumer,
+                events=app.events,
+                concurrency=getattr(consumer, "concurrency", None),
+            )
+            # Состояние партиций при перебалансировке
+            consumer.dispatcher = dispatcher
+
+            async def process(result: dict, count: int):
+                # Обработать партиции пакета
+                started = time.monotonic()
+                await dispatcher.run_batch(result)
+                consumer.batch_done(
+                    count=count,
+                    elapsed=time.monotonic() - started,
+                )
 
-        async def cycle():
             try:
-                while True:
-                    if config.SRC_TOPIC or config.SRC_PATTERN_TOPIC:
-                        # Получить пакет сообщений из kafka
-                        result = await KafkaConsumer().get_messages()
-                        # Перебрать пакеты
-                        for tp, messages in result.items():
-                            # Если есть сообщение
-                            if messages:
-                                for message in messages:
-                                    await capture(
-                                        message=message, events=app.events
-                                    )
-
-                                await KafkaConsumer().partition_commit(
-                                    tp, messages[-1].offset + 1
-                                )
-                    else:
-                        await asyncio.sleep(60)
+                # Пакеты обрабатываются задачами, пока выбираются
+                # следующие; перегруженные партиции приостанавливает
+                # backpressure. Ошибка обработки останавливает цикл
+                async with asyncio.TaskGroup() as tg:
+                    while True:
+                        if config.SRC_TOPIC or config.SRC_PATTERN_TOPIC:
+                            if priority:
+                                # Пропустить вперед lane с большим весом
+                                await priority.wait_turn(consumer)
+                            # Получить пакет сообщений из kafka
+                            result = await consumer.get_messages(
+                                timeout_ms=dispatcher.poll_timeout_ms()
+                            )
+                            count = sum(
+                                len(msgs) for msgs in result.values()
+                            )
+                            if priority:
+                                await priority.report(consumer, count)
+                            tg.create_task(process(result, count))
+                            # Пакет встает в очередь партиций
+                            # и учитывается backpressure до следующей выборки
+                            await asyncio.sleep(0)
+                        else:
+                            await asyncio.sleep(60)
             except Exception:
                 traceback.print_exc()
                 raise
 
-        while True:
+        while not self.stopped:
             if await Status().error():
                 logger.info(
                     f"service works with errors :( sleep {config.SLEEP_AFTER_ERROR_SECOND}"  # noqa
@@ -82,6 +121,13 @@ class BackgroundRunner:
                 # Попробовать еще раз
                 await Status().set_ok()
             else:
+                # Consumer сервиса или отдельные consumer lane
+                if config.CONSUMER_LANES:
+                    consumers = consumer_lanes() or [KafkaConsumer()]
+                    priority = LanePriority(consumers)
+                else:
+                    consumers = [KafkaConsumer()]
+                    priority = None
                 try:
                     # Подключиться к kafka
                     # logger.info('start kafka producer')
@@ -89,15 +135,35 @@ class BackgroundRunner:
                     # После запуска kafka запустить сервис
                     async with asyncio.TaskGroup() as tg:
                         # Запустить обработку
-                        logger.info("start task cycle")
-                        tg.create_task(cycle(), name="cycle")
-                        if hasattr(app, "runner"):
+                        for consumer in consumers:
+                            logger.info(f"start task cycle {consumer.name}")
+                            tg.create_task(
+                                cycle(consumer, priority),
+                                name=f"cycle {consumer.name}",
+                            )
+                            if config.COMMIT_ASYNC:
+                                logger.info(
+                                    f"start task committer {consumer.name}"
+                                )
+                                tg.create_task(
+                                    consumer.committer.run(),
+                                    name=f"committer {consumer.name}",
+                                )
+                        if config.OUTBOX:
+                            logger.info("start task outbox relay")
+                            tg.create_task(
+                                Outbox().relay(), name="outbox relay"
+                            )
+                        if primary and hasattr(app, "runner"):
                             logger.info("start task runner")
                             tg.create_task(app.runner(), name="runner")
                         # Событие запуска сервиса
                         # Отправим независимо от жизни других сервисов,
                         # непосредственно в телеграмм
-                        await send_start_service(service_name=app.summary)
+                        if primary:
+                            await send_start_service(
+                                service_name=app.summary
+                            )
                 except BaseException:
                     logger.error(traceback.format_exc())
                 finally:
@@ -105,8 +171,19 @@ class BackgroundRunner:
                     # Отключиться от kafka
                     logger.info("stop kafka producer")
                     await KafkaProducer().stop()
-                    logger.info("stop kafka consumer")
-                    await KafkaConsumer().stop()
+                    await TransactionalProducers().close()
+                    for consumer in consumers:
+                        logger.info(
+                            f"flush kafka consumer {consumer.name} commits"
+                        )
+                        try:
+                            await consumer.flush_commits()
+                        except Exception as e:
+                            logger.error(f"Kafka commit on stop failed {e}")
+                        logger.info(f"stop kafka consumer {consumer.name}")
+                        await consumer.stop()
+                    # Не подтвержденные события обработаются повторно
+                    KafkaProducer().clear_failed()
 
                     if hasattr(app, "del_objects"):
                         logger.info("del_objects")
@@ -120,10 +197,21 @@ class BackgroundRunner:
 runner = BackgroundRunner()
 
 
+supervisor: Supervisor = None
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    asyncio.create_task(runner.run_main(app))
-    yield
+    global supervisor
+    if config.CONSUMER_WORKERS:
+        # Обработка событий в отдельных процессах
+        supervisor = Supervisor(runner, app, config.CONSUMER_WORKERS)
+        asyncio.create_task(supervisor.run())
+        yield
+        await supervisor.stop()
+    else:
+        asyncio.create_task(runner.run_main(app))
+        yield
 
 
 app = FastAPI(
@@ -218,6 +306,21 @@ async def healthcheck():
                 content={"message": "Service works with errors"},
                 status_code=500,
             )
+    elif supervisor:
+        if await Status().ok() and supervisor.healthy():
+            return {
+                "status": "UP",
+                "uptime": uptime_str(),
+                "workers": supervisor.status(),
+            }
+        else:
+            return JSONResponse(
+                content={
+                    "message": "Service works with errors",
+                    "workers": supervisor.status(),
+                },
+                status_code=500,
+            )
     else:
         if await Status().ok():
             return {"status": "UP", "uptime": uptime_str()}
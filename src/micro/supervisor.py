@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from prometheus_client import multiprocess
+
+from micro.singleton import MetaSingleton
+from micro.status import Status
+
+import micro.config as config
+
+from micro.metrics import CONSUMER_WORKERS_ALIVE, CONSUMER_WORKER_RESTART_CNT
+
+logger = logging.getLogger(__name__)
+
+
+class Supervisor:
+    """Обработка событий в нескольких процессах
+
+    Запускает CONSUMER_WORKERS процессов (fork), в каждом
+    BackgroundRunner со своим consumer той же группы kafka,
+    партиции распределяются между процессами.
+    FastAPI, /health и /metrics остаются в родительском процессе.
+    Упавший процесс перезапускается через WORKER_RESTART_DELAY_SEC.
+    app.runner и сообщение о старте сервиса - только в процессе 0.
+    """
+
+    def __init__(self, runner, app, workers: int):
+        self.runner = runner
+        self.app = app
+        self.workers = workers
+        self.context = multiprocessing.get_context("fork")
+        self.processes: list = [None] * workers
+        # Состояние процессов: Status().ok() и время последнего отчета
+        self.ok = self.context.Array("b", workers, lock=False)
+        self.heartbeat = self.context.Array("d", workers, lock=False)
+        # Время, после которого можно перезапустить процесс
+        self.restart_at: list = [0.0] * workers
+        self.stopping: bool = False
+
+    def start(self, index: int) -> None:
+        """Запустить процесс обработки"""
+        self.ok[index] = 0
+        self.heartbeat[index] = time.time()
+        process = self.context.Process(
+            target=self.worker_main,
+            args=(index,),
+            name=f"consumer-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        logger.info(f"started worker {index} pid={process.pid}")
+
+    def worker_main(self, index: int) -> None:
+        """Точка входа процесса обработки"""
+        # Цикл событий и обработчики сигналов унаследованы от родителя
+        asyncio._set_running_loop(None)
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        # Соединения родителя не используются
+        MetaSingleton._instances.clear()
+        asyncio.run(self.worker(index))
+
+    async def worker(self, index: int) -> None:
+        """Обработка событий в процессе, отчет о состоянии родителю"""
+        task = asyncio.create_task(
+            self.runner.run_main(self.app, primary=index == 0)
+        )
+
+        def stop():
+            logger.info(f"stop worker {index}")
+            self.runner.stopped = True
+            task.cancel()
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop)
+        while not task.done():
+            self.ok[index] = int(await Status().ok())
+            self.heartbeat[index] = time.time()
+            await asyncio.wait([task], timeout=1)
+
+    def alive(self, index: int) -> bool:
+        process = self.processes[index]
+        return process is not None and process.is_alive()
+
+    def status(self) -> list:
+        """Состояние процессов обработки"""
+        now = time.time()
+        return [
+            {
+                "worker": index,
+                "pid": process.pid if process else None,
+                "alive": self.alive(index),
+                "ok": bool(self.ok[index]),
+                "heartbeat_sec": round(now - self.heartbeat[index], 1),
+            }
+            for index, process in enumerate(self.processes)
+        ]
+
+    def healthy(self) -> bool:
+        """Все процессы живы, без ошибок и отчитываются"""
+        return all(
+            item["alive"]
+            and item["ok"]
+            and item["heartbeat_sec"] < config.WORKER_HEARTBEAT_SEC
+            for item in self.status()
+        )
+
+    def reap(self, index: int) -> None:
+        """Учесть завершение процесса"""
+        process = self.processes[index]
+        logger.error(
+            f"worker {index} pid={process.pid} exited "
+            + f"with code {process.exitcode}, "
+            + f"restart in {config.WORKER_RESTART_DELAY_SEC}s"
+        )
+        if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+            multiprocess.mark_process_dead(process.pid)
+        process.close()
+        self.processes[index] = None
+        self.restart_at[index] = time.time() + config.WORKER_RESTART_DELAY_SEC
+
+    async def run(self) -> None:
+        """Запустить процессы и перезапускать упавшие"""
+        logger.info(f"start {self.workers} consumer workers")
+        for index in range(self.workers):
+            self.start(index)
+        while not self.stopping:
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    self.reap(index)
+                if (
+                    self.processes[index] is None
+                    and time.time() >= self.restart_at[index]
+                ):
+                    CONSUMER_WORKER_RESTART_CNT.inc()
+                    self.start(index)
+            CONSUMER_WORKERS_ALIVE.set(
+                sum(self.alive(index) for index in range(self.workers))
+            )
+            await asyncio.sleep(1)
+
+    async def stop(self) -> None:
+        """Остановить процессы, дождаться завершения обработки"""
+        self.stopping = True
+        processes = [process for process in self.processes if process]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + config.REBALANCE_DRAIN_TIMEOUT_SEC
+        for process in processes:
+            while process.is_alive() and time.time() < deadline:
+                await asyncio.sleep(0.1)
+            if process.is_alive():
+                logger.error(f"worker pid={process.pid} killed")
+                process.kill()
+            process.join()
+        CONSUMER_WORKERS_ALIVE.set(0)
+        logger.info("consumer workers stopped")
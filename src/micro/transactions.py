@@ -0,0 +1,85 @@
+"""Обработка событий в транзакциях kafka (exactly-once)
+
+KAFKA_TRANSACTIONS=true: сообщения партиции из пакета kafka
+обрабатываются в одной транзакции producer этой партиции.
+События, отправленные обработчиками (HeaderEvent.send, DLQ),
+и смещение партиции фиксируются вместе commit_transaction
+или не фиксируются вовсе. Consumer читает только
+зафиксированные сообщения (read_committed).
+
+transactional_id = <SRC_GROUP_ID>-<topic>-<partition>: новый владелец
+партиции после перебалансировки отсекает незавершенную транзакцию
+прежнего владельца.
+Смещения фиксируются через producer, поэтому SRC_BOOTSTRAP_SERVERS
+и DST_BOOTSTRAP_SERVERS должны указывать на один кластер.
+События пакетных обработчиков (batch_event_handler) отправляются
+вне транзакции.
+"""
+
+import logging
+from contextvars import ContextVar
+
+from aiokafka import AIOKafkaProducer
+
+from micro.singleton import MetaSingleton
+from micro.memory_kafka import MemoryProducer, is_memory
+
+import micro.config as config
+
+logger = logging.getLogger(__name__)
+
+# Producer транзакции обрабатываемой партиции
+current_transaction: ContextVar = ContextVar(
+    "current_transaction", default=None
+)
+
+
+class TransactionalProducers(metaclass=MetaSingleton):
+    """Транзакционные producer по партициям consumer"""
+
+    def __init__(self):
+        # tp -> producer
+        self.producers: dict = {}
+
+    @staticmethod
+    def group_id() -> str:
+        return config.CONSUMER_KAFKA["group_id"]
+
+    def transactional_id(self, tp) -> str:
+        return f"{self.group_id()}-{tp.topic}-{tp.partition}"
+
+    async def producer(self, tp):
+        """Producer партиции, если нет то создать"""
+        producer = self.producers.get(tp)
+        if producer is None:
+            producer_class = (
+                MemoryProducer
+                if is_memory(config.PRODUCER_KAFKA["bootstrap_servers"])
+                else AIOKafkaProducer
+            )
+            producer = producer_class(
+                **config.PRODUCER_KAFKA,
+                transactional_id=self.transactional_id(tp),
+            )
+            logger.info(
+                f"start transactional producer {self.transactional_id(tp)}"
+            )
+            await producer.start()
+            self.producers[tp] = producer
+        return producer
+
+    async def close(self, partitions=None) -> None:
+        """Остановить producer партиций, по умолчанию всех"""
+        if partitions is None:
+            partitions = list(self.producers)
+        for tp in partitions:
+            producer = self.producers.pop(tp, None)
+            if producer is None:
+                continue
+            try:
+                await producer.stop()
+            except Exception as e:
+                logger.error(
+                    "stop transactional producer "
+                    + f"{self.transactional_id(tp)} failed {e}"
+                )
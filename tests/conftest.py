@@ -0,0 +1,16 @@
+import pytest
+
+import micro.kafka_consumer as kafka_consumer
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """Чистые обработчики, регистрации теста не влияют на другие тесты"""
+    monkeypatch.setattr(kafka_consumer, "message_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "all_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "batch_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "handlers_index", {})
+    monkeypatch.setattr(kafka_consumer, "event_semaphores", {})
+    monkeypatch.setattr(kafka_consumer, "missing_models", set())
+    monkeypatch.setattr(kafka_consumer, "prioritized_events", set())
@@ -0,0 +1,158 @@
+# Подключить логирование главного модуля
+import asyncio
+import collections
+import json
+import logging
+import pytest
+
+from types import SimpleNamespace
+
+import micro.kafka_consumer as kafka_consumer
+from micro.dedup import Dedup
+from micro.models.common_events import Report
+
+logger = logging.getLogger(__name__)
+
+
+def report_message(text: str, uuid: str = "1") -> SimpleNamespace:
+    value = {"header": {"event": "Report", "uuid": uuid}, "text": text}
+    return SimpleNamespace(
+        value=json.dumps(value, ensure_ascii=False).encode(),
+        timestamp=1700000000000,
+    )
+
+
+@pytest.mark.asyncio
+async def test_capture_model_from_bytes(handlers, monkeypatch):
+    received = []
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        received.append(obj)
+
+    # dict не нужен, если нет legacy обработчиков
+    def no_dict(self):
+        raise AssertionError("dict decoded")
+
+    monkeypatch.setattr(kafka_consumer.EventMessage, "as_dict", no_dict)
+    await kafka_consumer.capture(report_message("привет"))
+    assert received[0].text == "привет"
+    assert received[0].header.event == "Report"
+    assert received[0].create_event_timestamp is not None
+
+
+@pytest.mark.asyncio
+async def test_capture_legacy_dict(handlers):
+    received = []
+
+    @kafka_consumer.message_handler("report")
+    async def on_report(message: dict):
+        received.append(message)
+
+    await kafka_consumer.capture(report_message("text"))
+    assert received[0]["text"] == "text"
+    assert "create_event_timestamp" in received[0]
+
+
+@pytest.mark.asyncio
+async def test_event_handler_limits(handlers, monkeypatch):
+    monkeypatch.setattr(kafka_consumer.config, "DLQ_WRITE_TOPIC", "dlq")
+    running, peak, errors = [], [], []
+
+    @kafka_consumer.event_handler("Report", max_concurrency=1, timeout=0.05)
+    async def on_report(obj: Report):
+        running.append(obj)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(0.1 if obj.text == "slow" else 0.01)
+        finally:
+            running.remove(obj)
+
+    # Ограничение общее для всех обработчиков события
+    @kafka_consumer.event_handler("Report")
+    async def audit_report(obj: Report):
+        running.append(obj)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            running.remove(obj)
+
+    async def send_dlq(message_dict, error):
+        errors.append((message_dict["text"], error))
+
+    monkeypatch.setattr(kafka_consumer, "send_dlq", send_dlq)
+    await asyncio.gather(
+        *[
+            kafka_consumer.capture(report_message(text))
+            for text in ["a", "slow", "b"]
+        ]
+    )
+    # Не больше одного события одновременно, медленное в DLQ
+    assert max(peak) == 1
+    assert len(errors) == 1 and errors[0][0] == "slow"
+    assert isinstance(errors[0][1], kafka_consumer.HandlerTimeoutError)
+
+
+@pytest.mark.asyncio
+async def test_capture_dedup(handlers, monkeypatch):
+    monkeypatch.setattr(Dedup(), "enabled", True)
+    monkeypatch.setattr(Dedup(), "cache", collections.OrderedDict())
+    received = []
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        if obj.text == "fail":
+            raise ValueError("fail")
+        received.append(obj.text)
+
+    await kafka_consumer.capture(report_message("a", uuid="u1"))
+    # Повтор не разбирается и не обрабатывается
+    await kafka_consumer.capture(report_message("b", uuid="u1"))
+    with pytest.raises(ValueError):
+        await kafka_consumer.capture(report_message("fail", uuid="u2"))
+    # Необработанное событие обрабатывается повторно
+    await kafka_consumer.capture(report_message("c", uuid="u2"))
+    assert received == ["a", "c"]
+
+
+@pytest.mark.asyncio
+async def test_dedup_prefetch_per_batch(handlers, monkeypatch):
+    from micro.dispatcher import Dispatcher
+
+    dedup = Dedup()
+    monkeypatch.setattr(dedup, "enabled", True)
+    monkeypatch.setattr(dedup, "postgres", True)
+    monkeypatch.setattr(dedup, "cache", collections.OrderedDict())
+    monkeypatch.setattr(dedup, "pending", [])
+    queries = []
+
+    async def prefetch(uuids):
+        queries.append(sorted(uuids))
+        dedup.remember("u1")
+
+    monkeypatch.setattr(dedup, "prefetch", prefetch)
+    received = []
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        received.append(obj.text)
+
+    # Один запрос на пакет, capture_dict проверяет только память
+    await kafka_consumer.capture_dict(
+        {"header": {"event": "Report", "uuid": "u3"}, "text": "c"}
+    )
+    assert queries == []
+    dispatcher = Dispatcher(consumer=None)
+    messages = [report_message("a", "u1"), report_message("b", "u2")]
+    for offset, message in enumerate(messages):
+        message.offset = offset
+    await dispatcher.prefetch({"tp": messages})
+    assert queries == [["u1", "u2"]]
+    # Разобранное при prefetch сообщение передается в capture
+    for message in messages:
+        await kafka_consumer.capture(
+            message,
+            event_message=dispatcher.peeked.pop(("tp", message.offset)),
+        )
+    assert received == ["c", "b"]
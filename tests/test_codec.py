@@ -0,0 +1,62 @@
+import json
+import math
+from datetime import date, datetime, time, timedelta, timezone
+
+import pytest
+
+from micro import codec
+from micro.codec import serialize_datetime
+
+
+DATA = {
+    "dt": datetime(2025, 8, 11, 14, 30, 0, 123456),
+    "tz": datetime(2025, 8, 11, 14, 30, tzinfo=timezone.utc),
+    "date": date(2025, 8, 11),
+    "time": time(14, 30),
+    "td": timedelta(hours=2, minutes=30, microseconds=5),
+    "text": "Запись клиента ✓",
+    "nested": [{"n": 1, "f": 1.5, "none": None, "flag": True}],
+    1: "int key",
+}
+
+
+@pytest.fixture(params=["json", "orjson", "msgspec"])
+def backend(request):
+    if codec.select(request.param) != request.param:
+        pytest.skip(f"{request.param} is not installed")
+    codec.use(request.param)
+    yield request.param
+    codec.use()
+
+
+def test_codec_byte_compatible(backend):
+    expected = json.dumps(DATA, ensure_ascii=False, default=serialize_datetime)
+    assert codec.dumps(DATA) == expected.encode()
+
+
+def test_codec_matches_stdlib(backend):
+    codec.use(backend, compact=True)
+    expected = json.dumps(DATA, ensure_ascii=False, default=serialize_datetime)
+    value = codec.dumps(DATA)
+    assert isinstance(value, bytes)
+    # Тот же json с точностью до пробелов между элементами
+    assert json.loads(value) == json.loads(expected)
+    assert "Запись клиента ✓".encode() in value
+    assert codec.loads(value) == json.loads(expected)
+    assert codec.loads(value.decode()) == json.loads(expected)
+
+
+def test_codec_big_int(backend):
+    n = 2**70 + 1
+    assert codec.loads(codec.dumps({"n": n})) == {"n": n}
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_codec_nan(backend, compact):
+    codec.use(backend, compact=compact)
+    value = json.dumps({"nan": math.nan, "inf": math.inf}).encode()
+    data = codec.loads(value)
+    assert math.isnan(data["nan"])
+    assert data["inf"] == math.inf
+    with pytest.raises(ValueError):
+        codec.loads(b"{")
@@ -0,0 +1,429 @@
+# Подключить логирование главного модуля
+import asyncio
+import datetime
+import json
+import logging
+import pytest
+
+from aiokafka.structs import TopicPartition, ConsumerRecord
+
+import micro.config as config
+import micro.kafka_consumer as kafka_consumer
+import micro.dispatcher as dispatcher_module
+from micro.dispatcher import Dispatcher, OffsetWatermark
+from micro.kafka_consumer import AdaptiveBatch
+
+logger = logging.getLogger(__name__)
+
+
+class FakeConsumer:
+
+    def __init__(self):
+        self.commits = []
+        self.paused = set()
+        self.seeks = []
+
+    async def partition_commit(self, tp, offset):
+        self.commits.append((tp, offset))
+
+    def pause(self, partitions):
+        self.paused.update(partitions)
+
+    def resume(self, partitions):
+        self.paused.difference_update(partitions)
+
+    def seek(self, tp, offset):
+        self.seeks.append((tp, offset))
+
+
+def record(
+    tp: TopicPartition, offset: int, key: bytes = None, value: bytes = b"{}"
+):
+    return ConsumerRecord(
+        topic=tp.topic,
+        partition=tp.partition,
+        offset=offset,
+        timestamp=1700000000000,
+        timestamp_type=0,
+        key=key,
+        value=value,
+        checksum=None,
+        serialized_key_size=0,
+        serialized_value_size=len(value),
+        headers=(),
+    )
+
+
+@pytest.fixture
+def handled(monkeypatch):
+    """Перехватить все сообщения, медленная партиция 0"""
+    result = []
+
+    async def handler(message):
+        if message.partition == 0:
+            await asyncio.sleep(0.2)
+        result.append((message.partition, message.offset))
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    return result
+
+
+@pytest.mark.asyncio
+async def test_partitions_concurrent(monkeypatch, handled):
+    monkeypatch.setattr(config, "PARTITION_CONCURRENCY", 2)
+    tp0, tp1 = TopicPartition("t", 0), TopicPartition("t", 1)
+    consumer = FakeConsumer()
+    await Dispatcher(consumer).run_batch(
+        {
+            tp0: [record(tp0, 10), record(tp0, 11)],
+            tp1: [record(tp1, 5), record(tp1, 6)],
+        }
+    )
+    # Быстрая партиция не ждет медленную
+    assert handled[:2] == [(1, 5), (1, 6)]
+    assert handled[2:] == [(0, 10), (0, 11)]
+    assert consumer.commits == [(tp1, 7), (tp0, 12)]
+
+
+@pytest.mark.asyncio
+async def test_partitions_sequential(monkeypatch, handled):
+    monkeypatch.setattr(config, "PARTITION_CONCURRENCY", 1)
+    tp0, tp1 = TopicPartition("t", 0), TopicPartition("t", 1)
+    consumer = FakeConsumer()
+    await Dispatcher(consumer).run_batch(
+        {tp0: [record(tp0, 10)], tp1: [record(tp1, 5)]}
+    )
+    assert handled == [(0, 10), (1, 5)]
+    assert consumer.commits == [(tp0, 11), (tp1, 6)]
+
+
+def test_watermark():
+    watermark = OffsetWatermark()
+    for offset in [3, 4, 5, 6]:
+        watermark.track(offset)
+    assert watermark.committable() == 3
+    watermark.done(5)
+    watermark.done(4)
+    assert watermark.committable() == 3
+    watermark.done(3)
+    assert watermark.committable() == 6
+    watermark.done(6)
+    assert watermark.committable() == 7
+
+
+@pytest.mark.asyncio
+async def test_key_lanes(monkeypatch):
+    monkeypatch.setattr(config, "KEY_CONCURRENCY", 4)
+    handled = []
+
+    async def handler(message):
+        if message.key == b"slow":
+            await asyncio.sleep(0.2)
+        if message.offset == 4:
+            raise ValueError("fail")
+        handled.append(message.offset)
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    tp = TopicPartition("t", 0)
+    consumer = FakeConsumer()
+    keys = [b"slow", b"a", b"b", b"a", b"slow"]
+    with pytest.raises(ExceptionGroup):
+        await Dispatcher(consumer).run_batch(
+            {tp: [record(tp, n, key) for n, key in enumerate(keys)]}
+        )
+    # Ключ slow не задерживает остальные, порядок внутри ключа сохранен
+    assert sorted(handled[:3]) == [1, 2, 3] and handled[3] == 0
+    assert handled.index(1) < handled.index(3)
+    # Смещение 4 не обработано, фиксируется только до него
+    assert consumer.commits == [(tp, 4)]
+
+
+def report_record(tp: TopicPartition, offset: int, text: str):
+    value = {"header": {"event": "Report", "uuid": str(offset)}, "text": text}
+    return record(tp, offset, value=json.dumps(value).encode())
+
+
+@pytest.mark.asyncio
+async def test_batch_handler(monkeypatch):
+    monkeypatch.setattr(kafka_consumer, "all_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "batch_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "handlers_index", {})
+    monkeypatch.setattr(config, "DLQ_WRITE_TOPIC", "dlq")
+    batches, dlq = [], []
+
+    @kafka_consumer.batch_event_handler("Report", max_size=2)
+    async def on_reports(objs: list):
+        batches.append([obj.text for obj in objs])
+        # Второй объект пакета не обработан
+        return {1: "fail"} if len(objs) == 2 else None
+
+    async def send_dlq(message_dict, error):
+        dlq.append((message_dict["text"], error))
+
+    monkeypatch.setattr(dispatcher_module, "send_dlq", send_dlq)
+    tp = TopicPartition("t", 0)
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    await dispatcher.run_batch(
+        {tp: [report_record(tp, n, f"r{n}") for n in range(3)]}
+    )
+    assert batches == [["r0", "r1"]]
+    assert dlq == [("r1", "fail")]
+    # Третье событие ждет пакета, смещение фиксируется до него
+    assert consumer.commits == [(tp, 2)]
+    assert dispatcher.poll_timeout_ms() <= 1000
+    await dispatcher.batches.flush_due(force=True)
+    assert batches == [["r0", "r1"], ["r2"]]
+    assert consumer.commits == [(tp, 2), (tp, 3)]
+
+
+def test_adaptive_batch(monkeypatch):
+    monkeypatch.setattr(config, "BATCH_ADAPTIVE", True)
+    monkeypatch.setattr(config, "BATCH_TARGET_SEC", 1)
+    batch = AdaptiveBatch()
+    batch.max_records = 5
+    # Быстрые полные блоки - блок растет
+    for _ in range(5):
+        batch.observe(batch.max_records, 0.001 * batch.max_records)
+    assert batch.max_records == 160
+    # Неполный блок - размер не меняется
+    batch.observe(10, 0.01)
+    assert batch.max_records == 160
+    # Обработчики замедлились - блок уменьшается
+    batch.observe(160, 3.2)
+    assert batch.max_records <= 80
+    # Не меньше нижней границы
+    for _ in range(10):
+        batch.observe(batch.max_records, 10)
+    assert batch.max_records == config.BATCH_MIN_RECORDS
+
+
+@pytest.mark.asyncio
+async def test_revoke_drains_partition(monkeypatch):
+    handled = []
+
+    async def handler(message):
+        await asyncio.sleep(0.05)
+        handled.append(message.offset)
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    tp = TopicPartition("t", 0)
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    dispatcher.assign([tp])
+    task = asyncio.create_task(
+        dispatcher.run_batch({tp: [record(tp, n) for n in range(10)]})
+    )
+    await asyncio.sleep(0.12)
+    # Отзыв дожидается текущего сообщения и фиксирует обработанное
+    await dispatcher.revoke([tp])
+    dispatcher.release([tp])
+    await task
+    assert handled == [0, 1, 2]
+    assert consumer.commits == [(tp, 3)]
+    assert tp not in dispatcher.watermarks
+
+
+@pytest.mark.asyncio
+async def test_backpressure(monkeypatch):
+    monkeypatch.setattr(kafka_consumer, "all_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "batch_event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "handlers_index", {})
+    monkeypatch.setattr(config, "BACKPRESSURE_HIGH_MESSAGES", 2)
+    monkeypatch.setattr(config, "BACKPRESSURE_LOW_MESSAGES", 0)
+
+    @kafka_consumer.batch_event_handler("Report", max_size=100)
+    async def on_reports(objs: list):
+        pass
+
+    tp = TopicPartition("t", 0)
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    # События ждут пакета, партиция приостановлена
+    await dispatcher.run_batch(
+        {tp: [report_record(tp, n, f"r{n}") for n in range(3)]}
+    )
+    assert consumer.paused == {tp}
+    assert dispatcher.watermarks[tp].bytes > 0
+    # Пакет обработан, партиция возобновлена
+    await dispatcher.batches.flush_due(force=True)
+    assert consumer.paused == set()
+    assert dispatcher.watermarks[tp].bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_backpressure_slow_handlers(monkeypatch):
+    monkeypatch.setattr(config, "BACKPRESSURE_HIGH_MESSAGES", 3)
+    monkeypatch.setattr(config, "BACKPRESSURE_LOW_MESSAGES", 1)
+    handled = []
+    release = asyncio.Event()
+
+    async def handler(message):
+        await release.wait()
+        handled.append(message.offset)
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    tp = TopicPartition("t", 0)
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    # Пакеты обрабатываются задачами, пока выбираются следующие
+    first = asyncio.create_task(
+        dispatcher.run_batch({tp: [record(tp, n) for n in range(2)]})
+    )
+    await asyncio.sleep(0)
+    assert consumer.paused == set()
+    second = asyncio.create_task(
+        dispatcher.run_batch({tp: [record(tp, n) for n in range(2, 4)]})
+    )
+    await asyncio.sleep(0)
+    # В обработке и в очереди партиции 4 сообщения
+    assert consumer.paused == {tp}
+    release.set()
+    await asyncio.gather(first, second)
+    # Пакеты партиции по порядку, партиция возобновлена
+    assert handled == [0, 1, 2, 3]
+    assert consumer.commits == [(tp, 2), (tp, 4)]
+    assert consumer.paused == set()
+    assert dispatcher.queued == {} and dispatcher.turns == {}
+
+
+@pytest.mark.asyncio
+async def test_dlq_redrive(monkeypatch):
+    handled = []
+
+    async def handler(message):
+        handled.append(message.offset)
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    monkeypatch.setattr(config, "DLQ_READ_TOPIC", "dlq")
+    monkeypatch.setattr(config, "DLQ_PARKING_TOPIC", None)
+    monkeypatch.setattr(config, "DLQ_BACKOFF_SEC", 0.05)
+    monkeypatch.setattr(config, "DLQ_MAX_ATTEMPTS", 3)
+    now = datetime.datetime.now()
+    old = (now - datetime.timedelta(seconds=60)).isoformat()
+
+    def dlq_record(offset: int, attempt: int, error_at: str):
+        value = {"attempt": attempt, "error_at": error_at}
+        return record(tp, offset, value=json.dumps(value).encode())
+
+    tp = TopicPartition("dlq", 0)
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    await dispatcher.run_batch(
+        {
+            tp: [
+                dlq_record(0, 1, old),
+                dlq_record(1, 3, old),
+                dlq_record(2, 2, now.isoformat()),
+                dlq_record(3, 1, old),
+            ]
+        }
+    )
+    # Попытки 1 исчерпаны, 2 еще рано повторять
+    assert handled == [0]
+    assert consumer.commits == [(tp, 2)]
+    assert consumer.seeks == [(tp, 2)] and consumer.paused == {tp}
+    assert 0 < dispatcher.poll_timeout_ms() <= 100
+    await asyncio.sleep(0.1)
+    await dispatcher.run_batch({})
+    assert consumer.paused == set()
+
+
+@pytest.mark.asyncio
+async def test_dlq_redrive_malformed(monkeypatch):
+    handled = []
+
+    async def handler(message):
+        handled.append(message.offset)
+
+    monkeypatch.setattr(
+        kafka_consumer, "all_event_handlers", [{"handler": handler}]
+    )
+    monkeypatch.setattr(config, "DLQ_READ_TOPIC", "dlq")
+    decodes = []
+    decode = dispatcher_module.codec.decode
+
+    def counting_decode(value, headers=None):
+        decodes.append(value)
+        return decode(value, headers)
+
+    monkeypatch.setattr(dispatcher_module.codec, "decode", counting_decode)
+    tp = TopicPartition("dlq", 0)
+    values = [
+        b"[1, 2]",
+        b'"text"',
+        json.dumps({"attempt": "x", "error_at": "yesterday"}).encode(),
+        json.dumps({"attempt": 1, "error_at": 12}).encode(),
+    ]
+    consumer = FakeConsumer()
+    dispatcher = Dispatcher(consumer)
+    await dispatcher.run_batch(
+        {tp: [record(tp, n, value=value) for n, value in enumerate(values)]}
+    )
+    # Нераспознанные сообщения повторяются сразу, consumer не падает
+    assert handled == [0, 1, 2, 3]
+    assert consumer.commits == [(tp, 4)]
+    # Каждое сообщение разобрано для повтора один раз
+    assert len(decodes) == len(values)
+    assert dispatcher.redrive.states == {}
+
+
+@pytest.mark.asyncio
+async def test_priority(handlers):
+    handled = []
+    release = asyncio.Event()
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj):
+        if obj.text == "busy":
+            await release.wait()
+        handled.append(obj.text)
+
+    @kafka_consumer.event_handler("Live", priority=10)
+    async def on_live(obj):
+        handled.append("live")
+
+    def live_record(tp, offset):
+        value = {"header": {"event": "Live", "uuid": str(offset)}}
+        return record(tp, offset, value=json.dumps(value).encode())
+
+    tps = [TopicPartition("t", n) for n in range(4)]
+    dispatcher = Dispatcher(FakeConsumer(), concurrency=1)
+    # Место обработки занято
+    busy = asyncio.create_task(
+        dispatcher.run_batch({tps[0]: [report_record(tps[0], 0, "busy")]})
+    )
+    await asyncio.sleep(0)
+    report = asyncio.create_task(
+        dispatcher.run_batch({tps[1]: [report_record(tps[1], 0, "report")]})
+    )
+    await asyncio.sleep(0)
+    live = asyncio.create_task(
+        dispatcher.run_batch({tps[2]: [live_record(tps[2], 0)]})
+    )
+    await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(busy, report, live)
+    # Ожидавшая дольше партиция без приоритета пропускает Live
+    assert handled == ["busy", "live", "report"]
+
+    # Партиции одного пакета по очереди, Live первой
+    handled.clear()
+    await dispatcher.run_batch(
+        {
+            tps[1]: [report_record(tps[1], 1, "report")],
+            tps[3]: [live_record(tps[3], 0)],
+        }
+    )
+    assert handled == ["live", "report"]
+    assert dispatcher.peeked == {}
@@ -1,7 +1,23 @@
 # Подключить логирование главного модуля
+import datetime
+import json
 import logging
+import sys
+import types
 
-from micro.events import get_event_name
+import pytest
+from pydantic import ValidationError
+
+import micro.config as config
+import micro.kafka_consumer as kafka_consumer
+from micro import codec
+from micro.codec import serialize_datetime
+from micro.events import get_event_name, Events
+from micro.kafka_producer import KafkaProducer
+from micro.models.ai_events import WillBeAbsent
+from micro.models.common_events import Live, Report
+from micro.models.header_event import Header, HeaderEvent, serializer
+from micro.schemes import Schema
 
 logger = logging.getLogger(__name__)
 
@@ -23,3 +39,141 @@ def test3():
         get_event_name("QueredReportTransactions")
         == "quered_report_transactions"
     )
+
+
+def test_events_routes():
+    class Handlers(Events):
+
+        async def cards(args, js):
+            pass
+
+        async def cards_inserted(args, js):
+            pass
+
+        async def clients(args, js):
+            pass
+
+    assert [name for name, _ in Handlers.routes("cards.inserted")] == [
+        "cards",
+        "cards_inserted",
+    ]
+    assert [name for name, _ in Handlers.routes("CardsDeleted")] == ["cards"]
+    assert Handlers.routes("Unknown") == ()
+    # Кэш имен событий из сообщений ограничен
+    for n in range(2000):
+        Handlers.routes(f"Unknown{n}")
+    assert Handlers.routes.cache_info().currsize <= 1024
+
+
+def test_handlers_index(handlers):
+    async def handler(obj):
+        pass
+
+    kafka_consumer.event_handler("live")(handler)
+    route = kafka_consumer.handlers_index["live"]
+    assert handler in [item.handler for item in route.event_handlers]
+    assert route.model is Live
+
+
+@pytest.mark.asyncio
+async def test_send_wire_format(monkeypatch):
+    sent = []
+
+    async def send_kafka_topic_value(topic, key, value, headers=None):
+        sent.append((topic, key, value))
+
+    producer = KafkaProducer()
+    monkeypatch.setattr(
+        producer, "send_kafka_topic_value", send_kafka_topic_value
+    )
+    monkeypatch.setattr(config, "DST_TOPIC", "events")
+    parent = Report(text="Отчет")
+    await parent.send(client_id="1")
+    # Получатель от вызывающего проверяется, как прежде
+    with pytest.raises(ValidationError):
+        await Report(text="Отчет").send(client_id=123)
+    absent = WillBeAbsent(
+        client_id=5, absence_start=datetime.datetime(2025, 8, 11, 14)
+    )
+    await absent.send(chat_id="2", parent=parent)
+    for obj, (topic, key, value) in zip((parent, absent), sent):
+        assert topic == "events"
+        assert key == obj.route_key()
+        # Как прежде: json.dumps(self.dict(), default=serialize_datetime)
+        assert json.loads(value) == json.loads(
+            json.dumps(obj.model_dump(), default=serialize_datetime)
+        )
+    header = json.loads(sent[1][2])["header"]
+    assert header["event"] == "WillBeAbsent"
+    assert header["parent"] == header["root"] == parent.header.uuid
+    assert json.loads(sent[1][2])["absence_start"] == "2025-08-11T14:00:00"
+    assert Header.model_validate(header).utc.endswith("+00:00")
+
+
+@pytest.mark.asyncio
+async def test_model_imported_after_handler(handlers, monkeypatch):
+    received = []
+
+    @kafka_consumer.event_handler("LateImported")
+    async def handler(obj):
+        received.append(obj)
+
+    assert kafka_consumer.handlers_index["lateimported"].model is None
+    # Модуль модели импортирован после регистрации обработчика
+    module = types.ModuleType("micro.models.late_events")
+
+    class LateImported(HeaderEvent):
+        text: str
+
+    module.LateImported = LateImported
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    monkeypatch.setattr(Schema(), "_models", None)
+    value = json.dumps(
+        {"header": {"event": "LateImported"}, "text": "x"}
+    ).encode()
+    await kafka_consumer.capture_message(kafka_consumer.EventMessage(value))
+    assert [obj.text for obj in received] == ["x"]
+    assert kafka_consumer.handlers_index["lateimported"].model is LateImported
+
+
+def test_serializer_float(monkeypatch):
+    class Measured(HeaderEvent):
+        value: float
+
+    for compact in (False, True):
+        monkeypatch.setattr(config, "JSON_COMPACT", compact)
+        for value in (1.5, 1e20, float("nan"), float("inf")):
+            event = Measured(value=value)
+            # float через model_dump: NaN и Infinity не превращаются в null
+            expected = codec.dumps(event.model_dump())
+            assert serializer(Measured)(event) == expected
+
+
+def test_serializer_compact(monkeypatch):
+    event = Report(text="Отчет")
+    expected = json.dumps(event.model_dump(), ensure_ascii=False)
+    # По умолчанию побайтно как json.dumps
+    assert serializer(Report)(event) == expected.encode()
+    monkeypatch.setattr(config, "JSON_COMPACT", True)
+    value = serializer(Report)(event)
+    assert b", " not in value
+    assert json.loads(value) == json.loads(expected)
+
+
+@pytest.mark.asyncio
+async def test_missing_model_refreshed_once(handlers, monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(Schema, "refresh", lambda self: refreshes.append(1))
+
+    @kafka_consumer.event_handler("NeverImported")
+    async def handler(obj):
+        pass
+
+    value = json.dumps({"header": {"event": "NeverImported"}}).encode()
+    for _ in range(3):
+        with pytest.raises(Exception, match="Не найдена model"):
+            await kafka_consumer.capture_message(
+                kafka_consumer.EventMessage(value)
+            )
+    # Модели собираются заново только для первого сообщения
+    assert refreshes == [1]
@@ -0,0 +1,82 @@
+# Подключить логирование главного модуля
+import asyncio
+import logging
+import pytest
+
+from aiokafka.structs import TopicPartition
+
+import micro.config as config
+from micro.kafka_consumer import OffsetCommitter, LanePriority, consumer_lanes
+
+logger = logging.getLogger(__name__)
+
+
+class FakeKafkaConsumer:
+
+    def __init__(self, fail: int = 0):
+        self.consumer = object()
+        self.commits = []
+        self.fail = fail
+
+    def assignment(self):
+        return {TopicPartition("t", 0), TopicPartition("t", 1)}
+
+    async def commit_offsets(self, offsets):
+        if self.fail:
+            self.fail -= 1
+            raise Exception("commit failed")
+        self.commits.append(offsets)
+
+
+@pytest.mark.asyncio
+async def test_committer_coalesce():
+    tp0, tp1 = TopicPartition("t", 0), TopicPartition("t", 1)
+    kafka_consumer = FakeKafkaConsumer()
+    committer = OffsetCommitter(kafka_consumer)
+    committer.stage(tp0, 10)
+    committer.stage(tp1, 5)
+    committer.stage(tp0, 12)
+    # Смещение назад не отправляется
+    committer.stage(tp0, 11)
+    task = asyncio.create_task(committer.run())
+    await asyncio.sleep(0.01)
+    task.cancel()
+    assert kafka_consumer.commits == [{tp0: 12, tp1: 5}]
+
+
+@pytest.mark.asyncio
+async def test_committer_flush_restage():
+    tp0, tp2 = TopicPartition("t", 0), TopicPartition("t", 2)
+    kafka_consumer = FakeKafkaConsumer(fail=1)
+    committer = OffsetCommitter(kafka_consumer)
+    committer.stage(tp0, 10)
+    committer.stage(tp2, 3)
+    with pytest.raises(Exception):
+        await committer.flush()
+    # Смещение не назначенной партиции не возвращается
+    assert committer.offsets == {tp0: 10}
+    await committer.flush([tp0])
+    assert kafka_consumer.commits == [{tp0: 10}]
+
+
+@pytest.mark.asyncio
+async def test_lane_priority(monkeypatch):
+    monkeypatch.setattr(config, "SRC_TOPIC", "live")
+    monkeypatch.setattr(config, "LOCAL_TOPIC", None)
+    monkeypatch.setattr(config, "DLQ_READ_TOPIC", "dlq")
+    monkeypatch.setattr(config, "LANE_MAX_WAIT_SEC", 1)
+    live, dlq = consumer_lanes()
+    assert (live.name, live.topics()) == ("live", ["live"])
+    assert (dlq.name, dlq.topics()) == ("dlq", ["dlq"])
+    priority = LanePriority([live, dlq])
+    # У live полный блок, dlq ждет
+    await priority.report(live, live.batch.max_records)
+    waiting = asyncio.create_task(priority.wait_turn(dlq))
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    # Очередь live разобрана, dlq читает
+    await priority.report(live, 0)
+    await asyncio.wait_for(waiting, 0.1)
+    # Lane с большим весом не ждет
+    await priority.report(dlq, dlq.batch.max_records)
+    await asyncio.wait_for(priority.wait_turn(live), 0.1)
@@ -0,0 +1,311 @@
+# Подключить логирование главного модуля
+import asyncio
+import logging
+import pytest
+
+from types import SimpleNamespace
+
+import micro.config as config
+from micro import codec
+import micro.kafka_consumer as kafka_consumer
+from micro.dispatcher import Dispatcher
+from micro.kafka_consumer import KafkaConsumerBase
+from micro.kafka_producer import KafkaProducer, KafkaDeliveryError
+from micro.memory_kafka import MemoryBroker
+from micro.models.common_events import Report
+from micro.models.crm_events import UpdatedClient
+from micro.singleton import MetaSingleton
+from micro.transactions import TransactionalProducers, current_transaction
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def memory_kafka(monkeypatch, handlers):
+    """Брокер kafka в памяти, чистые обработчики"""
+    MetaSingleton._instances.pop(MemoryBroker, None)
+    consumer_kafka = config.CONSUMER_KAFKA
+    monkeypatch.setitem(consumer_kafka, "bootstrap_servers", "memory://")
+    monkeypatch.setitem(consumer_kafka, "group_id", "test")
+    producer_kafka = config.PRODUCER_KAFKA
+    monkeypatch.setitem(producer_kafka, "bootstrap_servers", "memory://")
+    monkeypatch.setattr(config, "SRC_TOPIC", "events")
+    monkeypatch.setattr(config, "LOCAL_TOPIC", None)
+    monkeypatch.setattr(config, "DLQ_READ_TOPIC", None)
+    monkeypatch.setattr(KafkaProducer(), "producer", None)
+    return MemoryBroker()
+
+
+@pytest.mark.asyncio
+async def test_consume_handle_produce(memory_kafka):
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        await KafkaProducer().send_kafka_topic(
+            topic="replies", key=None, data={"text": obj.text.upper()}
+        )
+
+    consumer = KafkaConsumerBase()
+    await consumer.start()
+    consumer.dispatcher = Dispatcher(consumer)
+    for n in range(10):
+        await KafkaProducer().send_kafka_topic(
+            topic="events",
+            key=n,
+            data={"header": {"event": "Report", "uuid": str(n)}, "text": "t"},
+        )
+    consumed = 0
+    while consumed < 10:
+        result = await consumer.get_messages(timeout_ms=100)
+        consumed += sum(len(records) for records in result.values())
+        await consumer.dispatcher.run_batch(result)
+    # Ответы отправлены, смещения всех партиций зафиксированы
+    replies = [
+        record for records in memory_kafka.topics["replies"]
+        for record in records
+    ]
+    assert len(replies) == 10
+    assert sum(memory_kafka.committed["test"].values()) == 10
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_group_rebalance(memory_kafka):
+    first, second = KafkaConsumerBase(), KafkaConsumerBase()
+    await first.start()
+    assert len(first.assignment()) == config.MEMORY_KAFKA_PARTITIONS
+    await second.start()
+    await first.get_messages(timeout_ms=0)
+    # Партиции поделены между участниками группы
+    assert not first.assignment() & second.assignment()
+    assert len(first.assignment() | second.assignment()) == (
+        config.MEMORY_KAFKA_PARTITIONS
+    )
+    await second.stop()
+    await first.get_messages(timeout_ms=0)
+    assert len(first.assignment()) == config.MEMORY_KAFKA_PARTITIONS
+    await first.stop()
+
+
+@pytest.mark.asyncio
+async def test_pipeline_flush_before_commit(memory_kafka, monkeypatch):
+    monkeypatch.setattr(config, "PRODUCER_PIPELINE", True)
+    producer = KafkaProducer()
+    monkeypatch.setattr(producer, "failed", None)
+    consumer = KafkaConsumerBase()
+    await consumer.start()
+    tp = sorted(consumer.assignment())[0]
+    delivery = await producer.send_kafka_topic(
+        topic="replies", key=None, data={"text": "ok"}
+    )
+    await consumer.commit_offsets({tp: 1})
+    assert delivery.done() and not producer.deliveries
+    assert memory_kafka.committed["test"][tp] == 1
+
+    # Событие не подтверждено - смещение не фиксируется
+    async def send(*args, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        future.set_exception(RuntimeError("broker is down"))
+        return future
+
+    monkeypatch.setattr(producer.producer, "send", send)
+    await producer.send_kafka_topic(topic="replies", key=None, data={})
+    with pytest.raises(KafkaDeliveryError):
+        await consumer.commit_offsets({tp: 2})
+    with pytest.raises(KafkaDeliveryError):
+        await consumer.commit_offsets({tp: 2})
+    assert memory_kafka.committed["test"][tp] == 1
+    producer.clear_failed()
+    await consumer.commit_offsets({tp: 2})
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_transactions(memory_kafka, monkeypatch):
+    monkeypatch.setattr(config, "KAFKA_TRANSACTIONS", True)
+    MetaSingleton._instances.pop(TransactionalProducers, None)
+    fail = {"n": 1}
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        await KafkaProducer().send_kafka_topic(
+            topic="replies", key=None, data={"text": obj.text}
+        )
+        if obj.text == str(fail["n"]):
+            raise asyncio.CancelledError()
+
+    consumer = KafkaConsumerBase()
+    await consumer.start()
+    consumer.dispatcher = Dispatcher(consumer)
+    for n in range(3):
+        await KafkaProducer().send_kafka_topic(
+            topic="events",
+            key="client",
+            data={
+                "header": {"event": "Report", "uuid": str(n)},
+                "text": str(n),
+            },
+        )
+    result = await consumer.get_messages(timeout_ms=100)
+    # Транзакция прервана: ни ответов, ни смещений
+    with pytest.raises(asyncio.CancelledError):
+        await consumer.dispatcher.run_batch(result)
+    assert "replies" not in memory_kafka.topics or not any(
+        memory_kafka.topics["replies"]
+    )
+    assert not memory_kafka.committed.get("test")
+    # Повтор пакета фиксирует ответы и смещение вместе
+    fail["n"] = None
+    consumer.dispatcher = Dispatcher(consumer)
+    await consumer.dispatcher.run_batch(result)
+    replies = [
+        record for records in memory_kafka.topics["replies"]
+        for record in records
+    ]
+    assert len(replies) == 3
+    assert sum(memory_kafka.committed["test"].values()) == 3
+    await TransactionalProducers().close()
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_transaction_abort_with_batch_handler(memory_kafka, monkeypatch):
+    monkeypatch.setattr(config, "KAFKA_TRANSACTIONS", True)
+    monkeypatch.setattr(config, "DLQ_WRITE_TOPIC", None)
+    monkeypatch.setattr(kafka_consumer, "batch_event_handlers", [])
+    MetaSingleton._instances.pop(TransactionalProducers, None)
+    fail = {"text": "1"}
+    batches = []
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        if obj.text == fail["text"]:
+            raise RuntimeError("fail")
+
+    @kafka_consumer.batch_event_handler("Report", max_size=1)
+    async def on_reports(objs: list):
+        batches.append(([obj.text for obj in objs], current_transaction.get()))
+
+    consumer = KafkaConsumerBase()
+    await consumer.start()
+    consumer.dispatcher = Dispatcher(consumer)
+    for n in range(2):
+        await KafkaProducer().send_kafka_topic(
+            topic="events",
+            key="client",
+            data={
+                "header": {"event": "Report", "uuid": str(n)},
+                "text": str(n),
+            },
+        )
+    result = await consumer.get_messages(timeout_ms=100)
+    # Транзакция прервана: пакет не передан, смещения не зафиксированы
+    with pytest.raises(RuntimeError):
+        await consumer.dispatcher.run_batch(result)
+    assert batches == []
+    assert not memory_kafka.committed.get("test")
+    # Повтор: пакеты после фиксации транзакции и вне ее
+    fail["text"] = None
+    consumer.dispatcher = Dispatcher(consumer)
+    await consumer.dispatcher.run_batch(result)
+    assert batches == [(["0"], None), (["1"], None)]
+    assert sum(memory_kafka.committed["test"].values()) == 2
+    await TransactionalProducers().close()
+    await consumer.stop()
+
+
+@pytest.mark.asyncio
+async def test_send_many(memory_kafka, monkeypatch):
+    monkeypatch.setattr(config, "DST_TOPIC", "mailing")
+    parent = Report(text="parent")
+    parent.stamp()
+    reports = [Report(text=str(n)) for n in range(3)]
+    errors = await Report.send_many(
+        [reports[0], (reports[1], {"chat_id": "7"}), reports[2]],
+        parent=parent,
+        client_id="1",
+    )
+    assert errors == [None, None, None]
+    for obj in reports:
+        assert obj.header.parent == parent.header.uuid
+        assert obj.header.root == parent.header.root
+    assert reports[1].route_key() == "7"
+    sent = [
+        record for records in memory_kafka.topics["mailing"]
+        for record in records
+    ]
+    assert len(sent) == 3
+
+    # Ошибка отправки одного события
+    send = KafkaProducer().producer.send
+
+    async def failing_send(topic, value=None, key=None, **kwargs):
+        if b'"text": "bad"' in value:
+            raise RuntimeError("too large")
+        return await send(topic, value=value, key=key, **kwargs)
+
+    monkeypatch.setattr(KafkaProducer().producer, "send", failing_send)
+    errors = await Report.send_many([Report(text="ok"), Report(text="bad")])
+    assert errors[0] is None and isinstance(errors[1], RuntimeError)
+
+
+@pytest.mark.asyncio
+async def test_coalesce(memory_kafka, monkeypatch):
+    monkeypatch.setattr(config, "DST_TOPIC", "crm")
+    monkeypatch.setattr(config, "PRODUCER_COALESCE", True)
+    producer = KafkaProducer()
+    monkeypatch.setattr(producer, "failed", None)
+    monkeypatch.setattr(UpdatedClient, "coalesce_window_ms", 50)
+    for client_id in (1, 1, 2, 1):
+        await UpdatedClient(client_id=client_id).send()
+    await asyncio.sleep(0.1)
+    sent = [
+        record.key for records in memory_kafka.topics["crm"]
+        for record in records
+    ]
+    assert sorted(sent) == [b"1", b"2"]
+    # flush() перед фиксацией смещений отправляет сразу
+    monkeypatch.setattr(UpdatedClient, "coalesce_window_ms", 60000)
+    await UpdatedClient(client_id=3).send()
+    await UpdatedClient(client_id=3).send()
+    await producer.flush()
+    assert not producer.coalesced
+    assert sum(len(records) for records in memory_kafka.topics["crm"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_msgpack_topic(memory_kafka, monkeypatch):
+    pytest.importorskip("msgpack")
+    monkeypatch.setattr(config, "MSGPACK_TOPICS", ["events"])
+    received = []
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        received.append(obj)
+
+    consumer = KafkaConsumerBase()
+    await consumer.start()
+    consumer.dispatcher = Dispatcher(consumer)
+    await Report(text="Отчет").send(client_id="1", topic="events")
+    # json топик рядом с msgpack
+    await Report(text="json").send(client_id="1", topic="other")
+    record = [
+        record for records in memory_kafka.topics["events"]
+        for record in records
+    ][0]
+    assert record.headers == ((codec.CONTENT_TYPE, b"application/msgpack"),)
+    assert codec.decode(record.value)["text"] == "Отчет"
+    other = [
+        record for records in memory_kafka.topics["other"]
+        for record in records
+    ][0]
+    assert other.value.startswith(b"{") and not other.headers
+    # Формат определяется и без заголовка
+    await consumer.dispatcher.run_batch(
+        await consumer.get_messages(timeout_ms=100)
+    )
+    await kafka_consumer.capture(
+        SimpleNamespace(value=record.value, timestamp=record.timestamp)
+    )
+    assert [obj.text for obj in received] == ["Отчет", "Отчет"]
+    assert received[0].header.event == "Report"
+    await consumer.stop()
@@ -0,0 +1,52 @@
+# Подключить логирование главного модуля
+import json
+import logging
+import pytest
+
+import micro.config as config
+from micro.outbox import Outbox
+from micro.models.common_events import Report
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_send_into_caller_transaction(monkeypatch):
+    monkeypatch.setattr(Outbox(), "table_ready", True)
+    monkeypatch.setattr(config, "DST_TOPIC", "events")
+    queries = [{"sql": "update clients set ...", "params": {}}]
+    parent = Report(text="parent")
+    await parent.send(client_id="1", outbox=queries)
+    child = Report(text="child")
+    await child.send(client_id="1", parent=parent, outbox=queries)
+    assert len(queries) == 3
+    params = queries[2]["params"]
+    assert params["topic"] == "events" and params["key"] == "1"
+    value = json.loads(params["value"])
+    assert value["text"] == "child"
+    assert value["header"]["parent"] == parent.header.uuid
+    assert value["header"]["root"] == parent.header.uuid
+
+
+def test_query_keeps_headers():
+    headers = [("content-type", b"application/msgpack")]
+    params = Outbox.query("events", "1", b"\x81", headers)["params"]
+    assert json.loads(params["headers"]) == [
+        ["content-type", "YXBwbGljYXRpb24vbXNncGFjaw=="]
+    ]
+    assert Outbox.query("events", "1", b"{}")["params"]["headers"] is None
+
+
+@pytest.mark.asyncio
+async def test_send_with_caller_cursor(monkeypatch):
+    executed = []
+
+    class Cursor:
+        async def execute(self, sql, params=None):
+            executed.append(params)
+
+    monkeypatch.setattr(Outbox(), "table_ready", True)
+    monkeypatch.setattr(config, "DST_TOPIC", "events")
+    await Report(text="cursor").send(client_id="1", outbox=Cursor())
+    assert [params["key"] for params in executed] == ["1"]
+    assert json.loads(executed[0]["value"])["text"] == "cursor"
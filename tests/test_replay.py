@@ -0,0 +1,77 @@
+# Подключить логирование главного модуля
+import json
+import logging
+import pytest
+
+import micro.config as config
+import micro.kafka_consumer as kafka_consumer
+from micro.kafka_producer import KafkaProducer
+from micro.memory_kafka import MemoryBroker
+from micro.models.common_events import Report
+from micro.models.crm_events import UpdatedClient
+from micro.replay import replay
+from micro.singleton import MetaSingleton
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.mark.asyncio
+async def test_replay(tmp_path, monkeypatch):
+    MetaSingleton._instances.pop(MemoryBroker, None)
+    monkeypatch.setattr(KafkaProducer(), "producer", None)
+    monkeypatch.setattr(kafka_consumer, "event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "handlers_index", {})
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        await KafkaProducer().send_kafka_topic(
+            topic="replies", key=None, data={"text": obj.text}
+        )
+
+    path = tmp_path / "dump.jsonl"
+    with open(path, "w") as f:
+        for n in range(5):
+            header = {"event": "Report", "uuid": str(n)}
+            value = json.dumps({"header": header, "text": "t"})
+            line = {"offset": n, "timestamp": 1000 + n, "key": None}
+            f.write(json.dumps({**line, "value": value}) + "\n")
+        line = {"timestamp": 1010, "key": "k", "value": "{}"}
+        f.write(json.dumps(line) + "\n")
+    result = await replay(str(path), speed=100, concurrency=2)
+    assert [(row["event"], row["count"]) for row in result["events"]] == [
+        ("Report", 5),
+        ("unknown", 1),
+    ]
+    assert result["produced"] == {"replies": 5}
+    assert result["errors"] == 0
+
+
+@pytest.mark.asyncio
+async def test_replay_coalesce(tmp_path, monkeypatch):
+    MetaSingleton._instances.pop(MemoryBroker, None)
+    monkeypatch.setattr(KafkaProducer(), "producer", None)
+    monkeypatch.setattr(KafkaProducer(), "failed", None)
+    monkeypatch.setattr(kafka_consumer, "event_handlers", [])
+    monkeypatch.setattr(kafka_consumer, "handlers_index", {})
+    monkeypatch.setattr(config, "DST_TOPIC", "crm")
+    monkeypatch.setattr(config, "PRODUCER_COALESCE", True)
+    # Прогон не пишет в рабочую таблицу outbox
+    monkeypatch.setattr(config, "OUTBOX", True)
+    monkeypatch.setattr(UpdatedClient, "coalesce_window_ms", 60000)
+
+    @kafka_consumer.event_handler("Report")
+    async def on_report(obj: Report):
+        await UpdatedClient(client_id=int(obj.text)).send()
+
+    path = tmp_path / "dump.jsonl"
+    with open(path, "w") as f:
+        for n in range(3):
+            header = {"event": "Report", "uuid": str(n)}
+            value = json.dumps({"header": header, "text": str(n % 2)})
+            f.write(json.dumps({"offset": n, "key": None, "value": value}))
+            f.write("\n")
+    result = await replay(str(path))
+    # Ожидающие окна события отправлены до отчета
+    assert result["produced"] == {"crm": 2}
+    assert result["errors"] == 0
+    assert config.OUTBOX is True
@@ -0,0 +1,41 @@
+# Подключить логирование главного модуля
+import asyncio
+import logging
+import pytest
+
+import micro.config as config
+from micro.status import Status
+from micro.supervisor import Supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class FakeRunner:
+
+    stopped: bool = False
+
+    async def run_main(self, app, primary: bool = True):
+        if primary:
+            # Процесс 0 падает
+            await asyncio.sleep(0.2)
+            raise SystemExit(1)
+        await Status().set_ok()
+        while not self.stopped:
+            await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+async def test_supervisor_restart(monkeypatch):
+    monkeypatch.setattr(config, "WORKER_RESTART_DELAY_SEC", 0)
+    supervisor = Supervisor(FakeRunner(), app=None, workers=2)
+    task = asyncio.create_task(supervisor.run())
+    await asyncio.sleep(0.5)
+    first = supervisor.status()[0]["pid"]
+    await asyncio.sleep(1.5)
+    # Упавший процесс перезапущен, второй работает
+    assert supervisor.status()[0]["pid"] != first
+    assert supervisor.status()[1]["alive"]
+    assert supervisor.status()[1]["ok"]
+    await supervisor.stop()
+    await task
+    assert not any(item["alive"] for item in supervisor.status())